@@ -1,61 +1,42 @@
 """
 Split images from directory in to training/ validation and test data-sets
+
+Writes a manifest (path, label, hash, size) for every split, see visual_home_finder/dataset_manifest.py. Re-running
+the script after scraping more images only hashes the new images and adds them to the splits. The split
+directories in data/processed are only (re)built if --materialize is given.
+
+Usage (from the scripts directory):
+    python build_dataset.py
+    python build_dataset.py --materialize hardlink
 """
 
-from visual_home_finder import config, paths
-import random
-import shutil
 import os
-
-# Retrieve paths to all images and shuffle their order
-image_paths = list(paths.list_images(config.ORIG_INPUT_DIR))
-random.seed(13)
-random.shuffle(image_paths)
-
-# Calculate the training and test data split
-i = int(len(image_paths) * config.TRAIN_SPLIT)
-train_paths = image_paths[:i]
-test_paths = image_paths[i:]
-
-# Calculate the training and validation data split
-i = int(len(train_paths) * config.VAL_SPLIT)
-val_paths = train_paths[:i]
-train_paths = train_paths[i:]
-
-# define the datasets that we'll be building
-datasets = [
-    ("training", train_paths, config.TRAIN_PATH),
-    ("validation", val_paths, config.VAL_PATH),
-    ("testing", test_paths, config.TEST_PATH)
-]
-
-# loop over the datasets
-for (dType, imagePaths, baseOutput) in datasets:
-
-    print("[INFO] building '{}' split".format(dType))
-    # if the output base output directory does not exist, create it
-    if not os.path.exists(baseOutput):
-        print("[INFO] 'creating {}' directory".format(baseOutput))
-        os.makedirs(baseOutput)
-
-    # loop over the input image paths
-        for inputPath in imagePaths:
-
-            # extract the filename of the input image along with class label
-            filename = inputPath.split(os.path.sep)[-1]
-            label = inputPath.split(os.path.sep)[-2]
-
-            # build the path to the label directory
-            labelPath = os.path.sep.join([baseOutput, label])
-
-            # if the label output directory does not exist, create it
-            if not os.path.exists(labelPath):
-                print("[INFO] 'creating {}' directory".format(labelPath))
-                os.makedirs(labelPath)
-
-            # construct the path to the destination image and then copy image
-            p = os.path.sep.join([labelPath, filename])
-            shutil.copy2(inputPath, p)
-
-# Display the number of files in each folder (need to install package tree for mac using brew install tree)
-os.system("tree {} --filelimit 10".format(config.BASE_PATH))
\ No newline at end of file
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'visual_home_finder'))
+import config
+import dataset_manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split the home-style images in to training/ validation/ test.')
+    parser.add_argument('--input', type=str, default=config.ORIG_INPUT_DIR, help='directory of images per style')
+    parser.add_argument('--materialize', type=str, default=None, choices=dataset_manifest.MATERIALIZE_MODES,
+                        help='also create the split directories, with hard links, symlinks or copies')
+    parser.add_argument('--workers', type=int, default=8, help='number of threads hashing/copying images')
+    args = parser.parse_args()
+
+    manifests = dataset_manifest.build_manifests(args.input, workers=args.workers)
+    for split, manifest_df in manifests.items():
+        manifest_file, split_dir = dataset_manifest.SPLITS[split]
+        print("[INFO] '{}' split: {} images in {}".format(split, len(manifest_df), manifest_file))
+        for label, count in manifest_df['label'].value_counts().sort_index().items():
+            print("    {}: {}".format(label, count))
+        if args.materialize is not None:
+            written = dataset_manifest.materialize(manifest_df, split_dir, args.materialize, workers=args.workers)
+            print("[INFO] {} new images in '{}'".format(written, split_dir))
+
+
+if __name__ == "__main__":
+    main()
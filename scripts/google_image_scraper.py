@@ -12,10 +12,7 @@ from retry import retry
 import argparse
 import logging
 import os
-import io
-import requests
-from PIL import Image
-import hashlib
+from image_downloader import download_images
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 logger = logging.getLogger()
@@ -104,31 +101,16 @@ def google_image_search(wd, query, safe="off", n=20, opts='', out=None):
     sources = get_images(wd, n=n, out=out)
     return sources
 
-def persist_image(folder_path:str,url:str):
-    try:
-        image_content = requests.get(url).content
-    except Exception as e:
-        print(f"ERROR - Could not download {url} - {e}")
-
-    try:
-        image_file = io.BytesIO(image_content)
-        image = Image.open(image_file).convert('RGB')
-        file_path = os.path.join(folder_path, hashlib.sha1(image_content).hexdigest()[:10] + '.jpg')
-        with open(file_path, 'wb') as f:
-            image.save(f, "JPEG", quality=100, subsampling=0)
-        print(f"SUCCESS - saved {url} - as {file_path}")
-    except Exception as e:
-        print(f"ERROR - Could not save {url} - {e}")
-
 def main():
     parser = argparse.ArgumentParser(description='Fetch image URLs from Google Image Search.')
     parser.add_argument('--safe', type=str, default="off", help='safe search [off|active|images]')
     parser.add_argument('--opts', type=str, default="", help='search options, e.g. isz:lt,islt:svga,itp:photo,ic:color,ift:jpg')
-    #parser.add_argument('query', type=str, help='image search query')
-    #parser.add_argument('n', type=int, default=20, help='number of images (approx)')
-    search_term = "victorian home"
-    number_of_images = 1000
-    target_path = './images'
+    parser.add_argument('--query', type=str, default="victorian home", help='image search query')
+    parser.add_argument('--n', type=int, default=1000, help='number of images (approx)')
+    parser.add_argument('--output', type=str, default='./images', help='directory to save the images to')
+    parser.add_argument('--workers', type=int, default=16, help='maximum number of downloads at the same time')
+    parser.add_argument('--min_host_interval', type=float, default=0.2,
+                        help='minimum time in seconds between requests to the same host')
     args = parser.parse_args()
 
     opts = Options()
@@ -136,17 +118,16 @@ def main():
     opts.add_argument("--blink-settings=imagesEnabled=false")
     starting_time = time.time()
     with webdriver.Chrome(options=opts) as wd:
-        sources = google_image_search(wd, search_term, safe=args.safe, n=number_of_images, opts=args.opts, out=sys.stdout)
-        #sources = google_image_search(wd, args.query, safe=args.safe, n=args.n, opts=args.opts, out=sys.stdout)
+        sources = google_image_search(wd, args.query, safe=args.safe, n=args.n, opts=args.opts, out=sys.stdout)
 
     print("Downloading images from URLs")
-    target_folder = os.path.join(target_path, '_'.join(search_term.lower().split(' ')))
-    if not os.path.exists(target_folder):
-        os.makedirs(target_folder)
-    for elem in sources:
-        print(elem)
-        persist_image(target_folder, elem)
+    target_folder = os.path.join(args.output, '_'.join(args.query.lower().split(' ')))
+    counts = download_images(sources, target_folder, workers=args.workers, min_host_interval=args.min_host_interval)
+    print("%(saved)d saved, %(duplicate)d duplicates, %(error)d errors, %(skipped)d already downloaded" % counts)
 
     print("--- %s seconds ---" % (time.time() - starting_time))
-main()
+
+
+if __name__ == "__main__":
+    main()
 
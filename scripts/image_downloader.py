@@ -0,0 +1,214 @@
+"""
+Concurrent image downloader for the scraped image URLs
+
+Images are downloaded by a bounded pool of threads sharing one pooled requests session, with retries (with backoff)
+and a minimum interval between requests to the same host. Every download is recorded in a persistent index
+(download_index.jsonl in the output folder), so URLs and images (by content hash) that were already downloaded are
+skipped when the scraper is run again. Images that already are valid JPEGs are saved as downloaded; other formats
+are converted to JPEG.
+
+Usage, for a file with one URL per line (e.g. the output of google_image_scraper.py):
+    python image_downloader.py urls.txt --output ./images/victorian_home --workers 16
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
+
+INDEX_FILE = 'download_index.jsonl'
+
+
+def make_session(pool_size=16, retries=3, backoff=0.5):
+    """
+    Returns a requests session with a connection pool and retries on connection errors and 429/5xx responses
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET',))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = 'Mozilla/5.0 (HomeSpotter image downloader)'
+    return session
+
+
+class HostRateLimiter:
+    """
+    Keeps at least min_interval seconds between the starts of requests to the same host
+    """
+
+    def __init__(self, min_interval=0.2):
+        self.min_interval = min_interval
+        self._next_time = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_time.get(host, now))
+            self._next_time[host] = start + self.min_interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class DownloadIndex:
+    """
+    Persistent record of downloaded URLs and the content hashes of the saved images (one JSON line per URL)
+    """
+
+    def __init__(self, folder_path):
+        self.index_file = os.path.join(folder_path, INDEX_FILE)
+        self.urls = set()
+        self.hashes = set()
+        self._lock = threading.Lock()
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    # Failed downloads are tried again on the next run
+                    if entry['status'] != 'error':
+                        self.urls.add(entry['url'])
+                    # Only saved images block their hash: an image that could not be saved is tried again
+                    if entry['status'] == 'saved' and entry.get('hash'):
+                        self.hashes.add(entry['hash'])
+
+    def claim_hash(self, content_hash):
+        """
+        :return: False if an image with this hash was already saved (or is being saved by another thread)
+        """
+        with self._lock:
+            if content_hash in self.hashes:
+                return False
+            self.hashes.add(content_hash)
+            return True
+
+    def release_hash(self, content_hash):
+        """
+        Releases a hash claimed with claim_hash() whose image could not be saved, so another URL can save it
+        """
+        with self._lock:
+            self.hashes.discard(content_hash)
+
+    def record(self, url, status, content_hash=None, file_path=None):
+        with self._lock:
+            self.urls.add(url)
+            with open(self.index_file, 'a') as f:
+                f.write(json.dumps({'url': url, 'status': status, 'hash': content_hash, 'file': file_path}) + '\n')
+
+
+def is_valid_jpeg(image_content):
+    if not image_content.startswith(b'\xff\xd8'):
+        return False
+    try:
+        image = Image.open(io.BytesIO(image_content))
+        image.verify()
+        return image.format == 'JPEG' and image.mode in ('RGB', 'L')
+    except Exception:
+        return False
+
+
+def save_image(folder_path, image_content):
+    """
+    Saves an image as <first 10 characters of its SHA-1>.jpg. Valid JPEGs are written as downloaded.
+    :return: Path of the saved image
+    """
+    file_path = os.path.join(folder_path, hashlib.sha1(image_content).hexdigest()[:10] + '.jpg')
+    if not is_valid_jpeg(image_content):
+        image = Image.open(io.BytesIO(image_content)).convert('RGB')
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=95)
+        image_content = output.getvalue()
+    with open(file_path + '.tmp', 'wb') as f:
+        f.write(image_content)
+    os.replace(file_path + '.tmp', file_path)
+    return file_path
+
+
+def download_image(session, rate_limiter, index, folder_path, url, timeout=10):
+    """
+    Downloads and saves one image
+    :return: Status: 'saved', 'duplicate' or 'error'
+    """
+    try:
+        rate_limiter.wait(url)
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+        image_content = response.content
+    except requests.RequestException as e:
+        print(f"ERROR - Could not download {url} - {e}")
+        index.record(url, 'error')
+        return 'error'
+
+    content_hash = hashlib.sha1(image_content).hexdigest()
+    if not index.claim_hash(content_hash):
+        index.record(url, 'duplicate', content_hash)
+        return 'duplicate'
+    try:
+        file_path = save_image(folder_path, image_content)
+    except Exception as e:
+        print(f"ERROR - Could not save {url} - {e}")
+        index.release_hash(content_hash)
+        index.record(url, 'error', content_hash)
+        return 'error'
+    index.record(url, 'saved', content_hash, file_path)
+    return 'saved'
+
+
+def download_images(urls, folder_path, workers=16, min_host_interval=0.2, retries=3, timeout=10, session=None):
+    """
+    Downloads images to a folder, skipping URLs and images that were downloaded before
+    :param urls: List of image URLs
+    :param folder_path: Folder to save the images (and the download index) to
+    :param workers: Maximum number of downloads at the same time
+    :param min_host_interval: Minimum time in seconds between requests to the same host
+    :param retries: Number of retries for connection errors and 429/5xx responses
+    :param timeout: Timeout in seconds for each request
+    :param session: requests session to use. A pooled session is made if None.
+    :return: Dictionary with the number of URLs per status ('saved', 'duplicate', 'error', 'skipped')
+    """
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+    index = DownloadIndex(folder_path)
+    new_urls = list(dict.fromkeys(url for url in urls if url not in index.urls))
+    counts = {'saved': 0, 'duplicate': 0, 'error': 0, 'skipped': len(urls) - len(new_urls)}
+    session = session or make_session(pool_size=workers, retries=retries)
+    rate_limiter = HostRateLimiter(min_host_interval)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for status in executor.map(lambda url: download_image(session, rate_limiter, index, folder_path, url,
+                                                              timeout), new_urls):
+            counts[status] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download images from a list of URLs.')
+    parser.add_argument('urls', type=str, help='file with one image URL per line, or - for stdin')
+    parser.add_argument('--output', type=str, required=True, help='folder to save the images to')
+    parser.add_argument('--workers', type=int, default=16, help='maximum number of downloads at the same time')
+    parser.add_argument('--min_host_interval', type=float, default=0.2,
+                        help='minimum time in seconds between requests to the same host')
+    args = parser.parse_args()
+
+    url_file = sys.stdin if args.urls == '-' else open(args.urls)
+    urls = [line.strip() for line in url_file if line.strip().startswith('http')]
+    starting_time = time.time()
+    counts = download_images(urls, args.output, workers=args.workers, min_host_interval=args.min_host_interval)
+    print("%(saved)d saved, %(duplicate)d duplicates, %(error)d errors, %(skipped)d already downloaded" % counts)
+    print("--- %s seconds ---" % (time.time() - starting_time))
+
+
+if __name__ == "__main__":
+    main()
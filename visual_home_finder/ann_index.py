@@ -0,0 +1,290 @@
+"""
+Approximate nearest-neighbour (IVF) index for large home-listing catalogs.
+
+The listings are clustered with (spherical) k-means. A query is only scored against the listings in the
+n_probe clusters whose centroids are most similar to it. n_probe is the recall-vs-latency knob: n_probe = n_lists
+is an exact search, smaller values score fewer listings.
+
+Usage (from the visual_home_finder directory) to build the index and report its recall against brute force:
+    python ann_index.py --n_probe 4 8 16
+"""
+
+import os
+import time
+import hashlib
+import argparse
+import numpy as np
+
+import config
+import embedding_store
+from search import SimilaritySearch, normalize_rows, top_indices
+
+
+def spherical_kmeans(embeddings, n_clusters, n_iter=20, seed=13):
+    """
+    Clusters unit-norm embeddings by cosine similarity
+    :param embeddings: (N x dim) array of L2-normalized embeddings
+    :param n_clusters: Number of clusters
+    :param n_iter: Number of k-means iterations
+    :param seed: Seed for picking the initial centroids
+    :return: Tuple of (n_clusters x dim centroids, N cluster assignments)
+    """
+    rng = np.random.RandomState(seed)
+    centroids = embeddings[rng.choice(len(embeddings), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = np.argmax(embeddings @ centroids.T, axis=1)
+        # Sum the members of every cluster in one pass, then re-normalize the sums to get the new centroids
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, embeddings)
+        empty = ~sums.any(axis=1)
+        # Re-seed empty clusters with random listings so that every cluster stays in use
+        sums[empty] = embeddings[rng.choice(len(embeddings), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    assignments = np.argmax(embeddings @ centroids.T, axis=1)
+    return centroids, assignments
+
+
+def _update_fingerprint(digest, listing_embeddings, chunk_size=65536):
+    # Hashed in chunks, so that a memory-mapped catalog is never copied as a whole
+    for start in range(0, len(listing_embeddings), chunk_size):
+        digest.update(np.ascontiguousarray(listing_embeddings[start:start + chunk_size], dtype=np.float32))
+    return digest
+
+
+class IVFIndex:
+    """
+    Inverted-file index over normalized listing embeddings. Has the same search interface as SimilaritySearch,
+    so the app can use either.
+    """
+
+    def __init__(self, centroids, list_offsets, list_ids, listing_embeddings, n_probe=config.ANN_N_PROBE,
+                 removed_rows=None):
+        """
+        :param centroids: (n_lists x dim) unit-norm cluster centroids
+        :param list_offsets: Array of n_lists + 1 offsets. Cluster ii holds list_ids[list_offsets[ii]:list_offsets[ii+1]]
+        :param list_ids: Listing indices, grouped by cluster
+        :param listing_embeddings: (N x dim) array of listing embeddings, in the original listing order
+        :param n_probe: Default number of clusters to score per query
+        :param removed_rows: Rows of listings that should never be returned (e.g. tombstoned in the store)
+        """
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.list_ids = np.asarray(list_ids, dtype=np.int64)
+        # Store the embeddings grouped by cluster, so that scoring a cluster is a product with a contiguous slice
+        self.embeddings = normalize_rows(listing_embeddings)[self.list_ids]
+        self._fingerprint = _update_fingerprint(hashlib.sha1(), listing_embeddings)
+        self.n_probe = n_probe
+        self.removed = np.zeros(len(self.list_ids), dtype=bool)
+        if removed_rows is not None:
+            self.removed[removed_rows] = True
+
+    @classmethod
+    def build(cls, listing_embeddings, n_lists=None, n_probe=config.ANN_N_PROBE, n_iter=20, seed=13):
+        """
+        Clusters the listing embeddings and builds the index
+        :param listing_embeddings: (N x dim) array of listing embeddings
+        :param n_lists: Number of clusters. Defaults to sqrt(N).
+        :param n_probe: Default number of clusters to score per query
+        :param n_iter: Number of k-means iterations
+        :param seed: Seed for k-means
+        :return: IVFIndex
+        """
+        embeddings = normalize_rows(listing_embeddings)
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(embeddings)))
+        n_lists = max(1, min(n_lists, len(embeddings)))
+        centroids, assignments = spherical_kmeans(embeddings, n_lists, n_iter=n_iter, seed=seed)
+        list_ids = np.argsort(assignments, kind='stable')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        return cls(centroids, list_offsets, list_ids, listing_embeddings, n_probe=n_probe)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def fingerprint(self):
+        """
+        :return: SHA-1 of the listing embeddings (in listing order), which identifies the catalog the index is for
+        """
+        return self._fingerprint.hexdigest()
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    def add(self, listing_embeddings):
+        """
+        Appends listings without re-clustering. Each new listing goes to the cluster with the closest centroid.
+        :param listing_embeddings: (number of new listings x embedding size) array of listing embeddings
+        """
+        new_embeddings = normalize_rows(listing_embeddings)
+        _update_fingerprint(self._fingerprint, listing_embeddings)
+        new_ids = np.arange(len(self.list_ids), len(self.list_ids) + len(new_embeddings))
+        assignments = np.concatenate([np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets)),
+                                      np.argmax(new_embeddings @ self.centroids.T, axis=1)])
+        order = np.argsort(assignments, kind='stable')
+        self.list_ids = np.concatenate([self.list_ids, new_ids])[order]
+        self.embeddings = np.concatenate([self.embeddings, new_embeddings])[order]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=self.n_lists))])
+        self.removed = np.concatenate([self.removed, np.zeros(len(new_embeddings), dtype=bool)])
+
+    def remove(self, rows):
+        """
+        Stops returning listings in search results
+        :param rows: Rows of the listings to remove
+        """
+        self.removed[rows] = True
+
+    def save(self, index_file):
+        """
+        Saves the clustering, the removed listings and a fingerprint of the catalog. The embeddings themselves are
+        not saved, they are read from the embedding store.
+        :param index_file: .npz file to save the index to
+        """
+        np.savez(index_file, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids,
+                 n_probe=self.n_probe, removed=self.removed, fingerprint=self.fingerprint())
+
+    @classmethod
+    def load(cls, index_file, listing_embeddings, removed_rows=None):
+        """
+        Loads an index saved with save(). Raises a ValueError if the index was built from other embeddings (e.g. a
+        different or re-embedded catalog), even if it has the same number of listings.
+        :param index_file: .npz file with the index
+        :param listing_embeddings: (N x dim) array of listing embeddings the index was built from
+        :param removed_rows: Rows of listings that should never be returned (e.g. tombstoned in the store), on top
+        of the ones removed when the index was saved
+        :return: IVFIndex
+        """
+        data = np.load(index_file)
+        if len(data['list_ids']) != len(listing_embeddings):
+            raise ValueError("Index %s was built for %d listings, got %d. Rebuild the index." %
+                             (index_file, len(data['list_ids']), len(listing_embeddings)))
+        if 'fingerprint' not in data:
+            raise ValueError("Index %s has no catalog fingerprint. Rebuild the index." % index_file)
+        index = cls(data['centroids'], data['list_offsets'], data['list_ids'], listing_embeddings,
+                    n_probe=int(data['n_probe']), removed_rows=removed_rows)
+        if index.fingerprint() != str(data['fingerprint']):
+            raise ValueError("Index %s was built from other listing embeddings. Rebuild the index." % index_file)
+        index.removed |= data['removed']
+        return index
+
+    def search(self, query_embedding, threshold=None, k=None, n_probe=None):
+        """
+        Finds the listings most similar to a single query
+        :param query_embedding: Embedding of the query image
+        :param threshold: If given, only listings with a similarity above the threshold are returned
+        :param k: If given, at most k listings are returned
+        :param n_probe: Number of clusters to score. Defaults to self.n_probe.
+        :return: Tuple of (listing indices, similarities), sorted from most to least similar
+        """
+        return self.search_batch(query_embedding, threshold=threshold, k=k, n_probe=n_probe)[0]
+
+    def search_batch(self, query_embeddings, threshold=None, k=None, n_probe=None):
+        """
+        Finds the listings most similar to each of a batch of queries
+        :param query_embeddings: (number of queries x embedding size) array of query embeddings
+        :param threshold: If given, only listings with a similarity above the threshold are returned
+        :param k: If given, at most k listings are returned per query
+        :param n_probe: Number of clusters to score. Defaults to self.n_probe.
+        :return: List with one (listing indices, similarities) tuple per query
+        """
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        queries = normalize_rows(query_embeddings)
+        centroid_scores = queries @ self.centroids.T
+        results = []
+        for query, query_centroid_scores in zip(queries, centroid_scores):
+            probes = np.argpartition(-query_centroid_scores, n_probe - 1)[:n_probe]
+            rows = np.concatenate([np.arange(self.list_offsets[pp], self.list_offsets[pp + 1]) for pp in probes])
+            scores = np.concatenate([self.embeddings[self.list_offsets[pp]:self.list_offsets[pp + 1]] @ query
+                                     for pp in probes])
+            removed = self.removed[self.list_ids[rows]]
+            scores[removed] = -np.inf
+            selected = top_indices(scores, threshold=-np.inf if threshold is None else threshold, k=k)
+            results.append((self.list_ids[rows[selected]], scores[selected]))
+        return results
+
+
+def build_search_index(listing_embeddings, removed_rows=None, index_type=config.SEARCH_INDEX,
+                       index_file=config.ANN_INDEX_FILE, min_listings=config.ANN_MIN_LISTINGS):
+    """
+    Returns the search index used by the app. Small catalogs always use exact search.
+    :param listing_embeddings: (N x dim) array of listing embeddings
+    :param removed_rows: Rows of listings that should never be returned (e.g. tombstoned in the store)
+    :param index_type: 'exact', 'ivf', 'cascade', or one of the compressed index types in quantization.CODECS
+    :param index_file: File with a saved IVF index. The index is built (and saved) if the file does not exist or
+    was built from other listing embeddings.
+    :param min_listings: Catalogs with fewer listings than this use exact search
+    :return: SimilaritySearch, IVFIndex, QuantizedSearch or CascadeSearch
+    """
+    import quantization
+    import cascade_search
+
+    if index_type == 'exact' or len(listing_embeddings) < min_listings:
+        return SimilaritySearch(listing_embeddings, removed_rows=removed_rows)
+    if index_type in quantization.CODECS:
+        return quantization.QuantizedSearch(listing_embeddings, index_type, removed_rows=removed_rows)
+    if index_type == 'cascade':
+        return cascade_search.CascadeSearch(listing_embeddings, removed_rows=removed_rows)
+    if index_type != 'ivf':
+        raise ValueError("Unknown search index type %s" % index_type)
+    if os.path.exists(index_file):
+        try:
+            return IVFIndex.load(index_file, listing_embeddings, removed_rows=removed_rows)
+        except ValueError as e:
+            print('%s Rebuilding it.' % e)
+    index = IVFIndex.build(listing_embeddings)
+    index.save(index_file)
+    index.remove(removed_rows if removed_rows is not None else [])
+    return index
+
+
+def recall_at_k(approximate_results, exact_results, k):
+    """
+    Returns the average fraction of the exact top-k listings that the approximate search also returned
+    :param approximate_results: List of (listing indices, similarities) tuples from the approximate search
+    :param exact_results: List of (listing indices, similarities) tuples from the exact search
+    :param k: Number of neighbours compared
+    :return: recall@k between 0 and 1
+    """
+    recalls = [len(np.intersect1d(approx[0][:k], exact[0][:k])) / max(1, min(k, len(exact[0])))
+               for approx, exact in zip(approximate_results, exact_results)]
+    return float(np.mean(recalls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the IVF listing index and report recall@k vs brute force.')
+    parser.add_argument('--store', type=str, default=config.EMBEDDING_STORE, help='embedding store directory')
+    parser.add_argument('--index_file', type=str, default=config.ANN_INDEX_FILE, help='output index file')
+    parser.add_argument('--n_lists', type=int, default=None, help='number of clusters (default sqrt(N))')
+    parser.add_argument('--n_probe', type=int, nargs='+', default=[config.ANN_N_PROBE],
+                        help='number of clusters to probe; the first value is saved as the default')
+    parser.add_argument('--k', type=int, default=10, help='k for recall@k')
+    parser.add_argument('--num_queries', type=int, default=200, help='number of listings used as queries')
+    args = parser.parse_args()
+
+    listing_embeddings = embedding_store.open_store(args.store).features('home_feature')
+    start = time.time()
+    index = IVFIndex.build(listing_embeddings, n_lists=args.n_lists, n_probe=args.n_probe[0])
+    print("Built IVF index with %d lists over %d listings in %.2f s" % (index.n_lists, len(index),
+                                                                        time.time() - start))
+    index.save(args.index_file)
+    print("Saved index to %s" % args.index_file)
+
+    rng = np.random.RandomState(13)
+    queries = np.asarray(listing_embeddings)[rng.choice(len(index), min(args.num_queries, len(index)),
+                                                        replace=False)]
+    exact = SimilaritySearch(listing_embeddings)
+    start = time.time()
+    exact_results = exact.search_batch(queries, k=args.k)
+    exact_ms = 1000 * (time.time() - start) / len(queries)
+    print("exact:       %.3f ms/query" % exact_ms)
+    for n_probe in args.n_probe:
+        start = time.time()
+        approximate_results = index.search_batch(queries, k=args.k, n_probe=n_probe)
+        ivf_ms = 1000 * (time.time() - start) / len(queries)
+        print("n_probe=%-4d %.3f ms/query, recall@%d = %.3f" % (n_probe, ivf_ms, args.k,
+                                                              recall_at_k(approximate_results, exact_results,
+                                                                          args.k)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Benchmark harness for the HomeSpotter query path and catalog build.
+
+Runs against the bundled test images (the test split, used as uploads) and house listings (config.LISTINGS_PATH)
+and reports
+- p50/p95/p99 latency of every stage of the query path: decode, resize, predict, search, query_result, stats,
+  histogram, render. The stages run the same functions as home_spotter.py: the search index from
+  ann_index.build_search_index() (config.SEARCH_INDEX), QueryResult statistics, the cached price histogram and one
+  page of thumbnails rendered as a ListingGrid
+- model throughput at several batch sizes, and at several levels of concurrency through the micro-batcher
+- catalog build speed (images/sec for preprocessing + embedding the listings)
+- peak RSS of the process
+
+Results are written as JSON so that runs from different commits can be compared.
+
+Usage (from the visual_home_finder directory):
+    python benchmark.py --output bench.json
+    python benchmark.py --skip_model   # only the stages that do not need the Keras model
+"""
+
+import io
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import resource
+import subprocess
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import dataset_manifest
+import preprocessing
+import embedding_builder
+import query_result
+import metadata_index
+from embedding_cache import LRUCache
+
+
+class StageTimer:
+    """
+    Collects durations per named stage
+    """
+
+    def __init__(self):
+        self.durations = collections.defaultdict(list)
+
+    def time(self, stage, function, *args, **kwargs):
+        """
+        Calls function(*args, **kwargs), records how long it took under stage and returns its result
+        """
+        starting_time = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.durations[stage].append(time.perf_counter() - starting_time)
+        return result
+
+    def summary(self):
+        """
+        :return: Dictionary of stage -> {count, mean/p50/p95/p99 latency in ms}
+        """
+        summary = {}
+        for stage, durations in self.durations.items():
+            durations_ms = 1000 * np.asarray(durations)
+            summary[stage] = {'count': len(durations_ms),
+                              'mean_ms': float(durations_ms.mean()),
+                              'p50_ms': float(np.percentile(durations_ms, 50)),
+                              'p95_ms': float(np.percentile(durations_ms, 95)),
+                              'p99_ms': float(np.percentile(durations_ms, 99))}
+        return summary
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if platform.system() == 'Darwin' else peak / 1024.0
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_catalog_build(feature_model, listing_ids, batch_size=32, workers=4):
+    """
+    Embeds all listings the same way embedding_builder.py does (without writing a store)
+    :return: Tuple of (embeddings, listing IDs that were embedded, result dictionary)
+    """
+    embeddings, embedded_ids = [], []
+    starting_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_ids, batch in embedding_builder.iter_image_batches(listing_ids, batch_size, executor):
+            if feature_model is not None:
+                embeddings.append(np.asarray(feature_model.predict_on_batch(batch)))
+            embedded_ids.extend(batch_ids)
+    elapsed = time.perf_counter() - starting_time
+    result = {'images': len(embedded_ids), 'seconds': elapsed, 'images_per_sec': len(embedded_ids) / elapsed,
+              'batch_size': batch_size, 'workers': workers, 'includes_predict': feature_model is not None}
+    return (np.concatenate(embeddings) if embeddings else None), embedded_ids, result
+
+
+def benchmark_query_path(upload_files, feature_model, search_index, listings_df, timer, threshold):
+    """
+    Runs every upload through the stages of home_spotter.show_similar_listings(), timing each stage
+    """
+    run_model_stages = feature_model is not None and search_index is not None
+    if run_model_stages:
+        import matplotlib
+        matplotlib.use('Agg')
+        import thumbnails
+        import streamlit_utilities as str_util
+
+        # Built once per store version in the app, so not timed
+        bin_edges = query_result.price_bin_edges(listings_df)
+        listing_details = str_util.listing_details_html(listings_df)
+        thumbnail_cache = thumbnails.ThumbnailCache()
+        histograms = LRUCache(max_entries=config.QUERY_RESULT_CACHE_ENTRIES, size_of=len)
+        listing_grid = str_util.ListingGrid(color=str_util.COLOR, background_color=str_util.BACKGROUND_COLOR)
+
+    for upload_file in upload_files:
+        with open(upload_file, 'rb') as f:
+            upload = io.BytesIO(f.read())
+        image_pil = timer.time('decode', lambda: preprocessing.open_image(upload).convert('RGB'))
+        batch = preprocessing.allocate_batch(1)
+
+        def resize():
+            preprocessing.image_into(image_pil, batch[0])
+            preprocessing.normalize(batch)
+        timer.time('resize', resize)
+        if not run_model_stages:
+            continue
+        embedding = timer.time('predict', feature_model.predict_on_batch, batch)
+        # The app searches once per upload at threshold 0, and the slider only looks up the prefix statistics
+        rows, similarities = timer.time('search', metadata_index.filtered_search, search_index, np.ravel(embedding),
+                                        None, threshold=0.0)
+        result = timer.time('query_result', query_result.QueryResult, rows, similarities, listings_df, bin_edges)
+        timer.time('stats', result.stats, threshold)
+
+        def draw_histogram():
+            counts, edges = result.price_histogram(threshold)
+            key = counts.tobytes() + edges.tobytes()
+            if histograms.get(key) is None:
+                histograms.put(key, query_result.draw_price_histogram(counts, edges))
+        timer.time('histogram', draw_histogram)
+
+        def render():
+            page_rows, page_similarities = result.top(threshold)
+            not_same_home = np.abs(page_similarities - 1.0) > config.SAME_HOME_TOLERANCE
+            page_rows = page_rows[not_same_home][:config.RESULTS_PAGE_SIZE]
+            page_similarities = page_similarities[not_same_home][:config.RESULTS_PAGE_SIZE]
+            thumbnail_cache.refresh()
+            return listing_grid.style() + listing_grid.html(
+                [thumbnail_cache.src(listing_id) for listing_id in listings_df.index[page_rows]],
+                listing_details[page_rows], page_similarities)
+        timer.time('render', render)
+
+
+def benchmark_batch_throughput(feature_model, batch_sizes, repeats=5):
+    results = {}
+    for batch_size in batch_sizes:
+        batch = np.zeros((batch_size, config.IMAGE_SIZE, config.IMAGE_SIZE, 3), dtype=np.float32)
+        feature_model.predict_on_batch(batch)  # Warm up
+        starting_time = time.perf_counter()
+        for _ in range(repeats):
+            feature_model.predict_on_batch(batch)
+        results[str(batch_size)] = batch_size * repeats / (time.perf_counter() - starting_time)
+    return results
+
+
+def benchmark_concurrency(feature_model, concurrency_levels, requests_per_level=64, max_batch_size=32):
+    """
+    Measures images/sec when several clients send single images at the same time through the micro-batcher
+    """
+    from inference_server import MicroBatcher
+
+    batcher = MicroBatcher(feature_model.predict_on_batch, max_batch_size=max_batch_size)
+    image_array = np.zeros((config.IMAGE_SIZE, config.IMAGE_SIZE, 3), dtype=np.float32)
+    results = {}
+    for concurrency in concurrency_levels:
+        starting_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(lambda _: batcher.embed(image_array), range(requests_per_level)))
+        results[str(concurrency)] = requests_per_level / (time.perf_counter() - starting_time)
+    return results
+
+
+def run(num_uploads=50, threshold=config.SIMILARITY_DEFAULT, batch_sizes=(1, 8, 32), concurrency_levels=(1, 4, 16),
+        workers=4, skip_model=False, backend=config.FEATURE_BACKEND):
+    """
+    Runs all the benchmarks
+    :return: Dictionary of results
+    """
+    import model_registry
+    import ann_index
+
+    results = {'commit': git_commit(), 'timestamp': time.time(), 'platform': platform.platform(),
+               'threshold': threshold, 'backend': backend, 'search_index': config.SEARCH_INDEX}
+    feature_model = None
+    if not skip_model:
+        starting_time = time.perf_counter()
+        feature_model = model_registry.get_feature_model(backend)
+        results['model_load_seconds'] = time.perf_counter() - starting_time
+
+    listings_df = embedding_builder.read_listing_csvs()
+    embeddings, embedded_ids, results['catalog_build'] = benchmark_catalog_build(
+        feature_model, list(listings_df.index), workers=workers)
+    listings_df = listings_df.loc[embedded_ids]
+    search_index = None
+    if embeddings is not None:
+        # A saved IVF index goes to a temporary directory, so the app's index file is left alone
+        index_path = tempfile.mkdtemp()
+        starting_time = time.perf_counter()
+        search_index = ann_index.build_search_index(embeddings, index_file=os.path.join(index_path, 'ivf.npz'))
+        results['index_build_seconds'] = time.perf_counter() - starting_time
+        shutil.rmtree(index_path, ignore_errors=True)
+
+    timer = StageTimer()
+    upload_files = dataset_manifest.split_image_paths('test')[:num_uploads]
+    benchmark_query_path(upload_files, feature_model, search_index, listings_df, timer, threshold)
+    results['query_stages'] = timer.summary()
+
+    if feature_model is not None:
+        results['batch_throughput_images_per_sec'] = benchmark_batch_throughput(feature_model, batch_sizes)
+        results['concurrency_images_per_sec'] = benchmark_concurrency(feature_model, concurrency_levels)
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the HomeSpotter query path and catalog build.')
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--num_uploads', type=int, default=50, help='number of test images used as uploads')
+    parser.add_argument('--threshold', type=float, default=config.SIMILARITY_DEFAULT, help='similarity threshold')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32], help='batch sizes to measure')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='concurrent clients')
+    parser.add_argument('--workers', type=int, default=4, help='number of image decoding threads')
+    parser.add_argument('--skip_model', action='store_true', help='skip the stages that need the Keras model')
+    parser.add_argument('--backend', type=str, default=config.FEATURE_BACKEND,
+                        help="feature model backend, 'keras' or one exported with inference_backends.py")
+    args = parser.parse_args()
+
+    results = run(args.num_uploads, args.threshold, args.batch_sizes, args.concurrency, args.workers,
+                  args.skip_model, args.backend)
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Cached bottleneck features for training the classifier head on a frozen ResNet50.
+
+All ResNet50 layers are frozen while the head (AveragePooling -> Dense(512) -> Dropout -> Dense(classes)) trains, so
+the backbone output of an image never changes. Here the backbone is run once per image, optionally once per fixed
+augmentation variant, and its activations are saved to memory-mapped .npy files: either the pooled 2048-d vectors
+(the head starts with a 7x7 average pool, so this is exact) or the full 7x7x2048 maps. Head training and
+hyper-parameter sweeps then run on the cached tensors.
+
+Usage (from the visual_home_finder directory), after packing the splits with image_shards.py:
+    python bottleneck_cache.py --variants 4
+    python bottleneck_cache.py --learning_rates 0.001 0.0003 --dropouts 0.3 0.5 --epochs 50
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+import config
+import image_shards
+
+
+def backbone_model(pooled=True):
+    """
+    Returns the frozen ImageNet ResNet50 backbone of the classifier
+    :param pooled: If True, the 7x7x2048 output is average-pooled to 2048 values
+    """
+    from tensorflow.keras.applications import ResNet50
+    from tensorflow.keras.layers import GlobalAveragePooling2D
+    from tensorflow.keras.models import Model
+
+    resnet_model = ResNet50(weights='imagenet', include_top=False,
+                            input_shape=(config.IMAGE_SIZE, config.IMAGE_SIZE, 3))
+    if not pooled:
+        return resnet_model
+    return Model(inputs=resnet_model.input, outputs=GlobalAveragePooling2D()(resnet_model.output))
+
+
+def head_model(pooled=True, hidden_units=512, dropout=0.5, num_classes=len(config.CLASSES)):
+    """
+    Returns the classifier head, taking cached bottleneck features as input
+    :param pooled: If True, the input is pooled 2048-d features, else 7x7x2048 maps
+    :param hidden_units: Size of the hidden dense layer
+    :param dropout: Dropout rate after the hidden layer
+    :param num_classes: Number of home-styles
+    """
+    from tensorflow.keras.layers import Input, Dense, AveragePooling2D, Dropout, Flatten
+    from tensorflow.keras.models import Model
+
+    inputs = Input(shape=(2048,) if pooled else (7, 7, 2048))
+    outputs = inputs
+    if not pooled:
+        outputs = Flatten(name='flatten')(AveragePooling2D(pool_size=(7, 7))(outputs))
+    outputs = Dense(hidden_units, activation='relu')(outputs)
+    outputs = Dropout(dropout)(outputs)
+    outputs = Dense(num_classes, activation='softmax')(outputs)
+    return Model(inputs=inputs, outputs=outputs)
+
+
+def bottleneck_files(split, variant, pooled, cache_path=config.BOTTLENECK_PATH):
+    name = '%s_%s_v%d' % (split, 'pooled' if pooled else 'conv', variant)
+    return os.path.sep.join([cache_path, name + '.npy']), os.path.sep.join([cache_path, name + '.json'])
+
+
+def cache_bottlenecks(split, variants=0, pooled=True, batch_size=64, dtype=np.float32,
+                      cache_path=config.BOTTLENECK_PATH, shard_path=config.SHARD_PATH):
+    """
+    Runs the backbone over a packed split and saves its activations. Variant 0 is the plain images, variants 1 and up
+    are augmented with a fixed seed each. Variants that are up to date are skipped.
+    :param split: One of dataset_manifest.SPLITS
+    :param variants: Number of augmented variants per image (in addition to the plain images)
+    :param pooled: If True, cache pooled 2048-d features, else 7x7x2048 maps
+    :param batch_size: Number of images per forward pass
+    :param dtype: np.float32, or np.float16 to halve the size of the cache (e.g. for 7x7x2048 maps)
+    :param cache_path: Directory to write the cache to
+    :param shard_path: Directory with the packed image shards
+    :return: Number of variants computed
+    """
+    import tensorflow as tf
+
+    shard = image_shards.ImageShard(split, shard_path)
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    backbone = None
+    computed = 0
+    for variant in range(variants + 1):
+        feature_file, header_file = bottleneck_files(split, variant, pooled, cache_path)
+        header = {'shard': shard.header['hashes'], 'dtype': np.dtype(dtype).name, 'variant': variant}
+        if os.path.exists(header_file):
+            with open(header_file) as f:
+                if json.load(f) == header:
+                    continue
+        if backbone is None:
+            backbone = backbone_model(pooled)
+        features = np.lib.format.open_memmap(feature_file + '.tmp', mode='w+', dtype=dtype,
+                                             shape=(len(shard),) + tuple(backbone.output_shape[1:]))
+        for start in range(0, len(shard), batch_size):
+            images = tf.cast(shard.images[start:start + batch_size], tf.float32)
+            if variant > 0:
+                images = image_shards.augment_batch(images, seed=variant)
+            features[start:start + batch_size] = backbone.predict_on_batch(images - config.IMG_MEAN)
+        features.flush()
+        del features
+        os.replace(feature_file + '.tmp', feature_file)
+        with open(header_file, 'w') as f:
+            json.dump(header, f)
+        computed += 1
+    return computed
+
+
+def load_bottlenecks(split, variants=0, pooled=True, cache_path=config.BOTTLENECK_PATH,
+                     shard_path=config.SHARD_PATH):
+    """
+    :param split: One of dataset_manifest.SPLITS
+    :param variants: Number of augmented variants to use (in addition to the plain images)
+    :param pooled: If True, load pooled features, else 7x7x2048 maps
+    :param cache_path: Directory with the cache
+    :param shard_path: Directory with the packed image shards (for the labels)
+    :return: Tuple of (list of memory-mapped feature arrays, one per variant, one-hot labels)
+    """
+    shard = image_shards.ImageShard(split, shard_path)
+    features = [np.load(bottleneck_files(split, variant, pooled, cache_path)[0], mmap_mode='r')
+                for variant in range(variants + 1)]
+    return features, np.eye(len(shard.classes), dtype=np.float32)[shard.labels]
+
+
+def train_head(train_features, train_labels, val_features, val_labels, pooled=True, hidden_units=512, dropout=0.5,
+               learning_rate=0.001, epochs=50, batch_size=32):
+    """
+    Trains a classifier head on cached bottleneck features. Every epoch uses one of the cached variants of each
+    image in turn, so augmented variants act like on-the-fly augmentation.
+    :return: Tuple of (trained head, history dictionary)
+    """
+    from tensorflow.keras.optimizers import Adam
+
+    head = head_model(pooled, hidden_units, dropout, num_classes=train_labels.shape[1])
+    head.compile(loss='categorical_crossentropy', optimizer=Adam(learning_rate), metrics=['accuracy'])
+    val_features = np.asarray(val_features[0])
+    history = {}
+    for epoch in range(epochs):
+        epoch_history = head.fit(train_features[epoch % len(train_features)], train_labels,
+                                 validation_data=(val_features, val_labels), batch_size=batch_size,
+                                 shuffle=True, verbose=0).history
+        for name, values in epoch_history.items():
+            history.setdefault(name, []).extend(values)
+    return head, history
+
+
+def full_model(head, pooled=True):
+    """
+    Puts a head trained on cached features back on the backbone, giving a model that classifies images
+    """
+    from tensorflow.keras.models import Model
+
+    backbone = backbone_model(pooled)
+    for layer in backbone.layers:
+        layer.trainable = False
+    return Model(inputs=backbone.input, outputs=head(backbone.output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cache ResNet50 bottleneck features and train classifier heads.')
+    parser.add_argument('--variants', type=int, default=0, help='number of augmented variants per training image')
+    parser.add_argument('--conv', action='store_true', help='cache 7x7x2048 maps instead of pooled features')
+    parser.add_argument('--float16', action='store_true', help='store the cached features as float16')
+    parser.add_argument('--learning_rates', type=float, nargs='*', default=[], help='learning rates to sweep')
+    parser.add_argument('--dropouts', type=float, nargs='+', default=[0.5], help='dropout rates to sweep')
+    parser.add_argument('--epochs', type=int, default=50, help='number of epochs per head')
+    args = parser.parse_args()
+
+    pooled = not args.conv
+    dtype = np.float16 if args.float16 else np.float32
+    for split, variants in (('training', args.variants), ('validation', 0)):
+        starting_time = time.time()
+        computed = cache_bottlenecks(split, variants, pooled, dtype=dtype)
+        print("'%s': computed %d of %d variants in %.1f s" % (split, computed, variants + 1,
+                                                             time.time() - starting_time))
+
+    if not args.learning_rates:
+        return
+    train_features, train_labels = load_bottlenecks('training', args.variants, pooled)
+    val_features, val_labels = load_bottlenecks('validation', 0, pooled)
+    for learning_rate in args.learning_rates:
+        for dropout in args.dropouts:
+            starting_time = time.time()
+            _, history = train_head(train_features, train_labels, val_features, val_labels, pooled,
+                                    dropout=dropout, learning_rate=learning_rate, epochs=args.epochs)
+            print("learning_rate=%g dropout=%.2f: val_accuracy=%.3f (best %.3f), %.2f s/epoch"
+                  % (learning_rate, dropout, history['val_accuracy'][-1], max(history['val_accuracy']),
+                     (time.time() - starting_time) / args.epochs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Two-stage similarity search: PCA-reduced candidate generation followed by an exact re-rank.
+
+A PCA is fitted on the (normalized) listing embeddings of the catalog. The first stage scores every listing on its
+low-dimensional projection, which reads n_components instead of the full number of floats per listing. The second
+stage re-ranks the candidates with the full embeddings: dense_4, or dense_4 and the ResNet features concatenated.
+Searches with k re-rank a shortlist of the best max(k, shortlist) candidates; searches with only a threshold re-rank
+every listing whose first-stage score is within CASCADE_MARGIN of the threshold, so they return every listing above
+the threshold like exact search does. search_rows() only scores the given rows (e.g. the listings that pass the
+metadata filters) in both stages.
+
+With projection P and catalog mean m, the cosine similarity q.x of unit vectors is
+    q.x = (q - m).(x - m) + m.x + q.m - m.m ~= P(q - m).P(x - m) + m.x + (terms that are the same for every listing)
+so the first stage keeps m.x per listing and ranks by P(q - m).P(x - m) + m.x.
+
+Usage (from the visual_home_finder directory) to report speedup and recall@k against exact search:
+    python cascade_search.py --n_components 8 16 32 --features home_feature resnet_feature
+"""
+
+import time
+import argparse
+import numpy as np
+
+import config
+import embedding_store
+from search import SimilaritySearch, normalize_rows, top_indices
+
+# Number of candidates read from the full embeddings at a time in the second stage
+RERANK_CHUNK = 4096
+
+
+def concatenate_features(feature_matrices):
+    """
+    Normalizes each feature matrix and concatenates them, so that every feature counts equally in the similarity
+    :param feature_matrices: List of (N x dim) arrays, e.g. the home_feature and resnet_feature matrices
+    :return: (N x total dim) float32 array with unit-norm rows
+    """
+    return normalize_rows(np.hstack([normalize_rows(matrix) for matrix in feature_matrices]))
+
+
+class CascadeSearch:
+    """
+    Cosine-similarity search that generates candidates on PCA-reduced embeddings and re-ranks them exactly.
+    Has the same search interface as SimilaritySearch.
+    """
+
+    def __init__(self, listing_embeddings, n_components=config.CASCADE_PCA_COMPONENTS,
+                 shortlist=config.CASCADE_SHORTLIST, removed_rows=None, pca=None):
+        """
+        :param listing_embeddings: (N x dim) array of listing embeddings. Only the shortlisted rows are read from
+        it when searching, so it can be a memory-map of the embedding store.
+        :param n_components: Dimension of the PCA projection used for the first stage
+        :param shortlist: Number of candidates re-ranked with the full embeddings when searching for the k best
+        listings (at least k are re-ranked)
+        :param removed_rows: Rows of listings that should never be returned (e.g. tombstoned in the store)
+        :param pca: Fitted sklearn PCA to use instead of fitting one on the listings
+        """
+        from sklearn.decomposition import PCA
+
+        self.full_embeddings = listing_embeddings
+        self.shortlist = shortlist
+        embeddings = normalize_rows(listing_embeddings)
+        if pca is None:
+            pca = PCA(n_components=min(n_components, *embeddings.shape), svd_solver='randomized',
+                      random_state=13).fit(embeddings)
+        self.pca = pca
+        # Project queries with plain numpy, which is much quicker than pca.transform() for a single query
+        self.mean = pca.mean_.astype(np.float32)
+        self.components = np.ascontiguousarray(pca.components_.T, dtype=np.float32)
+        self.reduced = self._project(embeddings)
+        self.bias = embeddings @ self.mean
+        self.removed = np.zeros(len(embeddings), dtype=bool)
+        if removed_rows is not None:
+            self.removed[removed_rows] = True
+
+    def _project(self, embeddings):
+        return np.ascontiguousarray((embeddings - self.mean) @ self.components)
+
+    def __len__(self):
+        return len(self.reduced)
+
+    @property
+    def n_components(self):
+        return self.components.shape[1]
+
+    def add(self, listing_embeddings, full_embeddings=None):
+        """
+        Appends listings, projected with the existing PCA
+        :param listing_embeddings: (number of new listings x embedding size) array of listing embeddings
+        :param full_embeddings: All listing embeddings including the new ones, e.g. the memory-map of the refreshed
+        store. If None, the new embeddings are appended to an in-memory copy.
+        """
+        new_embeddings = normalize_rows(listing_embeddings)
+        self.reduced = np.concatenate([self.reduced, self._project(new_embeddings)])
+        self.bias = np.concatenate([self.bias, new_embeddings @ self.mean])
+        self.removed = np.concatenate([self.removed, np.zeros(len(new_embeddings), dtype=bool)])
+        if full_embeddings is None:
+            full_embeddings = np.concatenate([self.full_embeddings, listing_embeddings])
+        self.full_embeddings = full_embeddings
+
+    def remove(self, rows):
+        self.removed[rows] = True
+
+    def search(self, query_embedding, threshold=None, k=None):
+        """
+        Finds the listings most similar to a single query
+        :param query_embedding: Embedding of the query image
+        :param threshold: If given, only listings with a similarity above the threshold are returned
+        :param k: If given, at most k listings are returned
+        :return: Tuple of (listing indices, similarities), sorted from most to least similar
+        """
+        return self.search_batch(query_embedding, threshold=threshold, k=k)[0]
+
+    def search_rows(self, query_embedding, rows, threshold=None, k=None):
+        """
+        Finds the listings most similar to a single query, only scoring the given rows (e.g. the listings that
+        pass the metadata filters)
+        :param query_embedding: Embedding of the query image
+        :param rows: Rows of the listings to score
+        :param threshold: If given, only listings with a similarity above the threshold are returned
+        :param k: If given, at most k listings are returned
+        :return: Tuple of (listing indices, similarities), sorted from most to least similar
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        query = normalize_rows(query_embedding)
+        scores = self.reduced[rows] @ self._project(query)[0] + self.bias[rows]
+        scores += query[0] @ self.mean - self.mean @ self.mean
+        return self._rerank(query[0], rows, scores, threshold, k)
+
+    def _rerank(self, query, rows, scores, threshold, k):
+        scores[self.removed[rows]] = -np.inf
+        # The projection loses a little of the similarity, so keep candidates slightly below the threshold. Without k
+        # every such candidate is re-ranked, so that no listing above the threshold is missed.
+        candidates = top_indices(scores, threshold=-np.inf if threshold is None else threshold - config.CASCADE_MARGIN,
+                                 k=None if k is None else max(k, self.shortlist))
+        candidate_rows = np.sort(rows[candidates])
+        # Second stage: exact similarities of the candidates, read in chunks so that a long candidate list never
+        # holds a large normalized copy
+        exact_scores = np.concatenate(
+            [normalize_rows(self.full_embeddings[candidate_rows[start:start + RERANK_CHUNK]]) @ query
+             for start in range(0, len(candidate_rows), RERANK_CHUNK)] or [np.zeros(0, dtype=np.float32)])
+        selected = top_indices(exact_scores, threshold=threshold, k=k)
+        return candidate_rows[selected], exact_scores[selected]
+
+    def search_batch(self, query_embeddings, threshold=None, k=None):
+        """
+        Finds the listings most similar to each of a batch of queries
+        :param query_embeddings: (number of queries x embedding size) array of query embeddings
+        :param threshold: If given, only listings with a similarity above the threshold are returned
+        :param k: If given, at most k listings are returned per query
+        :return: List with one (listing indices, similarities) tuple per query
+        """
+        queries = normalize_rows(query_embeddings)
+        # First stage: approximate similarities of every listing, up to a constant per query
+        query_constants = queries @ self.mean - self.mean @ self.mean
+        approximate_scores = self._project(queries) @ self.reduced.T + self.bias
+        all_rows = np.arange(len(self.reduced))
+        return [self._rerank(query, all_rows, scores + constant, threshold, k)
+                for query, scores, constant in zip(queries, approximate_scores, query_constants)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report speedup and recall@k of the two-stage PCA search.')
+    parser.add_argument('--store', type=str, default=config.EMBEDDING_STORE, help='embedding store directory')
+    parser.add_argument('--features', type=str, nargs='+', default=['home_feature'],
+                        help='features to search on; several features are concatenated')
+    parser.add_argument('--n_components', type=int, nargs='+', default=[config.CASCADE_PCA_COMPONENTS],
+                        help='PCA dimensions to compare')
+    parser.add_argument('--shortlist', type=int, default=config.CASCADE_SHORTLIST,
+                        help='number of candidates re-ranked with the full embeddings')
+    parser.add_argument('--k', type=int, default=10, help='k for recall@k')
+    parser.add_argument('--num_queries', type=int, default=200, help='number of listings used as queries')
+    args = parser.parse_args()
+
+    from ann_index import recall_at_k
+
+    store = embedding_store.open_store(args.store)
+    if len(args.features) == 1:
+        listing_embeddings = store.features(args.features[0])
+    else:
+        listing_embeddings = concatenate_features([store.features(name) for name in args.features])
+    rng = np.random.RandomState(13)
+    queries = np.asarray(listing_embeddings)[rng.choice(len(listing_embeddings),
+                                                        min(args.num_queries, len(listing_embeddings)),
+                                                        replace=False)]
+
+    exact = SimilaritySearch(listing_embeddings)
+    start = time.time()
+    exact_results = [exact.search(query, k=args.k) for query in queries]
+    exact_ms = 1000 * (time.time() - start) / len(queries)
+    print("exact (%d dims): %.3f ms/query" % (exact.embeddings.shape[1], exact_ms))
+    for n_components in args.n_components:
+        index = CascadeSearch(listing_embeddings, n_components=n_components, shortlist=max(args.shortlist, args.k))
+        start = time.time()
+        results = [index.search(query, k=args.k) for query in queries]
+        cascade_ms = 1000 * (time.time() - start) / len(queries)
+        # Floats read per query: every reduced vector plus the full vectors of the shortlist
+        flops_ratio = (index.n_components * len(index) + index.shortlist * exact.embeddings.shape[1]) / \
+            float(exact.embeddings.size)
+        print("n_components=%-4d %.3f ms/query (%.1fx speedup, %.2f of the FLOPs), recall@%d = %.3f"
+              % (index.n_components, cascade_ms, exact_ms / cascade_ms, flops_ratio, args.k,
+                 recall_at_k(results, exact_results, args.k)))
+
+
+if __name__ == "__main__":
+    main()
@@ -18,12 +18,31 @@ TRAIN_PATH = os.path.sep.join([BASE_PATH, "training"])
 VAL_PATH = os.path.sep.join([BASE_PATH, "validation"])
 TEST_PATH = os.path.sep.join([BASE_PATH, "test"])
 
+# Manifests (path, label, hash, size of every image) of the training/ validation and test splits
+MANIFEST_PATH = os.path.sep.join([BASE_PATH, "manifests"])
+TRAIN_MANIFEST = os.path.sep.join([MANIFEST_PATH, "training.csv"])
+VAL_MANIFEST = os.path.sep.join([MANIFEST_PATH, "validation.csv"])
+TEST_MANIFEST = os.path.sep.join([MANIFEST_PATH, "test.csv"])
+
+# Directory with the splits packed as memory-mappable uint8 image shards (see image_shards.py)
+SHARD_PATH = os.path.sep.join([BASE_PATH, "shards"])
+
+# Directory with cached ResNet50 bottleneck features of the splits, for training the classifier head
+BOTTLENECK_PATH = os.path.sep.join([BASE_PATH, "bottlenecks"])
+
+# Index (CSV) of the test images that the classifier gets wrong, written by evaluation.py
+MISCLASSIFIED_FILE = os.path.sep.join([BASE_PATH, "misclassified_test.csv"])
+
 # PATH to save model
 MODEL_PATH = '../visual_home_finder'
 
 # PATH to house listings
 LISTINGS_PATH = '../data/raw/house_listings'
 
+# CSV files with the house listings (downloaded from redfin)
+LISTING_CSVS = [os.path.sep.join([LISTINGS_PATH, 'Zip_%s.csv' % zip_code])
+                for zip_code in ['98105', '98115', '98117', '98107', '98103']]
+
 # PATH to save home features
 FEATURE_PATH = os.path.sep.join([BASE_PATH, "home_features"])
 
@@ -41,6 +60,19 @@ CLASSES = ['craftsman', 'modern', 'ranch', 'tudor', 'victorian']
 #MODEL_NAME = 'eighth_model_50epochs_5classes.h5'
 MODEL_NAME = 'sixth_model_50epochs_5classes_redo.h5'
 
+# Trimmed model that only contains the layers up to dense_4 (see model_registry.py). Much quicker to load.
+FEATURE_MODEL_FILE = os.path.sep.join([MODEL_PATH, 'feature_' + MODEL_NAME])
+
+# Backend that runs the feature model: 'keras', or a model exported with inference_backends.py ('graph',
+# 'tflite_float32', 'tflite_float16' or 'tflite_int8'). Exported models are written to FEATURE_EXPORT_PATH.
+FEATURE_BACKEND = 'keras'
+FEATURE_EXPORT_PATH = os.path.sep.join([MODEL_PATH, 'feature_export'])
+
+# Number of validation images used to calibrate int8 quantization, and number of CPU threads of the TFLite
+# interpreter (None for TensorFlow's default)
+CALIBRATION_IMAGES = 200
+TFLITE_NUM_THREADS = None
+
 # Mean and STD of all the training images
 IMG_MEAN = np.array([123.526794, 129.04448, 119.95359], dtype=np.float32).reshape((1, 1, 3))
 IMG_STD = 62  # np.array([62.082836, 61.87381, 73.08175], dtype=np.float32).reshape((1,1,3))
@@ -48,6 +80,25 @@ IMG_STD = 62  # np.array([62.082836, 61.87381, 73.08175], dtype=np.float32).resh
 # Name of CSV file with house-listing embeddings
 FEATURE_FILE = os.path.sep.join([FEATURE_PATH, "home_features_model_6.csv"])
 
+# Directory of the binary embedding store (memory-mappable matrices + listing metadata) built from FEATURE_FILE
+EMBEDDING_STORE = os.path.sep.join([FEATURE_PATH, "home_features_model_6"])
+
+# Manifest of the listings in the embedding store (image hash, model name and row), used for incremental re-indexing
+INDEX_MANIFEST = os.path.sep.join([FEATURE_PATH, "home_features_model_6_manifest.json"])
+
+# Type of index used for the similarity search: 'exact' (brute force), 'ivf' (approximate, for large catalogs) or a
+# compressed index ('float16', 'int8' or 'pq') or the two-stage PCA search ('cascade')
+SEARCH_INDEX = 'exact'
+
+# File with the IVF (approximate nearest-neighbour) index built over the home features
+ANN_INDEX_FILE = os.path.sep.join([FEATURE_PATH, "home_features_model_6_ivf.npz"])
+
+# Number of IVF clusters scored per query. Higher values give better recall but slower queries.
+ANN_N_PROBE = 8
+
+# Catalogs with fewer listings than this always use exact search
+ANN_MIN_LISTINGS = 5000
+
 # Name of the pickle file with PCA model
 PCA_MODEL = os.path.sep.join([MODEL_PATH, "home_pca.sav"])
 
@@ -60,7 +111,94 @@ CLUSTER_PLT = os.path.sep.join([MODEL_PATH, "home_clusters_plt.sav"])
 # Name of the pickle containing features dataframe of all homes for TSNE
 ALL_FEATURES_DF = os.path.sep.join([MODEL_PATH, "home_features_np.sav"])
 
+# Size (in degrees of latitude/longitude) of the grid cells used to find the listings in a map area
+GEO_GRID_DEGREES = 0.005
+
+# Filtered searches only score the listings that pass the filters if they are at most this share of the catalog,
+# otherwise all listings are scored and the results are filtered
+PREFILTER_MAX_FRACTION = 0.25
+
+# Compressed search indexes ('float16', 'int8' or 'pq' as SEARCH_INDEX, see quantization.py): number of candidates
+# re-ranked with the float32 embeddings in a search for the k best listings, how far below the similarity threshold
+# candidates are kept, and the number of sub-vectors (bytes per listing) for product quantization
+QUANTIZATION_RERANK = 100
+QUANTIZATION_MARGIN = 0.05
+PQ_SUBSPACES = 16
+
+# Two-stage search ('cascade' as SEARCH_INDEX, see cascade_search.py): dimension of the PCA projection used to
+# generate candidates, number of candidates re-ranked with the full embeddings in a search for the k best listings,
+# and how far below the similarity threshold candidates are kept
+CASCADE_PCA_COMPONENTS = 16
+CASCADE_SHORTLIST = 200
+CASCADE_MARGIN = 0.1
+
 ## Some default values for the web-app
 
+# Default similarity metric of the app (see similarity.py): 'cosine', 'euclidean', 'pearson' or 'spearman'. Only
+# cosine similarity can use the approximate/compressed search indexes, the other metrics always search exactly.
+SIMILARITY_METRIC = 'cosine'
+
 # Default value for the home similarity index: controls the number of listings shown on the page
 SIMILARITY_DEFAULT = 0.75
+
+# Similarity threshold slider of every metric: (minimum, maximum, default, step). The metrics have different scales,
+# e.g. euclidean similarities 1 / (1 + distance) depend on the size of the embeddings. A default of None is computed
+# from the listings (see similarity.typical_threshold()), and a step of None is about a hundredth of the default.
+SIMILARITY_SLIDERS = {
+    'cosine': (0.0, 1.0, SIMILARITY_DEFAULT, 0.01),
+    'pearson': (0.0, 1.0, None, 0.01),
+    'spearman': (0.0, 1.0, None, 0.01),
+    'euclidean': (0.0, 1.0, None, None),
+}
+
+# Results with a similarity this close to 1 are the uploaded home itself and are not listed. Similarities are computed
+# in float32, so a listing's similarity with itself can be off from 1 by about 1e-7.
+SAME_HOME_TOLERANCE = 1e-5
+
+# Maximum number of upload embeddings kept in memory, and their maximum total size in bytes
+EMBEDDING_CACHE_ENTRIES = 4096
+EMBEDDING_CACHE_BYTES = 32 * 1024 * 1024
+
+# Directory for the on-disk tier of the upload embedding cache (None to only cache in memory)
+EMBEDDING_CACHE_PATH = None
+# Maximum number of upload embeddings kept on disk, and the maximum total size of their files in bytes
+EMBEDDING_CACHE_DISK_ENTRIES = 100000
+EMBEDDING_CACHE_DISK_BYTES = 512 * 1024 * 1024
+
+# Maximum number of per-upload query results (and rendered price histograms) kept by the web-app
+QUERY_RESULT_CACHE_ENTRIES = 64
+
+# Directory with the thumbnails of the listing images, and the sizes (in pixels) they are built at
+THUMBNAIL_PATH = os.path.sep.join([FEATURE_PATH, "thumbnails"])
+THUMBNAIL_SIZES = (128, 224, 350)
+THUMBNAIL_QUALITY = 85
+
+# URL the thumbnail directory is served from (e.g. "http://localhost:8502/thumbnails"). If None, thumbnails are
+# inlined in the page from an in-memory cache of at most THUMBNAIL_CACHE_BYTES.
+THUMBNAIL_URL = None
+THUMBNAIL_CACHE_BYTES = 64 * 1024 * 1024
+
+# Number of similar listings shown per results page
+RESULTS_PAGE_SIZE = 20
+
+# Timers and counters of the query path (see instrumentation.py). If METRICS_FILE is set, the app appends a JSON line
+# with the timers and counters of each query after it ran. With instrumentation on, the sidebar also has a box to
+# profile a query.
+INSTRUMENTATION = False
+METRICS_FILE = None
+
+## Settings for the inference server
+
+# Base URL of the inference server. If set, the web-app sends uploads to the server instead of loading the model.
+INFERENCE_SERVER_URL = None
+SERVER_PORT = 8502
+# Maximum number of images per forward pass, and maximum time (in ms) a request waits for a batch to fill up
+SERVER_MAX_BATCH_SIZE = 32
+SERVER_MAX_WAIT_MS = 5
+
+# Number of worker processes running the feature model (see worker_pool.py). 0 runs the model in the app/server
+# process. Every worker uses WORKER_INTRA_OP_THREADS intra-op threads (None for TensorFlow's default) and is pinned to
+# its own block of CPUs if WORKER_CPU_AFFINITY is True.
+WORKER_POOL_SIZE = 0
+WORKER_INTRA_OP_THREADS = None
+WORKER_CPU_AFFINITY = False
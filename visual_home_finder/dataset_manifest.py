@@ -0,0 +1,265 @@
+"""
+Manifest-based training/ validation/ test splits of the home-style images.
+
+Each split is a CSV manifest with one row per image: path (of the original image in config.ORIG_INPUT_DIR), label,
+content hash (SHA-1) and size in bytes. An image keeps the split it already has: the split directories in
+config.BASE_PATH (the splits the shipped models were trained on) come first, then the existing manifests. Only images
+that are in neither are assigned a split from their content hash, so
+- rebuilding the manifests gives the same splits (idempotent), and newly scraped images are added to the splits
+  without moving any existing image between them (incremental)
+- copies of the same picture (the scraper sometimes finds an image more than once) always end up in the same split,
+  so they cannot leak from training in to test
+Hashes are only computed for images that are new or changed size since the last build.
+
+Training and evaluation read the manifests directly (flow_from_manifest(), split_image_paths()). Split directories
+like the old ones in config.BASE_PATH can still be materialized with hard links or symlinks, or copied in parallel.
+"""
+
+import os
+import shutil
+import hashlib
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import paths
+
+MANIFEST_COLUMNS = ['path', 'label', 'hash', 'size']
+
+# Name of each split -> (manifest file, directory the split is materialized in)
+SPLITS = {
+    'training': (config.TRAIN_MANIFEST, config.TRAIN_PATH),
+    'validation': (config.VAL_MANIFEST, config.VAL_PATH),
+    'test': (config.TEST_MANIFEST, config.TEST_PATH),
+}
+
+MATERIALIZE_MODES = ('hardlink', 'symlink', 'copy')
+
+
+def file_hash(file_name):
+    with open(file_name, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def read_manifest(split):
+    """
+    :param split: One of SPLITS
+    :return: Dataframe with MANIFEST_COLUMNS. Empty if the manifest has not been built.
+    """
+    manifest_file = SPLITS[split][0]
+    if not os.path.exists(manifest_file):
+        return pd.DataFrame(columns=MANIFEST_COLUMNS)
+    return pd.read_csv(manifest_file, dtype={'label': str, 'hash': str})
+
+
+def split_dataframe(split):
+    """
+    :param split: One of SPLITS
+    :return: Manifest of the split. Falls back to the images in the split directory (without hashes) if there is no
+    manifest.
+    """
+    manifest_df = read_manifest(split)
+    if len(manifest_df):
+        return manifest_df
+    image_paths = sorted(paths.list_images(SPLITS[split][1]))
+    return pd.DataFrame({'path': image_paths,
+                         'label': [image_path.split(os.path.sep)[-2] for image_path in image_paths],
+                         'hash': None,
+                         'size': [os.path.getsize(image_path) for image_path in image_paths]}, columns=MANIFEST_COLUMNS)
+
+
+def write_manifest(manifest_df, split):
+    manifest_file = SPLITS[split][0]
+    manifest_dir = os.path.dirname(manifest_file)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    # Write to a temporary file first so that an interrupted build never leaves a truncated manifest
+    manifest_df.to_csv(manifest_file + '.tmp', index=False, columns=MANIFEST_COLUMNS)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def split_of(content_hash, train_split=config.TRAIN_SPLIT, val_split=config.VAL_SPLIT):
+    """
+    Picks the split of an image from its content hash. Like the old shuffled split, train_split of the images are
+    used for training + validation (of which val_split for validation), and the rest for test.
+    """
+    position = int(content_hash[:8], 16) / float(16 ** 8)
+    if position >= train_split:
+        return 'test'
+    return 'validation' if position < train_split * val_split else 'training'
+
+
+def scan_images(input_dir=config.ORIG_INPUT_DIR, workers=8):
+    """
+    Lists the images in input_dir (one sub-directory per label) with their hash and size. Hashes from the existing
+    manifests are reused for images whose size has not changed.
+    :param input_dir: Directory with one sub-directory of images per home-style
+    :param workers: Number of threads hashing images
+    :return: Dataframe with MANIFEST_COLUMNS, one row per image
+    """
+    known = pd.concat([read_manifest(split) for split in SPLITS]).set_index('path')
+    known = known[~known.index.duplicated(keep='last')]
+    image_paths = sorted(paths.list_images(input_dir))
+    sizes = [os.path.getsize(image_path) for image_path in image_paths]
+
+    def hash_image(image_path, size):
+        if image_path in known.index and known.at[image_path, 'size'] == size:
+            return known.at[image_path, 'hash']
+        return file_hash(image_path)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(hash_image, image_paths, sizes))
+    return pd.DataFrame({'path': image_paths,
+                         'label': [image_path.split(os.path.sep)[-2] for image_path in image_paths],
+                         'hash': hashes,
+                         'size': sizes}, columns=MANIFEST_COLUMNS)
+
+
+def _image_key(image_path):
+    return os.path.sep.join(image_path.split(os.path.sep)[-2:])
+
+
+def directory_splits(images_df, workers=8):
+    """
+    Finds the images that are already in a split directory (e.g. the committed data/processed/training folder). Files
+    are matched by label and file name, and by content hash if they were renamed.
+    :param images_df: Dataframe from scan_images()
+    :param workers: Number of threads hashing images
+    :return: Series (aligned with images_df) of the split of every image, None for images in no split directory
+    """
+    sizes = dict(zip(images_df['path'].map(_image_key), images_df['size']))
+    by_key = {}
+    unmatched = []
+    for split in SPLITS:
+        for image_path in sorted(paths.list_images(SPLITS[split][1])):
+            key = _image_key(image_path)
+            if key in sizes and os.path.exists(image_path) and os.path.getsize(image_path) == sizes[key]:
+                by_key.setdefault(key, split)
+            else:
+                unmatched.append((image_path, split))
+
+    def hash_existing(image_path):
+        try:
+            return file_hash(image_path)
+        except (IOError, OSError):
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(hash_existing, [image_path for image_path, _ in unmatched]))
+    by_hash = {}
+    for content_hash, (_, split) in zip(hashes, unmatched):
+        if content_hash is not None:
+            by_hash.setdefault(content_hash, split)
+
+    splits = images_df['path'].map(_image_key).map(by_key)
+    by_hash_splits = images_df['hash'].map(by_hash)
+    return splits.where(splits.notnull(), by_hash_splits)
+
+
+def assign_splits(images_df, workers=8):
+    """
+    Picks the split of every image: the split directory it is in, else the split of its existing manifest, else the
+    split of another copy of the same picture, else split_of() its hash. Images never move between splits.
+    :param images_df: Dataframe from scan_images()
+    :param workers: Number of threads hashing images
+    :return: Series (aligned with images_df) of the split of every image
+    """
+    splits = directory_splits(images_df, workers)
+    previous = {}
+    for split in SPLITS:
+        for image_path in read_manifest(split)['path']:
+            previous.setdefault(image_path, split)
+    splits = splits.where(splits.notnull(), images_df['path'].map(previous))
+    # Copies of a picture that already has a split go to the same split
+    known = pd.Series(splits.values, index=images_df['hash'].values)
+    by_hash = known[known.notnull()]
+    by_hash = by_hash[~by_hash.index.duplicated(keep='first')]
+    splits = splits.where(splits.notnull(), images_df['hash'].map(by_hash))
+    return splits.where(splits.notnull(), images_df['hash'].map(split_of))
+
+
+def build_manifests(input_dir=config.ORIG_INPUT_DIR, workers=8):
+    """
+    Scans the images and writes the manifest of every split
+    :param input_dir: Directory with one sub-directory of images per home-style
+    :param workers: Number of threads hashing images
+    :return: Dictionary of split -> manifest dataframe
+    """
+    images_df = scan_images(input_dir, workers)
+    splits = assign_splits(images_df, workers)
+    manifests = {}
+    for split in SPLITS:
+        manifests[split] = images_df[(splits == split).values].reset_index(drop=True)
+        write_manifest(manifests[split], split)
+    return manifests
+
+
+def _materialize_image(source, destination, mode):
+    if os.path.exists(destination):
+        # Never replace a file that is already there, it may be part of a committed split
+        return False
+    if os.path.islink(destination):
+        # Dangling symlink (e.g. to an image that was moved), only symlinks are replaced
+        os.remove(destination)
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(source), destination)
+        return True
+    if mode == 'hardlink':
+        try:
+            os.link(source, destination)
+            return True
+        except OSError:
+            # Hard links do not work across file systems (or on some network drives), so copy instead
+            pass
+    shutil.copy2(source, destination)
+    return True
+
+
+def materialize(manifest_df, output_dir, mode='hardlink', workers=8):
+    """
+    Creates a directory tree of the split (output_dir/<label>/<file>) for tools that need one, e.g.
+    flow_from_directory(). Images that are already there are skipped. Nothing in output_dir is ever removed.
+    :param manifest_df: Manifest of the split
+    :param output_dir: Directory to create the split in
+    :param mode: One of MATERIALIZE_MODES. Hard links fall back to copying.
+    :param workers: Number of threads linking/copying images
+    :return: Number of images linked or copied
+    """
+    if mode not in MATERIALIZE_MODES:
+        raise ValueError("Unknown mode %s, use one of %s" % (mode, MATERIALIZE_MODES))
+    destinations = [os.path.sep.join([output_dir, label, os.path.basename(image_path)])
+                    for image_path, label in zip(manifest_df['path'], manifest_df['label'])]
+    for label in manifest_df['label'].unique():
+        label_dir = os.path.sep.join([output_dir, label])
+        if not os.path.exists(label_dir):
+            os.makedirs(label_dir)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(lambda args: _materialize_image(*args, mode=mode),
+                                zip(manifest_df['path'], destinations)))
+
+
+def split_image_paths(split):
+    """
+    :param split: One of SPLITS
+    :return: List of the image paths in a split. Falls back to the split directory if there is no manifest.
+    """
+    return list(split_dataframe(split)['path'])
+
+
+def flow_from_manifest(image_data_generator, split, batch_size=32, shuffle=True, **kwargs):
+    """
+    Drop-in replacement for image_data_generator.flow_from_directory(<split directory>) that reads the manifest.
+    Falls back to the split directory if there is no manifest.
+    :param image_data_generator: Keras ImageDataGenerator
+    :param split: One of SPLITS
+    :param batch_size: Number of images per batch
+    :param shuffle: Whether to shuffle the images
+    :param kwargs: Other arguments of flow_from_dataframe()
+    :return: Keras DataFrameIterator yielding (images, one-hot labels) batches
+    """
+    return image_data_generator.flow_from_dataframe(split_dataframe(split), x_col='path', y_col='label',
+                                                    classes=list(config.CLASSES), class_mode='categorical',
+                                                    target_size=(config.IMAGE_SIZE, config.IMAGE_SIZE),
+                                                    color_mode='rgb', batch_size=batch_size, shuffle=shuffle,
+                                                    validate_filenames=False, **kwargs)
@@ -0,0 +1,147 @@
+"""
+Builds the embedding store for the home-listing catalog.
+
+Images are decoded and resized by a pool of worker threads, stacked in to batches and run through the models with
+one forward pass per batch. Results are streamed straight in to the embedding store, so memory use does not grow
+with the size of the catalog.
+
+Usage (from the visual_home_finder directory):
+    python embedding_builder.py --batch_size 64 --workers 8
+"""
+
+import os
+import time
+import argparse
+import collections
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import embedding_store
+import preprocessing
+
+
+def read_listing_csvs(csv_files=config.LISTING_CSVS):
+    """
+    Reads the redfin listing CSVs. Each listing is identified by <zip code>_<row number>, which is also the name
+    of its image in config.LISTINGS_PATH.
+    :param csv_files: List of listing CSV files
+    :return: Dataframe of listings indexed by listing ID
+    """
+    listings = []
+    for listings_file in csv_files:
+        listings_df = pd.read_csv(listings_file)
+        zip_codes = embedding_store.zip_code_strings(listings_df['ZIP OR POSTAL CODE'])
+        index_column = zip_codes + '_' + (listings_df.index + 1).astype(str)
+        listings.append(listings_df.set_index(index_column))
+    return pd.concat(listings).rename(columns=embedding_store.LISTING_COLUMN_NAMES)
+
+
+def listing_image_file(listing_id):
+    return os.path.sep.join([config.LISTINGS_PATH, listing_id + '.jpg'])
+
+
+def iter_image_batches(listing_ids, batch_size, executor, prefetch_batches=2):
+    """
+    Yields batches of preprocessed images. Up to prefetch_batches batches are decoded ahead by the executor while
+    the caller runs the models on the current batch. Batches are written in to a small ring of preallocated
+    buffers, so a yielded batch is only valid until the next one is requested.
+    :param listing_ids: Listing IDs to load images for
+    :param batch_size: Number of images per batch
+    :param executor: Executor used to decode images
+    :param prefetch_batches: Number of batches decoded ahead
+    :return: Generator of (listing IDs, image batch) tuples. Listings whose image cannot be read are skipped.
+    """
+    buffers = [preprocessing.allocate_batch(batch_size) for _ in range(prefetch_batches + 1)]
+    pending = collections.deque()
+    for batch_number, start in enumerate(range(0, len(listing_ids), batch_size)):
+        batch_ids = listing_ids[start:start + batch_size]
+        image_files = [listing_image_file(ii) for ii in batch_ids]
+        batch = buffers[batch_number % len(buffers)][:len(batch_ids)]
+        pending.append((batch_ids, batch, [executor.submit(preprocessing.load_into, image_file, out)
+                                           for image_file, out in zip(image_files, batch)]))
+        if len(pending) > prefetch_batches:
+            yield _collect_batch(*pending.popleft())
+    while pending:
+        yield _collect_batch(*pending.popleft())
+
+
+def _collect_batch(batch_ids, batch, futures):
+    loaded = np.array([future.result() for future in futures], dtype=bool)
+    preprocessing.normalize(batch, 'mean')
+    for ii in np.flatnonzero(~loaded):
+        print('File %s not found' % listing_image_file(batch_ids[ii]))
+    if loaded.all():
+        return batch_ids, batch
+    return [batch_ids[ii] for ii in np.flatnonzero(loaded)], batch[loaded]
+
+
+def build_embedding_store(store_path=config.EMBEDDING_STORE, csv_files=config.LISTING_CSVS, batch_size=32,
+                          workers=4, dtype=np.float32, listings_df=None, append=False):
+    """
+    Generates home-style predictions and embeddings for every listing and writes them to an embedding store
+    :param store_path: Directory to write the store to
+    :param csv_files: List of listing CSV files
+    :param batch_size: Number of images per forward pass
+    :param workers: Number of threads decoding images
+    :param dtype: np.float32 or np.float16
+    :param listings_df: Listings to embed. If not given, all listings in csv_files are embedded.
+    :param append: If True, append the listings to the existing store instead of writing a new store
+    :return: Number of listings written
+    """
+    import utilities
+    import model_registry
+
+    if listings_df is None:
+        listings_df = read_listing_csvs(csv_files)
+    model, has_resnet_features = utilities.combined_home_model(model_registry.get_model('home'))
+    resnet_model = None if has_resnet_features else model_registry.get_model('resnet_feature')
+
+    writer = embedding_store.EmbeddingStoreWriter(store_path, append=True) if append else None
+    start_count = writer.count if append else 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_ids, batch in iter_image_batches(list(listings_df.index), batch_size, executor):
+            if len(batch_ids) == 0:
+                continue
+            outputs = model.predict_on_batch(batch)
+            style_predictions, home_features = np.asarray(outputs[0]), np.asarray(outputs[1])
+            resnet_features = np.asarray(outputs[2] if has_resnet_features else resnet_model.predict_on_batch(batch))
+            features = {'home_feature': home_features, 'resnet_feature': resnet_features}
+            if writer is None:
+                writer = embedding_store.EmbeddingStoreWriter(
+                    store_path, {name: matrix.shape[1] for name, matrix in features.items()}, dtype=dtype)
+
+            batch_df = listings_df.loc[batch_ids].copy()
+            batch_df['predicted_style'] = np.asarray(config.CLASSES)[np.argmax(style_predictions, axis=1)]
+            writer.add(batch_df, features)
+
+    if writer is None:
+        return 0
+    writer.close()
+    return writer.count - start_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate embeddings for all home-listings.')
+    parser.add_argument('--store', type=str, default=config.EMBEDDING_STORE, help='output store directory')
+    parser.add_argument('--batch_size', type=int, default=32, help='number of images per forward pass')
+    parser.add_argument('--workers', type=int, default=4, help='number of image decoding threads')
+    parser.add_argument('--float16', action='store_true', help='store embeddings as float16 instead of float32')
+    parser.add_argument('--skip_thumbnails', action='store_true', help='do not build thumbnails of the listings')
+    args = parser.parse_args()
+
+    starting_time = time.time()
+    count = build_embedding_store(args.store, batch_size=args.batch_size, workers=args.workers,
+                                  dtype=np.float16 if args.float16 else np.float32)
+    elapsed = time.time() - starting_time
+    print("Embedded %d listings in %.1f seconds (%.1f images/sec)" % (count, elapsed, count / elapsed))
+
+    if not args.skip_thumbnails:
+        import thumbnails
+        listing_ids = list(embedding_store.EmbeddingStore(args.store).listings.index)
+        print("Wrote thumbnails for %d listings" % thumbnails.build_thumbnails(listing_ids, workers=args.workers))
+
+
+if __name__ == "__main__":
+    main()
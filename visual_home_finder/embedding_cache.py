@@ -0,0 +1,175 @@
+"""
+Bounded cache for the embeddings of uploaded images.
+
+Entries are keyed by a hash of the decoded image pixels plus the identity of the model, so the same picture
+uploaded twice (even as a different file object) skips inference. The in-memory tier is an LRU bounded by both the
+number of entries and their total size. An optional on-disk tier keeps embeddings across server restarts; it is an
+LRU with its own (larger) limits, whose order is kept in the modification times of the files.
+"""
+
+import os
+import hashlib
+import threading
+import collections
+import numpy as np
+
+import config
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by number of entries and total size in bytes
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, size_of=None, on_evict=None):
+        """
+        :param max_entries: Maximum number of entries
+        :param max_bytes: Maximum total size of the entries in bytes. No limit if None.
+        :param size_of: Function returning the size of a value in bytes. Defaults to value.nbytes.
+        :param on_evict: Function called with (key, value) of every evicted entry
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_of = size_of or (lambda value: value.nbytes)
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        size = self.size_of(value)
+        evicted_entries = []
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self.size_of(self._entries.pop(key))
+            self._entries[key] = value
+            self.total_bytes += size
+            # Evict the least recently used entries until we are back within both limits
+            while self._entries and (len(self._entries) > self.max_entries or
+                                     (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= self.size_of(evicted)
+                evicted_entries.append((evicted_key, evicted))
+        if self.on_evict is not None:
+            for evicted_key, evicted in evicted_entries:
+                self.on_evict(evicted_key, evicted)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self.total_bytes}
+
+
+def image_key(image_pil, model_id):
+    """
+    Returns a cache key for an image: a hash of its decoded pixels, size and mode, plus the model identity
+    :param image_pil: Decoded PIL image
+    :param model_id: String identifying the model that generates the embedding
+    :return: Hex digest string
+    """
+    key = hashlib.sha1()
+    key.update(model_id.encode())
+    key.update(("%s %s" % (image_pil.mode, image_pil.size)).encode())
+    key.update(image_pil.tobytes())
+    return key.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Cache of image embeddings with an in-memory LRU tier and an optional on-disk tier
+    """
+
+    def __init__(self, model_id=None, max_entries=config.EMBEDDING_CACHE_ENTRIES,
+                 max_bytes=config.EMBEDDING_CACHE_BYTES, disk_path=config.EMBEDDING_CACHE_PATH,
+                 max_disk_entries=config.EMBEDDING_CACHE_DISK_ENTRIES,
+                 max_disk_bytes=config.EMBEDDING_CACHE_DISK_BYTES):
+        """
+        :param model_id: String identifying the model (and layer) that generates the embeddings. Defaults to the model,
+        the feature backend (backends embed slightly differently) and the layer, e.g. '<MODEL_NAME>:keras:dense_4'.
+        :param max_entries: Maximum number of embeddings held in memory
+        :param max_bytes: Maximum total size of the embeddings held in memory
+        :param disk_path: Directory for the on-disk tier. No on-disk tier if None.
+        :param max_disk_entries: Maximum number of embeddings kept on disk
+        :param max_disk_bytes: Maximum total size of the embedding files kept on disk. No limit if None.
+        """
+        self.model_id = model_id or '%s:%s:dense_4' % (config.MODEL_NAME, config.FEATURE_BACKEND)
+        self.memory = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self.disk_path = disk_path
+        self.disk_hits = 0
+        # The disk tier only holds the file sizes in memory, the least recently used files are deleted
+        self.disk = LRUCache(max_entries=max_disk_entries, max_bytes=max_disk_bytes, size_of=lambda size: size,
+                             on_evict=lambda key, size: self._remove_disk_file(key))
+        if disk_path is not None:
+            if not os.path.exists(disk_path):
+                os.makedirs(disk_path)
+            # Files of earlier runs, least recently used first, so the limits also apply to them
+            entries = [entry for entry in os.scandir(disk_path) if entry.name.endswith('.npy')]
+            for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+                self.disk.put(entry.name[:-len('.npy')], entry.stat().st_size)
+
+    def _disk_file(self, key):
+        return os.path.sep.join([self.disk_path, key + '.npy'])
+
+    def _remove_disk_file(self, key):
+        try:
+            os.remove(self._disk_file(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        """
+        :param key: Key from image_key()
+        :return: The cached embedding, or None
+        """
+        embedding = self.memory.get(key)
+        if embedding is None and self.disk_path is not None and os.path.exists(self._disk_file(key)):
+            embedding = np.load(self._disk_file(key))
+            self.memory.put(key, embedding)
+            self.disk_hits += 1
+            # Mark the file as recently used, also for the next run
+            os.utime(self._disk_file(key))
+            self.disk.put(key, os.path.getsize(self._disk_file(key)))
+        return embedding
+
+    def put(self, key, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self.memory.put(key, embedding)
+        if self.disk_path is not None:
+            np.save(self._disk_file(key), embedding)
+            self.disk.put(key, os.path.getsize(self._disk_file(key)))
+
+    def get_or_compute(self, image_pil, compute_embedding):
+        """
+        Returns the embedding of an image, only computing it if it is not cached
+        :param image_pil: Decoded PIL image
+        :param compute_embedding: Function that takes the PIL image and returns its embedding
+        :return: 1-D float32 numpy array
+        """
+        key = image_key(image_pil, self.model_id)
+        embedding = self.get(key)
+        if embedding is None:
+            embedding = np.ravel(compute_embedding(image_pil)).astype(np.float32)
+            self.put(key, embedding)
+        return embedding
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats['disk_hits'] = self.disk_hits
+        stats['disk_entries'] = len(self.disk)
+        stats['disk_bytes'] = self.disk.total_bytes
+        return stats
@@ -0,0 +1,308 @@
+"""
+Binary embedding store for home-listings.
+
+A store is a directory containing
+- store.json: header with the number of rows, dtype and the dimension of every feature matrix
+- <feature_name>.bin: a contiguous, row-major matrix of embeddings (float32 or float16) that can be memory-mapped
+- listings.pkl: a dataframe with the listing metadata (price, beds, url etc.) indexed by listing ID
+- tombstones.npy: (optional) boolean array marking rows of listings that have been removed
+
+Row ii of every feature matrix belongs to the listing in row ii of the metadata table. Stores are append-only:
+when a listing is removed or its image changes, its row is tombstoned and a new row is appended.
+
+Usage (from the visual_home_finder directory) to convert the old CSV feature file:
+    python embedding_store.py --csv ../data/processed/home_features/home_features_model_6.csv
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+import config
+
+STORE_HEADER = "store.json"
+STORE_LISTINGS = "listings.pkl"
+STORE_TOMBSTONES = "tombstones.npy"
+STORE_VERSION = 1
+
+# Columns in the old feature CSV that hold stringified embeddings
+FEATURE_COLUMNS = ['home_feature', 'resnet_feature']
+
+# Long redfin column names are renamed to something the app can use
+LISTING_COLUMN_NAMES = {"URL (SEE http://www.redfin.com/buy-a-home/comparative-market-analysis FOR INFO ON PRICING)": "url",
+                        "LATITUDE": 'lat',
+                        "LONGITUDE": 'lon'}
+
+
+def zip_code_strings(zip_codes):
+    """
+    Converts zip codes to strings. A column with a missing zip code is read as floats, so whole numbers are cast to
+    int first (98103, not 98103.0).
+    :param zip_codes: Series of zip codes
+    :return: Series of strings ('nan' for missing zip codes)
+    """
+    numbers = pd.to_numeric(zip_codes, errors='coerce')
+    whole = numbers.notna() & (numbers % 1 == 0)
+    strings = pd.Series([str(zip_code) if pd.notna(zip_code) else 'nan' for zip_code in zip_codes],
+                        index=zip_codes.index, dtype=object)
+    strings[whole] = numbers[whole].astype(np.int64).astype(str)
+    return strings
+
+
+def parse_feature_string(string_numpy):
+    """
+    Converts a stringified list of floats (as written by DataFrame.to_csv) to a float32 array
+    :param string_numpy: String of the form "[0.1, 0.2, ...]"
+    :return: 1-D float32 numpy array
+    """
+    return np.fromstring(string_numpy.strip()[1:-1], sep=',', dtype=np.float32)
+
+
+class EmbeddingStore:
+    """
+    Read-only view of an embedding store directory. Feature matrices are memory-mapped, so opening a store
+    does not read the embeddings in to memory.
+    """
+
+    def __init__(self, store_path, mmap=True):
+        """
+        :param store_path: Directory containing the embedding store
+        :param mmap: If True, memory-map the feature matrices. Otherwise they are read in to memory.
+        """
+        self.store_path = store_path
+        with open(os.path.sep.join([store_path, STORE_HEADER])) as f:
+            self.header = json.load(f)
+        self.dtype = np.dtype(self.header['dtype'])
+        self.count = self.header['count']
+        self.listings = pd.read_pickle(os.path.sep.join([store_path, STORE_LISTINGS]))
+        self.tombstones = read_tombstones(store_path, self.count)
+        self._mmap = mmap
+        self._features = {}
+
+    @property
+    def feature_names(self):
+        return list(self.header['features'].keys())
+
+    @property
+    def model_name(self):
+        return self.header.get('model_name')
+
+    @property
+    def live_rows(self):
+        """
+        Rows of listings that have not been tombstoned
+        """
+        return np.flatnonzero(~self.tombstones)
+
+    def feature_dim(self, feature_name):
+        return self.header['features'][feature_name]
+
+    def features(self, feature_name='home_feature'):
+        """
+        Returns the (count x dim) embedding matrix for a feature. The matrix is loaded once and then reused.
+        :param feature_name: Name of the feature, for e.g. home_feature or resnet_feature
+        :return: 2-D numpy array (a read-only memory-map if the store was opened with mmap=True)
+        """
+        if feature_name not in self._features:
+            file_name = os.path.sep.join([self.store_path, feature_name + '.bin'])
+            shape = (self.count, self.feature_dim(feature_name))
+            if self.count == 0:
+                matrix = np.empty(shape, dtype=self.dtype)
+            elif self._mmap:
+                matrix = np.memmap(file_name, dtype=self.dtype, mode='r', shape=shape)
+            else:
+                matrix = np.fromfile(file_name, dtype=self.dtype).reshape(shape)
+            self._features[feature_name] = matrix
+        return self._features[feature_name]
+
+    def __len__(self):
+        return self.count
+
+
+class EmbeddingStoreWriter:
+    """
+    Writes an embedding store. Rows can be added in chunks, so the embeddings never need to be held in memory
+    all at once. The header and metadata table are only written on close(), so a half-written store is never
+    picked up by the app.
+    """
+
+    def __init__(self, store_path, feature_dims=None, dtype=np.float32, model_name=config.MODEL_NAME, append=False):
+        """
+        :param store_path: Directory to write the store to. Created if it does not exist.
+        :param feature_dims: Dictionary of feature name -> embedding dimension. Not needed when appending.
+        :param dtype: np.float32 or np.float16. Ignored when appending.
+        :param model_name: Name of the model that generated the embeddings
+        :param append: If True, add rows to the existing store at store_path instead of starting a new store
+        """
+        if not os.path.exists(store_path):
+            os.makedirs(store_path)
+        self.store_path = store_path
+        self.model_name = model_name
+        self._listings = []
+        if append:
+            existing = EmbeddingStore(store_path)
+            if existing.model_name != model_name:
+                raise ValueError("Store %s was built with model %s, cannot append embeddings from %s" %
+                                 (store_path, existing.model_name, model_name))
+            self.dtype = existing.dtype
+            self.feature_dims = dict(existing.header['features'])
+            self.count = existing.count
+            self.tombstones = existing.tombstones.copy()
+            self._listings.append(existing.listings)
+        else:
+            self.dtype = np.dtype(dtype)
+            self.feature_dims = dict(feature_dims)
+            self.count = 0
+            self.tombstones = np.zeros(0, dtype=bool)
+        if self.dtype not in (np.dtype(np.float32), np.dtype(np.float16)):
+            raise ValueError("Embedding store only supports float32 and float16, got %s" % self.dtype)
+        self._updates = []
+        self._files = {}
+        for name, dim in self.feature_dims.items():
+            file_name = os.path.sep.join([store_path, name + '.bin'])
+            self._files[name] = open(file_name, 'ab' if append else 'wb')
+            # Drop anything written after the last header (e.g. by an interrupted run) so rows stay aligned
+            self._files[name].truncate(self.count * dim * self.dtype.itemsize)
+
+    def add(self, listings_df, features):
+        """
+        Appends a chunk of listings to the store
+        :param listings_df: Dataframe with metadata of the listings, indexed by listing ID
+        :param features: Dictionary of feature name -> (len(listings_df) x dim) array
+        """
+        for name, dim in self.feature_dims.items():
+            matrix = np.ascontiguousarray(features[name], dtype=self.dtype)
+            if matrix.shape != (len(listings_df), dim):
+                raise ValueError("Expected %s to have shape %s, got %s" % (name, (len(listings_df), dim),
+                                                                           matrix.shape))
+            matrix.tofile(self._files[name])
+        self._listings.append(listings_df)
+        self.count += len(listings_df)
+
+    def tombstone(self, rows):
+        """
+        Marks rows as removed. Their embeddings stay in the store but are no longer searched.
+        :param rows: Row numbers of the listings to remove
+        """
+        self.tombstones = np.concatenate([self.tombstones, np.zeros(self.count - len(self.tombstones), dtype=bool)])
+        self.tombstones[np.asarray(rows, dtype=np.int64)] = True
+
+    def update_listings(self, rows, listings_df):
+        """
+        Replaces the metadata (price, days on market etc.) of existing rows. The embeddings are not changed.
+        :param rows: Row numbers of the listings to update
+        :param listings_df: Dataframe with the new metadata, one row per entry in rows
+        """
+        self._updates.append((np.asarray(rows, dtype=np.int64), listings_df))
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        listings_df = pd.concat(self._listings) if self._listings else pd.DataFrame()
+        for rows, updates_df in self._updates:
+            columns = [column for column in updates_df.columns if column in listings_df.columns]
+            listings_df.iloc[rows, listings_df.columns.get_indexer(columns)] = updates_df[columns].values
+        listings_df.to_pickle(os.path.sep.join([self.store_path, STORE_LISTINGS]))
+        if self.tombstones.any():
+            tombstones = np.concatenate([self.tombstones, np.zeros(self.count - len(self.tombstones), dtype=bool)])
+            np.save(os.path.sep.join([self.store_path, STORE_TOMBSTONES]), tombstones)
+        elif os.path.exists(os.path.sep.join([self.store_path, STORE_TOMBSTONES])):
+            os.remove(os.path.sep.join([self.store_path, STORE_TOMBSTONES]))
+        header = {'version': STORE_VERSION,
+                  'count': self.count,
+                  'dtype': self.dtype.name,
+                  'model_name': self.model_name,
+                  'features': self.feature_dims}
+        with open(os.path.sep.join([self.store_path, STORE_HEADER]), 'w') as f:
+            json.dump(header, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def read_tombstones(store_path, count):
+    """
+    Returns a boolean array with True for every tombstoned row of a store
+    :param store_path: Directory containing the embedding store
+    :param count: Number of rows in the store
+    :return: 1-D boolean numpy array of length count
+    """
+    tombstones = np.zeros(count, dtype=bool)
+    tombstones_file = os.path.sep.join([store_path, STORE_TOMBSTONES])
+    if os.path.exists(tombstones_file):
+        saved = np.load(tombstones_file)[:count]
+        tombstones[:len(saved)] = saved
+    return tombstones
+
+
+def convert_feature_csv(csv_file, store_path, dtype=np.float32, chunk_size=1000):
+    """
+    Converts the old CSV feature file (with stringified embedding lists) to an embedding store
+    :param csv_file: CSV file with home_feature and resnet_feature columns
+    :param store_path: Directory to write the store to
+    :param dtype: np.float32 or np.float16
+    :param chunk_size: Number of CSV rows to convert at a time
+    :return: Number of listings written. Raises a ValueError if the CSV has no listings.
+    """
+    writer = None
+    for chunk_df in pd.read_csv(csv_file, index_col=0, chunksize=chunk_size):
+        if len(chunk_df) == 0:
+            continue
+        chunk_df = chunk_df.rename(columns=LISTING_COLUMN_NAMES)
+        feature_names = [name for name in FEATURE_COLUMNS if name in chunk_df.columns]
+        features = {name: np.vstack(chunk_df[name].apply(parse_feature_string)) for name in feature_names}
+        if writer is None:
+            writer = EmbeddingStoreWriter(store_path,
+                                          {name: features[name].shape[1] for name in feature_names},
+                                          dtype=dtype)
+        writer.add(chunk_df.drop(columns=feature_names), features)
+    if writer is None:
+        # The feature sizes of the store are taken from the first listing
+        raise ValueError("%s has no listings, cannot build an embedding store from it" % csv_file)
+    writer.close()
+    return writer.count
+
+
+def store_version(store_path=config.EMBEDDING_STORE):
+    """
+    :param store_path: Directory containing the embedding store
+    :return: Modification time of the store header, which is rewritten whenever the store changes (e.g. by
+    incremental_indexer.py). None if there is no store.
+    """
+    try:
+        return os.stat(os.path.sep.join([store_path, STORE_HEADER])).st_mtime_ns
+    except OSError:
+        return None
+
+
+def open_store(store_path=config.EMBEDDING_STORE, csv_file=config.FEATURE_FILE, mmap=True):
+    """
+    Opens the embedding store, converting the CSV feature file first if the store has not been built yet
+    :param store_path: Directory containing the embedding store
+    :param csv_file: CSV feature file to convert if the store is missing
+    :param mmap: If True, memory-map the feature matrices
+    :return: EmbeddingStore
+    """
+    if not os.path.exists(os.path.sep.join([store_path, STORE_HEADER])):
+        convert_feature_csv(csv_file, store_path)
+    return EmbeddingStore(store_path, mmap=mmap)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert the home feature CSV file to a binary embedding store.')
+    parser.add_argument('--csv', type=str, default=config.FEATURE_FILE, help='CSV file with home features')
+    parser.add_argument('--store', type=str, default=config.EMBEDDING_STORE, help='output store directory')
+    parser.add_argument('--float16', action='store_true', help='store embeddings as float16 instead of float32')
+    args = parser.parse_args()
+
+    count = convert_feature_csv(args.csv, args.store, dtype=np.float16 if args.float16 else np.float32)
+    print("Wrote %d listings to %s" % (count, args.store))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Streaming evaluation of the home-style classifier.
+
+The images of a split are read from its manifest in fixed-size batches in to a reused buffer, and every batch only
+updates running totals: the confusion matrix (for precision/ recall/ F1) and, for every true class, a histogram of
+the predicted probability of every class (for one-vs-rest and one-vs-one ROC-AUC, exact up to the histogram bin
+width). Misclassified images are written to an index file (path, label, prediction, probabilities) instead of being
+kept in memory, so memory use does not grow with the size of the split.
+
+Usage (from the visual_home_finder directory):
+    python evaluation.py --split test --batch_size 32 --output ../data/processed/misclassified_test.csv
+"""
+
+import os
+import csv
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import preprocessing
+import dataset_manifest
+
+
+def _auc_from_histograms(positive, negative):
+    """
+    Area under the ROC curve from histograms of the scores of the positive and negative examples (ties, i.e. scores
+    in the same bin, count half)
+    """
+    if positive.sum() == 0 or negative.sum() == 0:
+        return np.nan
+    negative_below = np.cumsum(negative) - negative
+    return float(np.sum(positive * (negative_below + 0.5 * negative))) / (positive.sum() * negative.sum())
+
+
+class StreamingMetrics:
+    """
+    Classification metrics accumulated batch by batch
+    """
+
+    def __init__(self, classes=config.CLASSES, bins=1000):
+        """
+        :param classes: Names of the classes, in the order of the model outputs
+        :param bins: Number of probability bins of the AUC histograms
+        """
+        self.classes = list(classes)
+        self.bins = bins
+        self.confusion = np.zeros((len(self.classes), len(self.classes)), dtype=np.int64)
+        # score_histogram[true class, scored class, bin]: how often an image of the true class got a probability in
+        # the bin for the scored class
+        self.score_histogram = np.zeros((len(self.classes), len(self.classes), bins), dtype=np.int64)
+
+    def update(self, labels, probabilities):
+        """
+        :param labels: Array of the true class indices of a batch
+        :param probabilities: (batch x classes) array of predicted probabilities
+        :return: Array of the predicted class indices
+        """
+        num_classes = len(self.classes)
+        predictions = np.argmax(probabilities, axis=1)
+        np.add.at(self.confusion, (labels, predictions), 1)
+        score_bins = np.clip((probabilities * self.bins).astype(np.int64), 0, self.bins - 1)
+        flat = (labels[:, None] * num_classes + np.arange(num_classes)) * self.bins + score_bins
+        self.score_histogram += np.bincount(flat.ravel(), minlength=self.score_histogram.size).reshape(
+            self.score_histogram.shape)
+        return predictions
+
+    @property
+    def count(self):
+        return int(self.confusion.sum())
+
+    def accuracy(self):
+        return np.trace(self.confusion) / max(self.count, 1)
+
+    def precision(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.nan_to_num(np.diag(self.confusion) / self.confusion.sum(axis=0))
+
+    def recall(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.nan_to_num(np.diag(self.confusion) / self.confusion.sum(axis=1))
+
+    def f1(self):
+        precision, recall = self.precision(), self.recall()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.nan_to_num(2 * precision * recall / (precision + recall))
+
+    def support(self):
+        return self.confusion.sum(axis=1)
+
+    def auc_ovr(self):
+        """
+        :return: Array of the one-vs-rest ROC-AUC of every class (like roc_auc_score(multi_class='ovr'))
+        """
+        aucs = []
+        for ii in range(len(self.classes)):
+            positive = self.score_histogram[ii, ii]
+            negative = self.score_histogram[:, ii].sum(axis=0) - positive
+            aucs.append(_auc_from_histograms(positive, negative))
+        return np.array(aucs)
+
+    def auc_ovo(self):
+        """
+        :return: Macro average of the one-vs-one ROC-AUC over all pairs of classes (like
+        roc_auc_score(multi_class='ovo'))
+        """
+        aucs = []
+        for ii in range(len(self.classes)):
+            for jj in range(ii + 1, len(self.classes)):
+                pair_aucs = [_auc_from_histograms(self.score_histogram[ii, ii], self.score_histogram[jj, ii]),
+                             _auc_from_histograms(self.score_histogram[jj, jj], self.score_histogram[ii, jj])]
+                aucs.append(np.mean(pair_aucs))
+        return np.nanmean(aucs) if aucs else np.nan
+
+    def confusion_df(self, normalize=False):
+        """
+        :param normalize: If True, every row (true class) is divided by its number of images
+        :return: Confusion matrix as a dataframe, with the true classes as rows and the predictions as columns
+        """
+        confusion = self.confusion.astype(float)
+        if normalize:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                confusion = np.nan_to_num(confusion / confusion.sum(axis=1, keepdims=True))
+        return pd.DataFrame(confusion, index=self.classes, columns=self.classes)
+
+    def report(self):
+        """
+        :return: Text report like sklearn's classification_report, with the one-vs-rest AUC of every class
+        """
+        width = max(len(name) for name in self.classes + ['macro avg'])
+        lines = ['%*s %9s %9s %9s %9s %9s' % (width, '', 'precision', 'recall', 'f1-score', 'auc', 'support'), '']
+        rows = zip(self.classes, self.precision(), self.recall(), self.f1(), self.auc_ovr(), self.support())
+        for name, precision, recall, f1, auc, support in rows:
+            lines.append('%*s %9.2f %9.2f %9.2f %9.3f %9d' % (width, name, precision, recall, f1, auc, support))
+        lines.append('')
+        lines.append('%*s %9s %9s %9.2f %9s %9d' % (width, 'accuracy', '', '', self.accuracy(), '', self.count))
+        lines.append('%*s %9.2f %9.2f %9.2f %9.3f %9d' % (width, 'macro avg', self.precision().mean(),
+                                                          self.recall().mean(), self.f1().mean(),
+                                                          np.nanmean(self.auc_ovr()), self.count))
+        lines.append('%*s %9s %9s %9s %9.3f' % (width, 'ovo auc', '', '', '', self.auc_ovo()))
+        return '\n'.join(lines)
+
+
+def evaluate(model, split='test', batch_size=32, workers=4, misclassified_file=None, bins=1000):
+    """
+    Scores a classifier on a split, one batch at a time
+    :param model: Keras model that outputs the probability of every class in config.CLASSES
+    :param split: One of dataset_manifest.SPLITS
+    :param batch_size: Number of images per forward pass
+    :param workers: Number of image decoding threads
+    :param misclassified_file: If given, misclassified images are written to this CSV file
+    :param bins: Number of probability bins of the AUC histograms
+    :return: StreamingMetrics of the split
+    """
+    manifest_df = dataset_manifest.split_dataframe(split)
+    manifest_df = manifest_df[manifest_df['label'].isin(config.CLASSES)].reset_index(drop=True)
+    metrics = StreamingMetrics(config.CLASSES, bins)
+    batch = preprocessing.allocate_batch(batch_size)
+
+    writer = None
+    if misclassified_file is not None:
+        output_dir = os.path.dirname(misclassified_file)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        index_file = open(misclassified_file, 'w', newline='')
+        writer = csv.writer(index_file)
+        writer.writerow(['path', 'label', 'predicted', 'confidence'] + config.CLASSES)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, len(manifest_df), batch_size):
+                batch_df = manifest_df.iloc[start:start + batch_size]
+                images, loaded = preprocessing.load_batch(list(batch_df['path']), batch, executor=executor)
+                for image_file in batch_df['path'][~loaded]:
+                    print('File %s could not be read' % image_file)
+                if not loaded.any():
+                    continue
+                batch_df = batch_df[loaded]
+                probabilities = np.asarray(model.predict_on_batch(images[loaded]))
+                labels = np.array([config.CLASSES.index(label) for label in batch_df['label']])
+                predictions = metrics.update(labels, probabilities)
+                if writer is None:
+                    continue
+                for ii in np.flatnonzero(predictions != labels):
+                    writer.writerow([batch_df['path'].iloc[ii], batch_df['label'].iloc[ii],
+                                     config.CLASSES[predictions[ii]], '%.4f' % probabilities[ii].max()]
+                                    + ['%.4f' % probability for probability in probabilities[ii]])
+    finally:
+        if writer is not None:
+            index_file.close()
+    return metrics
+
+
+def read_misclassified(misclassified_file, label=None, predicted=None):
+    """
+    :param misclassified_file: CSV file written by evaluate()
+    :param label: If given, only images of this class
+    :param predicted: If given, only images predicted as this class
+    :return: Dataframe with one row per misclassified image
+    """
+    misclassified_df = pd.read_csv(misclassified_file)
+    if label is not None:
+        misclassified_df = misclassified_df[misclassified_df['label'] == label]
+    if predicted is not None:
+        misclassified_df = misclassified_df[misclassified_df['predicted'] == predicted]
+    return misclassified_df
+
+
+def main():
+    import model_registry
+
+    parser = argparse.ArgumentParser(description='Evaluate the home-style classifier on a split.')
+    parser.add_argument('--split', type=str, default='test', choices=list(dataset_manifest.SPLITS),
+                        help='split to evaluate on')
+    parser.add_argument('--batch_size', type=int, default=32, help='number of images per batch')
+    parser.add_argument('--workers', type=int, default=4, help='number of image decoding threads')
+    parser.add_argument('--output', type=str, default=config.MISCLASSIFIED_FILE,
+                        help='CSV file to write the misclassified images to')
+    args = parser.parse_args()
+
+    home_model = model_registry.get_model('home')
+    starting_time = time.time()
+    metrics = evaluate(home_model, args.split, args.batch_size, args.workers, args.output)
+    print(metrics.report())
+    print()
+    print(metrics.confusion_df())
+    print("Evaluated %d images in %.1f s, misclassified images are listed in %s" % (
+        metrics.count, time.time() - starting_time, args.output))
+
+
+if __name__ == "__main__":
+    main()
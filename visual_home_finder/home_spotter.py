@@ -3,133 +3,298 @@ HomeSpotter Webapp using Streamlit
 """
 
 import streamlit as st
-import config, utilities
+import config, embedding_store, embedding_cache, ann_index, inference_client, model_registry, preprocessing
+import query_result, thumbnails, metadata_index, instrumentation, similarity
 import streamlit_utilities as str_util
 import pandas as pd
 import numpy as np
 import os
-import matplotlib.pyplot as plt
+import hashlib
 
-from sklearn.metrics.pairwise import cosine_similarity, euclidean_distances
-from tensorflow.keras.preprocessing import image
-from tensorflow.keras.models import Model, load_model
-from PIL import Image
+
+@st.cache(allow_output_mutation=True)
+def read_store(version=None):
+    """
+    Opens the binary embedding store (converting config.FEATURE_FILE the first time)
+    :param version: embedding_store.store_version(). Everything cached from the store takes the version, so that it
+    is re-read after the store is refreshed (e.g. by incremental_indexer.py).
+    :return: EmbeddingStore with memory-mapped feature matrices
+    """
+    return embedding_store.open_store()
+
+
+def read_store_version():
+    """
+    :return: Version of the embedding store, changes whenever the store is refreshed
+    """
+    return embedding_store.store_version()
 
 
-@st.cache
 def read_listings():
     """
     Loads home-listings and returns them as a dataframe
-    :return: A homelisting dataframe which includes feature embeddings for the home listings
+    :return: A homelisting dataframe with the metadata for the home listings
     """
-    home_listings_df = pd.read_csv(config.FEATURE_FILE, index_col=0)
-    home_listings_df['home_feature'] = home_listings_df.home_feature.apply(utilities.str_to_array)
-    home_listings_df['resnet_feature'] = home_listings_df.resnet_feature.apply(utilities.str_to_array)
-    home_listings_df = home_listings_df.rename(columns={"URL (SEE http://www.redfin.com/buy-a-home/comparative-market-analysis FOR INFO ON PRICING)": "url",
-                                                        "LATITUDE": 'lat',
-                                                        "LONGITUDE": 'lon'})
-    return home_listings_df
+    return read_store(read_store_version()).listings
+
+
+def read_home_features():
+    """
+    Returns the home feature embeddings of all the listings, in the same order as read_listings()
+    :return: A (number of listings x embedding size) numpy array
+    """
+    return read_store(read_store_version()).features('home_feature')
 
 
-@st.cache
 def read_model():
     """
-    Loads and returns the Keras model to generate feature embeddings
-    :return: Keras model to generate feature embeddings
+    Returns the Keras model to generate feature embeddings. The model is loaded once per server process, or once per
+    worker process if config.WORKER_POOL_SIZE is set.
+    :return: Keras model (or WorkerPool) to generate feature embeddings
+    """
+    if config.WORKER_POOL_SIZE:
+        return model_registry.get_worker_pool()
+    return model_registry.get_feature_model()
+
+
+@st.cache(allow_output_mutation=True)
+def read_embedding_cache():
+    """
+    Returns the cache of upload embeddings, shared by all sessions of the server
+    :return: EmbeddingCache
     """
-    # Load our home-style feature model
-    home_model = load_model(os.path.sep.join([config.MODEL_PATH, config.MODEL_NAME]))
+    return embedding_cache.EmbeddingCache()
 
-    # Get home-style features from the model
-    home_feature_model = Model(inputs=home_model.input,
-                               outputs=home_model.get_layer('dense_4').output)
 
-    return home_feature_model
+@st.cache(allow_output_mutation=True)
+def read_listing_details(version=None):
+    """
+    Formats the details shown for every listing. Only done once per server and store version.
+    :param version: read_store_version()
+    :return: Array with the details html of each listing, in the same order as read_listings()
+    """
+    return str_util.listing_details_html(read_listings())
+
+
+@st.cache(allow_output_mutation=True)
+def read_listing_rows(version=None):
+    """
+    Maps listing IDs (as strings, like the inference server returns them) to their rows in read_listings(). Only
+    listings that have not been removed are included. Only done once per server and store version.
+    :param version: read_store_version()
+    :return: Series of listing ID -> row
+    """
+    store = read_store(version)
+    live_rows = store.live_rows
+    listing_ids = store.listings.index[live_rows].astype(str)
+    # Only the latest row of a listing whose image changed is live. Should a listing have two live rows, use the latest.
+    last = ~listing_ids.duplicated(keep='last')
+    return pd.Series(live_rows[last], index=listing_ids[last])
+
+
+@st.cache(allow_output_mutation=True)
+def read_thumbnail_cache():
+    """
+    Returns the cache of listing thumbnails, shared by all sessions of the server
+    :return: ThumbnailCache
+    """
+    return thumbnails.ThumbnailCache()
 
 
-@st.cache
 def get_features_for_image(image_file_name, home_feature_model):
     """
-    Returns the feature embeddings for an image using the home_feature_model
+    Returns the feature embeddings for an image using the home_feature_model. Embeddings are cached by image
+    content, so uploading the same picture again skips the model.
     :param image_file_name: Image file (in .jpg or other file formats). Can also be IObytes (directly from web)
     :param home_feature_model: Keras model to generate feature embeddings
     :return: feature embeddings for the image
     """
-    image_pil = Image.open(image_file_name)
-    image_pil = image_pil.resize((224, 224))
-    image_array = image.img_to_array(image_pil)
-    image_array = np.expand_dims(image_array - config.IMG_MEAN, axis=0)  # Shape = (1,222,224,3)
-    image_feature = np.ravel(home_feature_model.predict(image_array)).tolist()
-    return image_feature
+    def compute_embedding(image_pil):
+        instrumentation.count('embedding_cache_misses')
+        with instrumentation.timer('predict'):
+            return home_feature_model.predict(preprocessing.preprocess_image(image_pil))
+
+    with instrumentation.timer('decode'):
+        image_pil = preprocessing.open_image(image_file_name)
+    return read_embedding_cache().get_or_compute(image_pil, compute_embedding)
+
+
+@st.cache(allow_output_mutation=True)
+def read_search_engine(metric=config.SIMILARITY_METRIC, version=None):
+    """
+    Builds the similarity search engine over the listing embeddings. Only done once per server, metric and store
+    version, so listings added or removed by a refresh are searched from the next query on.
+    :param metric: One of similarity.METRICS
+    :param version: read_store_version()
+    :return: SimilaritySearch, or IVFIndex/QuantizedSearch/CascadeSearch for large catalogs depending on config.SEARCH_INDEX.
+    MetricSearch for metrics other than cosine similarity.
+    """
+    removed_rows = np.flatnonzero(read_store(version).tombstones)
+    if metric != 'cosine':
+        return similarity.MetricSearch(read_home_features(), metric, removed_rows=removed_rows)
+    return ann_index.build_search_index(read_home_features(), removed_rows=removed_rows)
+
 
 @st.cache
-def get_similarities_with_other_listings(home_img_file, home_feature_model, home_listings_df):
+def read_similarity_slider(metric=config.SIMILARITY_METRIC, version=None):
+    """
+    Returns the threshold slider of a metric. Defaults that depend on the listings are computed once per server,
+    metric and store version.
+    :param metric: One of similarity.METRICS
+    :param version: read_store_version()
+    :return: Tuple of (minimum, maximum, default, step) of the slider
+    """
+    minimum, maximum, default, step = config.SIMILARITY_SLIDERS[metric]
+    if default is None:
+        default = similarity.typical_threshold(read_home_features(), metric)
+    if step is None:
+        # A round step, so that the slider shows a few significant digits of the default
+        step = 10.0 ** np.floor(np.log10(max(default, 1e-12)) - 2)
+    return minimum, maximum, float(np.round(default / step) * step), float(step)
+
+
+@st.cache(allow_output_mutation=True)
+def read_metadata_index(version=None):
+    """
+    Builds the price/beds/baths/zip code/location index over the listings. Only done once per server and store
+    version.
+    :param version: read_store_version()
+    :return: MetadataIndex
     """
-    Returns the similarity of the home image with other home listings
+    return metadata_index.MetadataIndex(read_listings())
+
+
+def find_similar_listings(home_img_file, home_feature_model, similarity_threshold, candidates=None,
+                          metric=config.SIMILARITY_METRIC):
+    """
+    Finds the home listings that are similar to the home image
     :param home_img_file: Image file (in .jpg or other file formats)
     :param home_feature_model: Keras model to generate feature embeddings
-    :param home_listings_df: Homelisting dataframe which includes feature embeddings for the home listings
-    :return: A 1-D numpy array of similarity values
+    :param similarity_threshold: Only listings with a similarity above this threshold are returned
+    :param candidates: Boolean array marking the listings that pass the user's filters, or None for all listings
+    :param metric: One of similarity.METRICS
+    :return: Tuple of (listing indices, similarities), sorted from most to least similar
     """
-    home_embedding = get_features_for_image(home_img_file, home_feature_model)
-    return (np.ravel(cosine_similarity(np.reshape(home_embedding, [1, -1]),
-                               np.vstack(home_listings_df.home_feature))))
+    # The inference server searches with cosine similarity. For other metrics it only computes the embedding.
+    if config.INFERENCE_SERVER_URL and metric == 'cosine':
+        _, listing_ids, similarities = inference_client.find_similar(home_img_file.getvalue(),
+                                                                     threshold=similarity_threshold)
+        # The server may have read another version of the store, so its rows are looked up by listing ID. Listings
+        # that the app's version of the store does not have are dropped.
+        rows = read_listing_rows(read_store_version()).reindex(listing_ids).values
+        known = ~np.isnan(rows)
+        rows, similarities = rows[known].astype(np.int64), similarities[known]
+        if candidates is None:
+            return rows, similarities
+        passed = candidates[rows]
+        return rows[passed], similarities[passed]
+    with instrumentation.timer('embed'):
+        if config.INFERENCE_SERVER_URL:
+            home_embedding = inference_client.embed_image(home_img_file.getvalue())
+        else:
+            home_embedding = get_features_for_image(home_img_file, home_feature_model)
+    search_engine = read_search_engine(metric, read_store_version())
+    instrumentation.observe('candidates_scored', len(search_engine) if candidates is None else int(candidates.sum()))
+    with instrumentation.timer('search'):
+        return metadata_index.filtered_search(search_engine, home_embedding, candidates,
+                                              threshold=similarity_threshold)
 
 
-@st.cache
-def get_home_stats(listings_df):
+@st.cache(allow_output_mutation=True)
+def read_query_result_cache():
     """
-    :param listings_df: Dataframe containing home listings
-    :return: Returns a dictionary with various home stats
+    Returns the caches of per-upload query results and of rendered price histograms, shared by all sessions
+    :return: Tuple of (LRUCache of QueryResults, LRUCache of histogram images)
     """
-    home_stats = {}
-    home_stats['Avg Days on Market'] = listings_df['DAYS ON MARKET'].mean()
-    home_stats['Earliest Year Built'] = listings_df['YEAR BUILT'].min()
-    home_stats['Latest Year Built'] = listings_df['YEAR BUILT'].max()
-    home_stats['Min Price'] = listings_df['PRICE'].min()
-    home_stats['Max Price'] = listings_df['PRICE'].max()
-    return home_stats
+    return (embedding_cache.LRUCache(max_entries=config.QUERY_RESULT_CACHE_ENTRIES, size_of=len),
+            embedding_cache.LRUCache(max_entries=config.QUERY_RESULT_CACHE_ENTRIES, size_of=len))
 
 
-def main():
+def get_query_result(home_img_file, home_feature_model, listing_filter, metric=config.SIMILARITY_METRIC):
+    """
+    Returns all listings similar to the home image, with prefix statistics so that the similarity threshold can be
+    changed without searching again. Only computed once per uploaded image, set of filters and metric.
+    :param home_img_file: Image file (in .jpg or other file formats)
+    :param home_feature_model: Keras model to generate feature embeddings
+    :param listing_filter: ListingFilter with the user's price/beds/baths/zip code filters
+    :param metric: One of similarity.METRICS
+    :return: QueryResult
+    """
+    query_results, _ = read_query_result_cache()
+    version = read_store_version()
+    key = (hashlib.sha1(home_img_file.getvalue()).hexdigest(), listing_filter, metric, version)
+    result = query_results.get(key)
+    instrumentation.count('query_cache_hits' if result is not None else 'query_cache_misses')
+    if result is None:
+        # The slider goes down to 0, so every listing that can ever be shown has a similarity above 0
+        rows, similarities = find_similar_listings(home_img_file, home_feature_model, 0.0,
+                                                   read_metadata_index(version).select(listing_filter), metric)
+        with instrumentation.timer('query_result'):
+            result = query_result.QueryResult(rows, similarities, read_listings())
+        query_results.put(key, result)
+    return result
 
-    similarity_value = st.sidebar.slider('Home Similarity Threshold', 0.0, 1.0, config.SIMILARITY_DEFAULT)
 
-    st.title('HomeSpotter')
-    st.subheader('Curating Home-listings by Visual Style')
-    st.text('\n')
-    st.text('\n')
+def plot_price_histogram(counts, bin_edges):
+    """
+    Draws the price histogram of the similar homes. Images are cached by bin counts.
+    :param counts: Number of similar homes in each price bin
+    :param bin_edges: Edges of the price bins
+    :return: JPEG image as bytes
+    """
+    _, histograms = read_query_result_cache()
+    key = counts.tobytes() + bin_edges.tobytes()
+    histogram = histograms.get(key)
+    instrumentation.count('histogram_cache_hits' if histogram is not None else 'histogram_cache_misses')
+    if histogram is None:
+        histogram = query_result.draw_price_histogram(counts, bin_edges)
+        histograms.put(key, histogram)
+    return histogram
 
-    # Load up the model and listings information at the beginning itself
-    home_model = read_model()
-    home_listings_df = read_listings()
 
-    # User uploads picture
-    uploaded_file = st.file_uploader("Upload Picture of Dream Home", type="jpg")
+def read_listing_filter():
+    """
+    Shows the listing filters in the sidebar
+    :return: ListingFilter with the user's choices
+    """
+    listing_index = read_metadata_index(read_store_version())
+    min_price, max_price = (int(value) for value in listing_index.value_range('PRICE'))
+    price_range = st.sidebar.slider('Price Range', min_price, max_price, (min_price, max_price), step=25000)
+    min_beds = st.sidebar.number_input('Minimum Number of Beds', min_value=0, max_value=10, value=0, step=1)
+    min_baths = st.sidebar.number_input('Minimum Number of Baths', min_value=0.0, max_value=10.0, value=0.0, step=0.5)
+    zip_codes = st.sidebar.multiselect('Zip Codes', listing_index.zip_codes, listing_index.zip_codes)
 
-    if uploaded_file is not None:
+    # Filters that let every listing through are left out, so that they cost nothing
+    return metadata_index.ListingFilter(
+        price=tuple(price_range) if tuple(price_range) != (min_price, max_price) else None,
+        beds=(min_beds, None) if min_beds > 0 else None,
+        baths=(min_baths, None) if min_baths > 0 else None,
+        zip_codes=tuple(zip_codes) if len(zip_codes) < len(listing_index.zip_codes) else None)
 
-        # Get feature embedding for uploaded home with other listings
-        home_similarities = get_similarities_with_other_listings(uploaded_file,
-                                                                 home_model,
-                                                                 home_listings_df)
-
-        # Only show listings with similarity above user-selected threshold
-        filtered_indices = np.ravel(np.argwhere(home_similarities > similarity_value))
-        home_similarities_filtered = home_similarities[filtered_indices]
-        sorted_similarity_arg = np.ravel(np.flip(np.argsort(home_similarities_filtered)))
-        filtered_indices = filtered_indices[sorted_similarity_arg]
-        home_similarities_filtered = home_similarities_filtered[sorted_similarity_arg]
-
-        home_stats = get_home_stats(home_listings_df.iloc[filtered_indices, :])
-        plt.figure()
-        plt.hist(home_listings_df.iloc[filtered_indices, :].loc[:, 'PRICE'].values, 20)
-        plt.title('Price Range of Similar Homes')
-        plt.xlabel('Home Prices')
-        plt.ylabel('Number of Houses')
-        plt.savefig('temp_fig.jpg')
-
-        # Plot the uploaded picture along with some statistics of similar houses
+
+def show_similar_listings(uploaded_file, home_model, home_listings_df, similarity_value, listing_filter,
+                          metric=config.SIMILARITY_METRIC):
+    """
+    Shows the statistics, map and details of the listings similar to an uploaded picture
+    :param uploaded_file: Uploaded image file
+    :param home_model: Keras model to generate feature embeddings (None when an inference server is used)
+    :param home_listings_df: Dataframe with the metadata of the home listings
+    :param similarity_value: Only listings with a similarity above this threshold are shown
+    :param listing_filter: ListingFilter with the user's price/beds/baths/zip code filters
+    :param metric: One of similarity.METRICS
+    """
+    # Only show listings with similarity above user-selected threshold, most similar first. The search is only
+    # run once per upload, moving the slider just looks up the precomputed prefix statistics.
+    home_query_result = get_query_result(uploaded_file, home_model, listing_filter, metric)
+    filtered_indices, home_similarities_filtered = home_query_result.top(similarity_value)
+
+    with instrumentation.timer('stats'):
+        home_stats = home_query_result.stats(similarity_value)
+    with instrumentation.timer('histogram'):
+        price_histogram = plot_price_histogram(*home_query_result.price_histogram(similarity_value))
+
+    # Plot the uploaded picture along with some statistics of similar houses
+    with instrumentation.timer('render_summary'):
         str_util.set_block_container_style()
         with str_util.Grid("1 1 1", color=str_util.COLOR, background_color=str_util.BACKGROUND_COLOR) as grid:
             grid.cell(
@@ -138,33 +303,77 @@ def main():
                 grid_column_end=2,
                 grid_row_start=1,
                 grid_row_end=2,
-            ).image_from_iostream(uploaded_file, image_size=350)
+            ).image_from_src(read_thumbnail_cache().upload_src(uploaded_file.getvalue(), 350), image_size=350)
             grid.cell("b", 2, 4, 1, 2).print_home_stats(home_stats)
-            grid.cell("c", 4, 5, 1, 2).image_from_file('temp_fig.jpg', image_size=350)
+            grid.cell("c", 4, 5, 1, 2).image_from_bytes(price_histogram, image_size=350)
 
-        # Plot a map with the selected home-listings
+    # Plot a map with the selected home-listings
+    with instrumentation.timer('map'):
         st.map(home_listings_df.iloc[filtered_indices, :].loc[:, ['lat', 'lon']])
 
-        # Give details of each selected home-listing
-        for iv, ii in enumerate(filtered_indices):
+    # Give details of the selected home-listings, one page at a time so that the time to the first result does
+    # not depend on how many listings pass the threshold
+    not_same_home = np.abs(home_similarities_filtered - 1.0) > config.SAME_HOME_TOLERANCE
+    listing_rows, listing_similarities = filtered_indices[not_same_home], home_similarities_filtered[not_same_home]
+    num_pages = max(1, int(np.ceil(len(listing_rows) / float(config.RESULTS_PAGE_SIZE))))
+    # The key changes with the number of pages, so a page that no longer exists (e.g. after raising the threshold)
+    # is not kept: the input starts again at the first page
+    page = st.sidebar.number_input('Results Page', min_value=1, max_value=num_pages, value=1, step=1,
+                                   key='results_page_%d' % num_pages)
+    page = min(max(int(page), 1), num_pages)
+    page_start = (page - 1) * config.RESULTS_PAGE_SIZE
+    page_rows = listing_rows[page_start:page_start + config.RESULTS_PAGE_SIZE]
+    st.text('Showing listings %d to %d of %d' % (min(page_start + 1, len(listing_rows)),
+                                                 page_start + len(page_rows), len(listing_rows)))
+    instrumentation.observe('listings_shown', len(page_rows))
 
-            # Remove the same house listing
-            if abs(home_similarities_filtered[iv] - 1.0) <= 1e-10:
-                continue
-            similar_home_index = home_listings_df.index[ii]
-            type(similar_home_index)
-            similar_home_file = os.path.sep.join([config.LISTINGS_PATH, similar_home_index+'.jpg'])
+    with instrumentation.timer('render_listings'):
+        thumbnail_cache = read_thumbnail_cache()
+        thumbnail_cache.refresh()
+        str_util.ListingGrid(color=str_util.COLOR, background_color=str_util.BACKGROUND_COLOR).render(
+            [thumbnail_cache.src(listing_id) for listing_id in home_listings_df.index[page_rows]],
+            read_listing_details(read_store_version())[page_rows],
+            listing_similarities[page_start:page_start + config.RESULTS_PAGE_SIZE])
 
-            with str_util.Grid("1 1 1 1", color=str_util.COLOR, background_color=str_util.BACKGROUND_COLOR) as grid:
-                grid.cell(
-                    class_="a",
-                    grid_column_start=1,
-                    grid_column_end=2,
-                    grid_row_start=1,
-                    grid_row_end=2,
-                ).image_from_file(similar_home_file)
-                grid.cell("b", 2, 4, 1, 2).print_home_details(home_listings_df.iloc[ii, :], home_similarities_filtered[iv])
+
+def main():
+
+    metric = st.sidebar.selectbox('Similarity Metric', similarity.METRICS,
+                                  index=similarity.METRICS.index(config.SIMILARITY_METRIC))
+    # Every metric has its own scale, so its own slider
+    minimum, maximum, default, step = read_similarity_slider(metric, read_store_version())
+    similarity_value = st.sidebar.slider('Home Similarity Threshold', minimum, maximum, default, step=step,
+                                         key='similarity_threshold_' + metric)
+    listing_filter = read_listing_filter()
+    profile_query = instrumentation.is_enabled() and st.sidebar.checkbox('Profile this query', value=False)
+
+    st.title('HomeSpotter')
+    st.subheader('Curating Home-listings by Visual Style')
+    st.text('\n')
+    st.text('\n')
+
+    # Load up the model and listings information at the beginning itself. When an inference server is
+    # configured, the server runs the model instead.
+    with instrumentation.timer('read_model'):
+        home_model = None if config.INFERENCE_SERVER_URL else read_model()
+    with instrumentation.timer('read_listings'):
+        home_listings_df = read_listings()
+
+    # User uploads picture
+    uploaded_file = st.file_uploader("Upload Picture of Dream Home", type="jpg")
+
+    if uploaded_file is not None:
+        with instrumentation.collect() as query_metrics, instrumentation.profile(profile_query) as profile_report:
+            with instrumentation.timer('query'):
+                show_similar_listings(uploaded_file, home_model, home_listings_df, similarity_value, listing_filter,
+                                      metric)
+        if profile_query:
+            st.text(profile_report.getvalue())
+        if config.METRICS_FILE and instrumentation.is_enabled():
+            instrumentation.write_json_line(config.METRICS_FILE, query_metrics,
+                                            upload=hashlib.sha1(uploaded_file.getvalue()).hexdigest()[:10],
+                                            threshold=similarity_value, metric=metric)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,220 @@
+"""
+Packed training images and a tf.data input pipeline that reads them.
+
+Each split is decoded and resized once, and packed in to a shard: a single uint8 .npy file of
+(number of images x IMAGE_SIZE x IMAGE_SIZE x 3) pixels that is memory-mapped when training, plus the labels and a
+header. Epochs then read raw pixels instead of decoding and resizing every JPEG again. Images that cannot be read are
+left out of the shard (pixels, labels and hashes).
+
+make_dataset() shuffles, batches, augments (in parallel, on whole batches) and prefetches with tf.data, so the next
+batches are ready while the model trains on the current one.
+
+Usage (from the visual_home_finder directory) to pack the splits listed in the dataset manifests:
+    python image_shards.py --workers 8
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import preprocessing
+import dataset_manifest
+
+SHARD_VERSION = 2
+
+
+def shard_files(split, shard_path=config.SHARD_PATH):
+    """
+    :return: Tuple of (pixel file, label file, header file) of a split's shard
+    """
+    return tuple(os.path.sep.join([shard_path, split + suffix])
+                 for suffix in ('_images.npy', '_labels.npy', '.json'))
+
+
+def _load_pixels(image_file, out):
+    try:
+        image_pil = preprocessing.open_image(image_file, image_size=out.shape[0]).convert('RGB')
+        out[...] = np.asarray(image_pil.resize((out.shape[1], out.shape[0])))
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def pack_split(split, shard_path=config.SHARD_PATH, image_size=config.IMAGE_SIZE, workers=8):
+    """
+    Packs the images of a split in to a shard. Splits whose images have not changed since they were packed are
+    skipped.
+    :param split: One of dataset_manifest.SPLITS
+    :param shard_path: Directory to write the shard to
+    :param image_size: Size the images are resized to
+    :param workers: Number of threads decoding images
+    :return: Number of images packed (0 if the shard was up to date)
+    """
+    manifest_df = dataset_manifest.read_manifest(split)
+    manifest_df = manifest_df[manifest_df['label'].isin(config.CLASSES)].reset_index(drop=True)
+    pixel_file, label_file, header_file = shard_files(split, shard_path)
+    # The shard is up to date if it was packed from the same manifest, even if some of its images could not be read
+    header = {'version': SHARD_VERSION, 'image_size': image_size, 'classes': list(config.CLASSES),
+              'manifest_hashes': list(manifest_df['hash'])}
+    if os.path.exists(header_file):
+        with open(header_file) as f:
+            old_header = json.load(f)
+        if all(old_header.get(key) == value for key, value in header.items()):
+            return 0
+    if not os.path.exists(shard_path):
+        os.makedirs(shard_path)
+
+    pixels = np.lib.format.open_memmap(pixel_file + '.tmp', mode='w+', dtype=np.uint8,
+                                       shape=(len(manifest_df), image_size, image_size, 3))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        loaded = np.array(list(executor.map(_load_pixels, manifest_df['path'], pixels)), dtype=bool)
+    for image_file in manifest_df['path'][~loaded]:
+        print('File %s could not be read' % image_file)
+    if loaded.all():
+        pixels.flush()
+        del pixels
+    else:
+        # Unreadable images would otherwise be trained on as black images with real labels, so only the images
+        # that were read are copied to the shard
+        packed = np.lib.format.open_memmap(pixel_file + '.packed.tmp', mode='w+', dtype=np.uint8,
+                                           shape=(int(loaded.sum()), image_size, image_size, 3))
+        rows = np.flatnonzero(loaded)
+        for start in range(0, len(rows), 256):
+            packed[start:start + 256] = pixels[rows[start:start + 256]]
+        packed.flush()
+        del packed, pixels
+        os.replace(pixel_file + '.packed.tmp', pixel_file + '.tmp')
+    manifest_df = manifest_df[loaded]
+
+    labels = np.array([config.CLASSES.index(label) for label in manifest_df['label']], dtype=np.int32)
+    np.save(label_file, labels)
+    os.replace(pixel_file + '.tmp', pixel_file)
+    # The header is written last, so a shard with a header is always complete
+    with open(header_file, 'w') as f:
+        json.dump(dict(header, hashes=list(manifest_df['hash']), count=len(manifest_df)), f)
+    return len(manifest_df)
+
+
+class ImageShard:
+    """
+    Memory-mapped pixels and labels of a packed split
+    """
+
+    def __init__(self, split, shard_path=config.SHARD_PATH):
+        pixel_file, label_file, header_file = shard_files(split, shard_path)
+        with open(header_file) as f:
+            self.header = json.load(f)
+        self.images = np.load(pixel_file, mmap_mode='r')
+        self.labels = np.load(label_file)
+        self.classes = self.header['classes']
+
+    def __len__(self):
+        return len(self.labels)
+
+    def batch(self, indices):
+        """
+        :param indices: Indices of the images
+        :return: Tuple of (uint8 images, one-hot float32 labels). The indices are sorted to read the file in order.
+        """
+        indices = np.sort(indices)
+        return np.asarray(self.images[indices]), np.eye(len(self.classes), dtype=np.float32)[self.labels[indices]]
+
+
+def augment_batch(images, zoom_range=0.1, shift_range=0.1, horizontal_flip=True, seed=None):
+    """
+    Randomly zooms, shifts and flips a batch of images, like the ImageDataGenerator used for training (without
+    shear). Runs as a single crop_and_resize over the batch.
+    :param images: (batch x height x width x 3) float32 tensor
+    :param zoom_range: Images are zoomed by a factor between 1 - zoom_range and 1 + zoom_range
+    :param shift_range: Images are shifted by up to this fraction of their size
+    :param horizontal_flip: If True, half of the images are flipped
+    :param seed: Seed of the random transformations
+    :return: Augmented images, same shape as the input
+    """
+    import tensorflow as tf
+
+    # Every op gets its own seed: ops with the same seed draw the same numbers, which would tie zoom, shift and flip
+    seeds = [None] * 3 if seed is None else [seed, seed + 1, seed + 2]
+    batch_size = tf.shape(images)[0]
+    size = 1.0 / tf.random.uniform([batch_size, 1], 1 - zoom_range, 1 + zoom_range, seed=seeds[0])
+    center = 0.5 + tf.random.uniform([batch_size, 2], -shift_range, shift_range, seed=seeds[1])
+    boxes = tf.concat([center - size / 2, center + size / 2], axis=1)
+    if horizontal_flip:
+        # A box with x1 > x2 mirrors the crop horizontally
+        flip = tf.random.uniform([batch_size, 1], seed=seeds[2]) < 0.5
+        boxes = tf.where(flip, tf.gather(boxes, [0, 3, 2, 1], axis=1), boxes)
+    crop_size = tf.shape(images)[1:3]
+    return tf.image.crop_and_resize(images, boxes, tf.range(batch_size), crop_size, method='bilinear')
+
+
+def make_dataset(split, batch_size=32, shuffle=True, augment=False, shard_path=config.SHARD_PATH, seed=13):
+    """
+    Builds a tf.data pipeline over a packed split
+    :param split: One of dataset_manifest.SPLITS
+    :param batch_size: Number of images per batch
+    :param shuffle: If True, the images are reshuffled every epoch
+    :param augment: If True, batches are randomly zoomed, shifted and flipped
+    :param shard_path: Directory with the shards
+    :param seed: Seed for shuffling and augmentation
+    :return: Tuple of (tf.data.Dataset of (mean-subtracted float32 images, one-hot labels) batches, steps per epoch)
+    """
+    import tensorflow as tf
+
+    shard = ImageShard(split, shard_path)
+    image_size = shard.header['image_size']
+    num_classes = len(shard.classes)
+    dataset = tf.data.Dataset.range(len(shard))
+    if shuffle:
+        # Only indices are shuffled, so the shuffle buffer can hold the whole split
+        dataset = dataset.shuffle(len(shard), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+
+    def read_batch(indices):
+        images, labels = tf.numpy_function(shard.batch, [indices], [tf.uint8, tf.float32])
+        images.set_shape([None, image_size, image_size, 3])
+        labels.set_shape([None, num_classes])
+        return images, labels
+
+    def prepare_batch(images, labels):
+        images = tf.cast(images, tf.float32)
+        if augment:
+            images = augment_batch(images, seed=seed)
+        return images - config.IMG_MEAN, labels
+
+    dataset = dataset.map(read_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.map(prepare_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    steps_per_epoch = int(np.ceil(len(shard) / float(batch_size)))
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE), steps_per_epoch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack the training/ validation/ test images in to shards.')
+    parser.add_argument('--output', type=str, default=config.SHARD_PATH, help='shard directory')
+    parser.add_argument('--splits', type=str, nargs='+', default=list(dataset_manifest.SPLITS),
+                        help='splits to pack')
+    parser.add_argument('--workers', type=int, default=8, help='number of image decoding threads')
+    parser.add_argument('--time', action='store_true', help='time one epoch of the training pipeline')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        starting_time = time.time()
+        count = pack_split(split, args.output, workers=args.workers)
+        if count:
+            print("Packed %d '%s' images in %.1f s" % (count, split, time.time() - starting_time))
+        else:
+            print("'%s' shard is up to date" % split)
+
+    if args.time:
+        dataset, steps = make_dataset('training', augment=True, shard_path=args.output)
+        starting_time = time.time()
+        for _ in dataset:
+            pass
+        print("One augmented epoch (%d batches) in %.1f s" % (steps, time.time() - starting_time))
+
+
+if __name__ == "__main__":
+    main()
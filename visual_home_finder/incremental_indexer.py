@@ -0,0 +1,207 @@
+"""
+Incremental re-indexing of the home-listing catalog.
+
+A manifest records, for every listing in the embedding store, the hash of its image, the model that embedded it
+and its row in the store. On each refresh only new listings and listings whose image (or the model) changed are
+embedded. Removed and changed listings are tombstoned, so a daily refresh costs as much as the daily churn instead
+of the whole catalog.
+
+New rows are appended to the store before the manifest is written. If a refresh is interrupted in between, the next
+refresh finds live rows that no manifest entry points to and tombstones them, so they never show up as duplicates;
+their listings are embedded again.
+
+Only the saved IVF index is updated in place (with apply_update()). A running app or inference server notices the
+refresh from embedding_store.store_version() and re-opens the store and rebuilds its search index on the next query:
+it runs in another process, so it has no IndexUpdate to apply.
+
+Usage (from the visual_home_finder directory):
+    python incremental_indexer.py
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import embedding_store
+import embedding_builder
+import thumbnails
+from ann_index import IVFIndex
+from quantization import QuantizedSearch
+from cascade_search import CascadeSearch
+
+# Rows added to and removed from the store by a refresh. Used to update search indexes in place.
+IndexUpdate = collections.namedtuple('IndexUpdate', ['added_rows', 'removed_rows', 'updated_rows'])
+
+
+def image_hash(image_file_name):
+    """
+    Returns the SHA-1 of an image file, or None if the file does not exist
+    """
+    try:
+        with open(image_file_name, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def read_manifest(manifest_file=config.INDEX_MANIFEST):
+    """
+    :param manifest_file: JSON manifest written by refresh_index()
+    :return: Dictionary of listing ID -> {"hash", "model_name", "row"}. Empty if there is no manifest yet.
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, manifest_file=config.INDEX_MANIFEST):
+    # Write to a temporary file first so that an interrupted refresh never leaves a truncated manifest
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def plan_update(manifest, image_hashes, model_name=config.MODEL_NAME):
+    """
+    Compares the current listings with the manifest
+    :param manifest: Dictionary from read_manifest()
+    :param image_hashes: Dictionary of listing ID -> image hash for the current listings (None if no image)
+    :param model_name: Name of the current model
+    :return: Tuple of (IDs to embed, IDs to remove from the store, IDs that are unchanged)
+    """
+    to_embed, to_remove, unchanged = [], [], []
+    for listing_id, hash_value in image_hashes.items():
+        entry = manifest.get(listing_id)
+        if entry is not None and entry['hash'] == hash_value and entry['model_name'] == model_name:
+            unchanged.append(listing_id)
+            continue
+        if entry is not None:
+            to_remove.append(listing_id)
+        if hash_value is not None:
+            to_embed.append(listing_id)
+    to_remove.extend(listing_id for listing_id in manifest if listing_id not in image_hashes)
+    return to_embed, to_remove, unchanged
+
+
+def refresh_index(store_path=config.EMBEDDING_STORE, manifest_file=config.INDEX_MANIFEST,
+                  csv_files=config.LISTING_CSVS, index_file=config.ANN_INDEX_FILE, batch_size=32, workers=4):
+    """
+    Brings the embedding store (and the saved IVF index, if there is one) up to date with the listing CSVs
+    :param store_path: Directory of the embedding store
+    :param manifest_file: JSON manifest of the embedded listings
+    :param csv_files: List of listing CSV files
+    :param index_file: Saved IVF index to update in place
+    :param batch_size: Number of images per forward pass
+    :param workers: Number of threads hashing and decoding images
+    :return: IndexUpdate with the rows that were added, removed and had their metadata updated
+    """
+    listings_df = embedding_builder.read_listing_csvs(csv_files)
+    listings_df = listings_df[~listings_df.index.duplicated(keep='last')]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = executor.map(image_hash, [embedding_builder.listing_image_file(ii) for ii in listings_df.index])
+        image_hashes = dict(zip(listings_df.index, hashes))
+
+    store_exists = os.path.exists(os.path.sep.join([store_path, embedding_store.STORE_HEADER]))
+    manifest = read_manifest(manifest_file) if store_exists else {}
+    if store_exists and (not manifest or embedding_store.EmbeddingStore(store_path).model_name != config.MODEL_NAME):
+        # Without a manifest (e.g. a store converted from the CSV feature file) we cannot tell which rows belong to
+        # which image, and embeddings from different models cannot be mixed in one store, so re-embed everything
+        manifest, store_exists = {}, False
+    if not store_exists and os.path.exists(index_file):
+        # A saved IVF index only matches the store it was built from
+        os.remove(index_file)
+    to_embed, to_remove, unchanged = plan_update(manifest, image_hashes)
+
+    orphaned_rows = np.zeros(0, dtype=np.int64)
+    if store_exists:
+        # Rows appended by an interrupted refresh (before it wrote the manifest) belong to no manifest entry
+        listed_rows = np.array([entry['row'] for entry in manifest.values()], dtype=np.int64)
+        orphaned_rows = np.setdiff1d(embedding_store.EmbeddingStore(store_path).live_rows, listed_rows)
+        if len(orphaned_rows):
+            with embedding_store.EmbeddingStoreWriter(store_path, append=True) as writer:
+                writer.tombstone(orphaned_rows)
+
+    start_count = embedding_store.EmbeddingStore(store_path).count if store_exists else 0
+    if to_embed:
+        embedding_builder.build_embedding_store(store_path, listings_df=listings_df.loc[to_embed],
+                                                batch_size=batch_size, workers=workers, append=store_exists)
+    # Thumbnails are named by image hash, so changed images get new thumbnails and unchanged ones are reused
+    thumbnails.build_thumbnails(to_embed, workers=workers)
+    if not os.path.exists(os.path.sep.join([store_path, embedding_store.STORE_HEADER])):
+        # No store yet and nothing (readable) to embed
+        write_manifest({}, manifest_file)
+        no_rows = np.zeros(0, dtype=np.int64)
+        return IndexUpdate(no_rows, no_rows, no_rows)
+    store = embedding_store.EmbeddingStore(store_path)
+    added_rows = np.arange(start_count, store.count)
+    removed_rows = np.concatenate([orphaned_rows,
+                                   np.array([manifest[ii]['row'] for ii in to_remove], dtype=np.int64)])
+    updated_rows = np.array([manifest[ii]['row'] for ii in unchanged], dtype=np.int64)
+
+    if store_exists:
+        # Tombstone the old rows and refresh prices etc. of the listings whose image did not change
+        with embedding_store.EmbeddingStoreWriter(store_path, append=True) as writer:
+            writer.tombstone(removed_rows)
+            writer.update_listings(updated_rows, listings_df.loc[unchanged])
+
+    for listing_id in to_remove:
+        del manifest[listing_id]
+    for row in added_rows:
+        listing_id = store.listings.index[row]
+        manifest[listing_id] = {'hash': image_hashes[listing_id], 'model_name': config.MODEL_NAME, 'row': int(row)}
+    write_manifest(manifest, manifest_file)
+
+    update = IndexUpdate(added_rows, removed_rows, updated_rows)
+    if store_exists and os.path.exists(index_file):
+        features = store.features('home_feature')
+        try:
+            index = IVFIndex.load(index_file, features[:start_count])
+        except ValueError as e:
+            # The index does not match the store, so it is rebuilt the next time it is needed
+            print('%s Removing it.' % e)
+            os.remove(index_file)
+            return update
+        apply_update(index, features, update)
+        index.save(index_file)
+    return update
+
+
+def apply_update(search_index, listing_embeddings, update):
+    """
+    Updates a SimilaritySearch, IVFIndex, QuantizedSearch or CascadeSearch in place after a refresh, without rebuilding it
+    :param search_index: SimilaritySearch or IVFIndex built before the refresh
+    :param listing_embeddings: Home feature matrix of the refreshed store
+    :param update: IndexUpdate returned by refresh_index()
+    """
+    if len(update.added_rows):
+        new_embeddings = listing_embeddings[update.added_rows[0]:update.added_rows[-1] + 1]
+        if isinstance(search_index, (QuantizedSearch, CascadeSearch)):
+            # Compressed and two-stage indexes re-rank with the full embeddings, so point them at the refreshed store
+            search_index.add(new_embeddings, full_embeddings=listing_embeddings)
+        else:
+            search_index.add(new_embeddings)
+    search_index.remove(update.removed_rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Embed only new or changed home-listings.')
+    parser.add_argument('--store', type=str, default=config.EMBEDDING_STORE, help='embedding store directory')
+    parser.add_argument('--manifest', type=str, default=config.INDEX_MANIFEST, help='manifest file')
+    parser.add_argument('--batch_size', type=int, default=32, help='number of images per forward pass')
+    parser.add_argument('--workers', type=int, default=4, help='number of image hashing/decoding threads')
+    args = parser.parse_args()
+
+    update = refresh_index(args.store, args.manifest, batch_size=args.batch_size, workers=args.workers)
+    print("Added %d listings, removed %d listings, refreshed %d listings" % (len(update.added_rows),
+                                                                          len(update.removed_rows),
+                                                                          len(update.updated_rows)))
+
+
+if __name__ == "__main__":
+    main()
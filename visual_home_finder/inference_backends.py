@@ -0,0 +1,299 @@
+"""
+CPU inference backends for the home feature (dense_4) model.
+
+Besides running the Keras model, the feature model can be exported and run as
+- 'graph': a frozen graph (variables folded in to constants) called as a single graph function, without the per-call
+  overhead of Keras' predict
+- 'tflite_float32', 'tflite_float16', 'tflite_int8': TensorFlow Lite models. float16 stores the weights as float16,
+  int8 quantizes weights and activations after calibrating on images of the validation split. Inputs and outputs
+  stay float32, so all backends are drop-in replacements for each other.
+Every backend has the same predict()/ predict_on_batch() interface as the Keras model. config.FEATURE_BACKEND picks
+the backend used by model_registry.get_feature_model().
+
+Quantized models give slightly different embeddings, so check() compares the top-k neighbours of the listings with
+each backend against the Keras model before a backend is used for serving.
+
+Usage (from the visual_home_finder directory):
+    python inference_backends.py --export graph tflite_float16 tflite_int8
+    python inference_backends.py --check graph tflite_float16 tflite_int8 --num_listings 1000 --k 10
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import preprocessing
+import dataset_manifest
+import embedding_builder
+from search import SimilaritySearch, normalize_rows
+
+BACKENDS = ('keras', 'graph', 'tflite_float32', 'tflite_float16', 'tflite_int8')
+
+
+def backend_file(backend, export_path=config.FEATURE_EXPORT_PATH, model_name=config.MODEL_NAME):
+    """
+    :return: File the feature model is exported to for a backend
+    """
+    name = 'feature_' + os.path.splitext(model_name)[0]
+    if backend == 'graph':
+        return os.path.sep.join([export_path, name + '.pb'])
+    return os.path.sep.join([export_path, '%s_%s.tflite' % (name, backend.split('_')[1])])
+
+
+def calibration_batches(num_images=config.CALIBRATION_IMAGES, split='validation', seed=13):
+    """
+    Yields preprocessed images of a split, one at a time, to calibrate int8 quantization
+    :param num_images: Number of images (picked at random from the split)
+    :param split: One of dataset_manifest.SPLITS
+    :param seed: Seed for picking the images
+    """
+    image_files = dataset_manifest.split_image_paths(split)
+    if not image_files:
+        raise ValueError("No images in the '%s' split to calibrate on" % split)
+    rng = np.random.RandomState(seed)
+    for image_file in rng.choice(image_files, min(num_images, len(image_files)), replace=False):
+        batch, loaded = preprocessing.load_batch([image_file])
+        if loaded.all():
+            yield [batch]
+
+
+def export_graph(feature_model, output_file):
+    """
+    Freezes the feature model in to a graph with the variables folded in to constants
+    :param feature_model: Keras feature model
+    :param output_file: .pb file to write the graph to. The input/output tensor names are written next to it.
+    """
+    import tensorflow as tf
+    from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+    model_function = tf.function(lambda images: feature_model(images, training=False))
+    concrete_function = model_function.get_concrete_function(
+        tf.TensorSpec([None, config.IMAGE_SIZE, config.IMAGE_SIZE, 3], tf.float32))
+    frozen_function = convert_variables_to_constants_v2(concrete_function)
+    tf.io.write_graph(frozen_function.graph.as_graph_def(), os.path.dirname(output_file),
+                      os.path.basename(output_file), as_text=False)
+    with open(output_file + '.json', 'w') as f:
+        json.dump({'inputs': [tensor.name for tensor in frozen_function.inputs],
+                   'outputs': [tensor.name for tensor in frozen_function.outputs]}, f)
+
+
+def export_tflite(feature_model, output_file, quantization='float32',
+                  num_calibration_images=config.CALIBRATION_IMAGES):
+    """
+    Converts the feature model to TensorFlow Lite
+    :param feature_model: Keras feature model
+    :param output_file: .tflite file to write
+    :param quantization: 'float32' (no quantization), 'float16' (float16 weights) or 'int8' (int8 weights and
+    activations, calibrated on the validation split)
+    :param num_calibration_images: Number of validation images used to calibrate int8 quantization
+    """
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(feature_model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: calibration_batches(num_calibration_images)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization != 'float32':
+        raise ValueError("Unknown quantization %s, use 'float32', 'float16' or 'int8'" % quantization)
+    with open(output_file, 'wb') as f:
+        f.write(converter.convert())
+
+
+def export(feature_model, backend, export_path=config.FEATURE_EXPORT_PATH):
+    """
+    Exports the feature model for a backend
+    :return: File the model was exported to
+    """
+    if not os.path.exists(export_path):
+        os.makedirs(export_path)
+    output_file = backend_file(backend, export_path)
+    if backend == 'graph':
+        export_graph(feature_model, output_file)
+    elif backend.startswith('tflite_'):
+        export_tflite(feature_model, output_file, backend.split('_')[1])
+    else:
+        raise ValueError("Cannot export backend %s, use one of %s" % (backend, BACKENDS[1:]))
+    return output_file
+
+
+class GraphModel:
+    """
+    Runs a frozen feature graph
+    """
+
+    def __init__(self, graph_file):
+        import tensorflow as tf
+
+        with open(graph_file + '.json') as f:
+            names = json.load(f)
+        graph_def = tf.compat.v1.GraphDef()
+        with open(graph_file, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        wrapped = tf.compat.v1.wrap_function(lambda: tf.compat.v1.import_graph_def(graph_def, name=''), [])
+        self._function = wrapped.prune(wrapped.graph.get_tensor_by_name(names['inputs'][0]),
+                                       wrapped.graph.get_tensor_by_name(names['outputs'][0]))
+
+    def predict_on_batch(self, batch):
+        return self._function(np.asarray(batch, dtype=np.float32)).numpy()
+
+    predict = predict_on_batch
+
+
+class TFLiteModel:
+    """
+    Runs a TensorFlow Lite feature model. The interpreter is not thread-safe, so calls are serialized.
+    """
+
+    def __init__(self, model_file, num_threads=config.TFLITE_NUM_THREADS):
+        import tensorflow as tf
+
+        self._interpreter = tf.lite.Interpreter(model_path=model_file, num_threads=num_threads)
+        self._input = self._interpreter.get_input_details()[0]['index']
+        self._output = self._interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def predict_on_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        with self._lock:
+            # Tensors are only re-allocated when the batch size changes
+            if len(batch) != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input, batch.shape)
+                self._interpreter.allocate_tensors()
+                self._batch_size = len(batch)
+            self._interpreter.set_tensor(self._input, batch)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output).copy()
+
+    predict = predict_on_batch
+
+
+def load_backend(backend, export_path=config.FEATURE_EXPORT_PATH):
+    """
+    Loads an exported feature model
+    :param backend: One of BACKENDS, except 'keras'
+    :param export_path: Directory the model was exported to
+    :return: Model with predict() and predict_on_batch()
+    """
+    model_file = backend_file(backend, export_path)
+    if not os.path.exists(model_file):
+        raise IOError("%s has not been exported, run: python inference_backends.py --export %s" % (backend, backend))
+    if backend == 'graph':
+        return GraphModel(model_file)
+    return TFLiteModel(model_file)
+
+
+def embed_listings(feature_model, listing_ids, batch_size=32, workers=4):
+    """
+    :return: Tuple of (IDs of the listings whose image could be read, their embeddings)
+    """
+    embedded_ids, embeddings = [], []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_ids, batch in embedding_builder.iter_image_batches(listing_ids, batch_size, executor):
+            embedded_ids.extend(batch_ids)
+            embeddings.append(np.asarray(feature_model.predict_on_batch(batch)))
+    return embedded_ids, np.concatenate(embeddings)
+
+
+def topk_overlap(reference_embeddings, embeddings, k=10, catalog_embeddings=None):
+    """
+    Compares the k most similar listings of every listing with two sets of embeddings
+    :param reference_embeddings: Embeddings of the listings with the reference (Keras) model
+    :param embeddings: Embeddings of the same listings with another backend
+    :param k: Number of neighbours compared (the listing itself is not counted)
+    :param catalog_embeddings: Catalog searched with embeddings. Defaults to embeddings; pass reference_embeddings
+    to measure queries embedded by the backend against a catalog built with the reference model.
+    :return: Array with the share of the reference neighbours found, per listing
+    """
+    if catalog_embeddings is None:
+        catalog_embeddings = embeddings
+    reference_results = SimilaritySearch(reference_embeddings).search_batch(reference_embeddings, k=k + 1)
+    results = SimilaritySearch(catalog_embeddings).search_batch(embeddings, k=k + 1)
+    overlaps = []
+    for row, ((reference_rows, _), (rows, _)) in enumerate(zip(reference_results, results)):
+        reference_rows = set(reference_rows) - {row}
+        rows = set(rows) - {row}
+        overlaps.append(len(reference_rows & rows) / float(len(reference_rows)))
+    return np.array(overlaps)
+
+
+def check(backends, num_listings=1000, k=10, batch_size=32, seed=13):
+    """
+    Embeds a sample of the listings with the Keras model and every backend, and compares their neighbours
+    :param backends: Exported backends to check
+    :param num_listings: Number of listings sampled
+    :param k: Number of neighbours compared
+    :param batch_size: Number of images per forward pass
+    :param seed: Seed for sampling the listings
+    :return: Dictionary of backend -> results
+    """
+    import model_registry
+
+    listing_ids = list(embedding_builder.read_listing_csvs().index)
+    rng = np.random.RandomState(seed)
+    listing_ids = list(rng.choice(listing_ids, min(num_listings, len(listing_ids)), replace=False))
+
+    def timed_embeddings(feature_model):
+        starting_time = time.perf_counter()
+        embedded_ids, embeddings = embed_listings(feature_model, listing_ids, batch_size)
+        return embedded_ids, embeddings, len(embedded_ids) / (time.perf_counter() - starting_time)
+
+    reference_ids, reference_embeddings, reference_speed = timed_embeddings(model_registry.get_model('home_feature'))
+    results = {'keras': {'images_per_sec': reference_speed}}
+    for backend in backends:
+        embedded_ids, embeddings, speed = timed_embeddings(load_backend(backend))
+        if embedded_ids != reference_ids:
+            raise ValueError("%s embedded other listings than the Keras model (%d against %d images read)"
+                             % (backend, len(embedded_ids), len(reference_ids)))
+        cosine = np.sum(normalize_rows(reference_embeddings) * normalize_rows(embeddings), axis=1)
+        self_overlap = topk_overlap(reference_embeddings, embeddings, k)
+        mixed_overlap = topk_overlap(reference_embeddings, embeddings, k, catalog_embeddings=reference_embeddings)
+        results[backend] = {'images_per_sec': speed, 'speedup': speed / reference_speed,
+                            'min_cosine_to_keras': float(cosine.min()),
+                            'top%d_overlap' % k: float(self_overlap.mean()),
+                            'top%d_overlap_worst' % k: float(self_overlap.min()),
+                            'top%d_overlap_keras_catalog' % k: float(mixed_overlap.mean()),
+                            'model_bytes': os.path.getsize(backend_file(backend))}
+    return results
+
+
+def main():
+    import model_registry
+
+    parser = argparse.ArgumentParser(description='Export the feature model to CPU backends and check them.')
+    parser.add_argument('--export', type=str, nargs='*', default=[], choices=BACKENDS[1:], help='backends to export')
+    parser.add_argument('--check', type=str, nargs='*', default=[], choices=BACKENDS[1:],
+                        help='backends to compare with the Keras model')
+    parser.add_argument('--num_listings', type=int, default=1000, help='number of listings to compare on')
+    parser.add_argument('--k', type=int, default=10, help='number of neighbours to compare')
+    parser.add_argument('--min_overlap', type=float, default=0.9,
+                        help='exit with an error if the mean top-k overlap of a backend is below this')
+    args = parser.parse_args()
+
+    for backend in args.export:
+        starting_time = time.time()
+        output_file = export(model_registry.get_model('home_feature'), backend)
+        print("Exported %s to %s in %.1f s" % (backend, output_file, time.time() - starting_time))
+
+    if not args.check:
+        return
+    results = check(args.check, args.num_listings, args.k)
+    print(json.dumps(results, indent=2))
+    failed = [backend for backend in args.check if results[backend]['top%d_overlap' % args.k] < args.min_overlap]
+    if failed:
+        print("Top-%d overlap below %.2f: %s" % (args.k, args.min_overlap, ', '.join(failed)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Client for the HomeSpotter inference server (see inference_server.py). Only needs the standard library and numpy,
+so the Streamlit app does not have to load TensorFlow when it uses the server.
+"""
+
+import json
+import numpy as np
+from urllib.request import Request, urlopen
+from urllib.parse import urlencode
+
+import config
+
+
+def _post(path, image_bytes, params=None, server_url=None, timeout=30):
+    # Looked up on every call, so a server URL set after import (e.g. by the app) is used
+    url = (server_url or config.INFERENCE_SERVER_URL).rstrip('/') + path
+    if params:
+        url += '?' + urlencode(params)
+    request = Request(url, data=image_bytes, headers={'Content-Type': 'application/octet-stream'})
+    with urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode())
+
+
+def embed_image(image_bytes, server_url=None):
+    """
+    Returns the feature embedding of an image
+    :param image_bytes: Contents of an image file
+    :param server_url: Base URL of the inference server. Defaults to config.INFERENCE_SERVER_URL.
+    :return: 1-D float32 numpy array
+    """
+    return np.asarray(_post('/embed', image_bytes, server_url=server_url)['embedding'], dtype=np.float32)
+
+
+def find_similar(image_bytes, threshold=None, k=None, server_url=None):
+    """
+    Finds the listings most similar to an image
+    :param image_bytes: Contents of an image file
+    :param threshold: Only listings with a similarity above the threshold are returned
+    :param k: At most k listings are returned
+    :param server_url: Base URL of the inference server. Defaults to config.INFERENCE_SERVER_URL.
+    :return: Tuple of (listing rows, listing IDs, similarities), sorted from most to least similar. The rows are rows
+    of the server's version of the embedding store, so use the listing IDs to look the listings up.
+    """
+    params = {}
+    if threshold is not None:
+        params['threshold'] = threshold
+    if k is not None:
+        params['k'] = k
+    result = _post('/similar', image_bytes, params=params, server_url=server_url)
+    return (np.asarray(result['rows'], dtype=np.int64), list(result['listing_ids']),
+            np.asarray(result['similarities'], dtype=np.float32))
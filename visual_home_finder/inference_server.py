@@ -0,0 +1,330 @@
+"""
+Headless HTTP/JSON inference server for HomeSpotter.
+
+Endpoints
+- POST /embed: request body is an image file. Returns {"embedding": [...]}
+- POST /similar?threshold=0.75&k=100: request body is an image file. Returns the most similar listings as
+  {"rows": [...], "listing_ids": [...], "similarities": [...]}, most similar first
+- GET /health: Returns {"status": "ok"} and the batching/cache counters
+- GET /metrics: Timers and counters (see instrumentation.py) in the Prometheus text format, if config.INSTRUMENTATION
+  is on
+- GET /thumbnails/<hash>_<size>.jpg: Listing thumbnails built by thumbnails.py. They are named by content hash, so
+  browsers may cache them forever.
+
+Requests from concurrent clients are put in a queue and run through the feature model together, with up to
+max_batch_size images per forward pass. A batch is started as soon as it is full, or max_wait_ms after its first
+request arrived.
+
+When the server is started on an embedding store, the store and search index are re-read whenever the store changes
+(e.g. after incremental_indexer.py refreshed it), so results never include removed listings or miss new ones. Results
+carry listing IDs, which clients should use instead of row numbers: a client may have read another version of the
+store.
+
+Usage (from the visual_home_finder directory):
+    python inference_server.py --port 8502 --max_batch_size 32 --max_wait_ms 5
+    python inference_server.py --workers 4 --intra_op_threads 4 --affinity
+"""
+
+import io
+import os
+import re
+import json
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import config
+import embedding_cache
+import instrumentation
+import preprocessing
+
+
+class MicroBatcher:
+    """
+    Collects images from concurrent requests and runs them through the model in batches. Batches are run on a
+    single thread, or on one thread per model worker process (see worker_pool.py).
+    """
+
+    def __init__(self, predict_batch, max_batch_size=config.SERVER_MAX_BATCH_SIZE,
+                 max_wait_ms=config.SERVER_MAX_WAIT_MS, threads=1):
+        """
+        :param predict_batch: Function that takes a (batch x IMAGE_SIZE x IMAGE_SIZE x 3) array and returns
+        a (batch x embedding size) array
+        :param max_batch_size: Maximum number of images per forward pass
+        :param max_wait_ms: Maximum time the first request of a batch waits for more requests
+        :param threads: Number of batches run at the same time. Only useful if predict_batch can run in parallel.
+        """
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.images = 0
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, image_array):
+        """
+        Queues an image for the next batch
+        :param image_array: Preprocessed (IMAGE_SIZE x IMAGE_SIZE x 3) image
+        :return: Future that resolves to the image's embedding
+        """
+        future = Future()
+        self._queue.put((image_array, future))
+        return future
+
+    def embed(self, image_array):
+        return self.submit(image_array).result()
+
+    def _run(self):
+        while True:
+            requests = [self._queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(requests) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    requests.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            instrumentation.observe('batch_size', len(requests))
+            try:
+                with instrumentation.timer('predict'):
+                    embeddings = np.asarray(self.predict_batch(np.stack([image for image, _ in requests])))
+                embeddings = embeddings.reshape(len(requests), -1)
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+            with self._stats_lock:
+                self.batches += 1
+                self.images += len(requests)
+            for (_, future), embedding in zip(requests, embeddings):
+                future.set_result(embedding)
+
+    def stats(self):
+        return {'batches': self.batches, 'images': self.images,
+                'mean_batch_size': self.images / self.batches if self.batches else 0.0}
+
+
+class InferenceService:
+    """
+    The work behind the HTTP endpoints, independent of HTTP so that it can also be used in-process
+    """
+
+    def __init__(self, batcher, search_index=None, listing_ids=None, cache=None, store_path=None):
+        """
+        :param batcher: MicroBatcher running the feature model
+        :param search_index: SimilaritySearch or IVFIndex over the listings. Needed for find_similar().
+        :param listing_ids: Listing ID of every row of the search index
+        :param cache: EmbeddingCache for repeated images. No caching if None.
+        :param store_path: Embedding store to search. If given, the search index and listing IDs are built from the
+        store, and built again whenever the store changes.
+        """
+        self.batcher = batcher
+        self.cache = cache
+        self.store_path = store_path
+        self.store_version = None
+        # Index and listing IDs are swapped together, so a search never mixes two versions of the store
+        self._index = (search_index, listing_ids)
+        self._reload_lock = threading.Lock()
+        if store_path is not None:
+            self.current_index()
+
+    @property
+    def search_index(self):
+        return self._index[0]
+
+    @property
+    def listing_ids(self):
+        return self._index[1]
+
+    def current_index(self):
+        """
+        :return: Tuple of (search index, listing ID of every row), re-read from the embedding store if it changed
+        """
+        if self.store_path is None:
+            return self._index
+        import ann_index
+        import embedding_store
+
+        version = embedding_store.store_version(self.store_path)
+        if version != self.store_version:
+            with self._reload_lock:
+                if version != self.store_version:
+                    store = embedding_store.EmbeddingStore(self.store_path)
+                    search_index = ann_index.build_search_index(store.features('home_feature'),
+                                                                removed_rows=np.flatnonzero(store.tombstones))
+                    self._index = (search_index, np.asarray(store.listings.index))
+                    self.store_version = version
+        return self._index
+
+    def embed(self, image_bytes):
+        """
+        :param image_bytes: Contents of an image file
+        :return: 1-D float32 embedding of the image
+        """
+        image_pil = preprocessing.open_image(io.BytesIO(image_bytes))
+        if self.cache is None:
+            return self.batcher.embed(preprocessing.preprocess_image(image_pil)[0])
+        return self.cache.get_or_compute(image_pil,
+                                         lambda img: self.batcher.embed(preprocessing.preprocess_image(img)[0]))
+
+    def find_similar(self, image_bytes, threshold=None, k=None):
+        """
+        :param image_bytes: Contents of an image file
+        :param threshold: Only listings with a similarity above the threshold are returned
+        :param k: At most k listings are returned
+        :return: Dictionary with rows, listing_ids and similarities of the similar listings, most similar first
+        """
+        embedding = self.embed(image_bytes)
+        search_index, listing_ids = self.current_index()
+        with instrumentation.timer('search'):
+            rows, similarities = search_index.search(embedding, threshold=threshold, k=k)
+        return {'rows': rows.tolist(),
+                'listing_ids': [str(listing_ids[row]) for row in rows] if listing_ids is not None else [],
+                'similarities': similarities.tolist()}
+
+    def stats(self):
+        stats = {'batcher': self.batcher.stats()}
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+
+# Only plain thumbnail file names are served, so requests cannot reach other files
+THUMBNAIL_ROUTE = re.compile(r'^/thumbnails/([0-9a-f]+_[0-9]+\.jpg)$')
+
+
+def make_handler(service, thumbnail_path=None):
+    """
+    Returns a request handler class bound to an InferenceService
+    :param service: InferenceService to expose
+    :param thumbnail_path: Directory with the listing thumbnails. Thumbnails are not served if None.
+    """
+
+    class InferenceRequestHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _send_thumbnail(self, file_name):
+            try:
+                with open(os.path.sep.join([thumbnail_path, file_name]), 'rb') as f:
+                    payload = f.read()
+            except (IOError, OSError):
+                self._send_json(404, {'error': 'unknown thumbnail %s' % file_name})
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(payload)))
+            self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            thumbnail_match = THUMBNAIL_ROUTE.match(path)
+            if path == '/health':
+                self._send_json(200, dict(status='ok', **service.stats()))
+            elif path == '/metrics':
+                payload = instrumentation.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            elif thumbnail_match is not None and thumbnail_path is not None:
+                self._send_thumbnail(thumbnail_match.group(1))
+            else:
+                self._send_json(404, {'error': 'unknown endpoint %s' % self.path})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            image_bytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                if url.path == '/embed':
+                    self._send_json(200, {'embedding': service.embed(image_bytes).tolist()})
+                elif url.path == '/similar':
+                    threshold = float(params['threshold'][0]) if 'threshold' in params else None
+                    k = int(params['k'][0]) if 'k' in params else None
+                    self._send_json(200, service.find_similar(image_bytes, threshold=threshold, k=k))
+                else:
+                    self._send_json(404, {'error': 'unknown endpoint %s' % url.path})
+            except (IOError, OSError, ValueError) as e:
+                self._send_json(400, {'error': str(e)})
+            except Exception as e:
+                # Anything else is a bug in the server, but the client still gets an answer
+                self._send_json(500, {'error': '%s: %s' % (type(e).__name__, e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return InferenceRequestHandler
+
+
+def make_server(service, host='127.0.0.1', port=config.SERVER_PORT, thumbnail_path=config.THUMBNAIL_PATH):
+    """
+    :param service: InferenceService to expose
+    :param host: Interface to listen on
+    :param port: Port to listen on (0 picks a free port)
+    :param thumbnail_path: Directory with the listing thumbnails to serve. Thumbnails are not served if None.
+    :return: ThreadingHTTPServer. Call serve_forever() to start it.
+    """
+    return ThreadingHTTPServer((host, port), make_handler(service, thumbnail_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HomeSpotter inference server.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='interface to listen on')
+    parser.add_argument('--port', type=int, default=config.SERVER_PORT, help='port to listen on')
+    parser.add_argument('--max_batch_size', type=int, default=config.SERVER_MAX_BATCH_SIZE,
+                        help='maximum number of images per forward pass')
+    parser.add_argument('--max_wait_ms', type=float, default=config.SERVER_MAX_WAIT_MS,
+                        help='maximum time a request waits for a batch to fill up')
+    parser.add_argument('--workers', type=int, default=config.WORKER_POOL_SIZE,
+                        help='number of model worker processes (0 to run the model in the server process)')
+    parser.add_argument('--intra_op_threads', type=int, default=config.WORKER_INTRA_OP_THREADS,
+                        help='intra-op threads per worker process')
+    parser.add_argument('--affinity', action='store_true', default=config.WORKER_CPU_AFFINITY,
+                        help='pin every worker process to its own block of CPUs')
+    parser.add_argument('--instrument', action='store_true', default=config.INSTRUMENTATION,
+                        help='collect timers and counters, served at /metrics')
+    args = parser.parse_args()
+    instrumentation.enable(args.instrument)
+
+    import embedding_store
+    import model_registry
+
+    if args.workers:
+        import worker_pool
+        feature_model = worker_pool.WorkerPool(args.workers, args.intra_op_threads, cpu_affinity=args.affinity,
+                                               max_batch_size=args.max_batch_size)
+    else:
+        feature_model = model_registry.get_feature_model()
+    # Converts the feature CSV if the store has not been built yet
+    embedding_store.open_store()
+    batcher = MicroBatcher(feature_model.predict_on_batch, max_batch_size=args.max_batch_size,
+                           max_wait_ms=args.max_wait_ms, threads=max(1, args.workers))
+    service = InferenceService(batcher, cache=embedding_cache.EmbeddingCache(), store_path=config.EMBEDDING_STORE)
+    server = make_server(service, args.host, args.port)
+    print("Serving on http://%s:%d" % (args.host, server.server_address[1]))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
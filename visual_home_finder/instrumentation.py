@@ -0,0 +1,252 @@
+"""
+Lightweight timers and counters for the query path.
+
+    with instrumentation.timer('search'):
+        ...
+    @instrumentation.timed('render')
+    def render(...): ...
+    instrumentation.count('query_cache_hits')
+    instrumentation.observe('candidates_scored', len(rows))
+
+Instrumentation is off unless config.INSTRUMENTATION is True (or enable() is called). When it is off, timer()
+returns a shared do-nothing context manager and count()/ observe() return straight away, so the calls can stay in
+the hot path. When it is on, every metric keeps a count, a sum, a maximum and (for timers) latency bucket counts,
+which are exported in the Prometheus text format or as JSON lines.
+
+collect() gathers the metrics that one thread records inside a block, e.g. the stage timings of a single query, which
+write_json_line() appends to a JSON lines file, one line per query. The exported totals are not affected.
+
+profile() runs a block under cProfile, e.g. for a single slow query, and returns the hottest functions as text.
+"""
+
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import functools
+
+import config
+
+# Upper bounds (in seconds) of the latency buckets of the timers
+TIMER_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_enabled = config.INSTRUMENTATION
+_lock = threading.Lock()
+_metrics = {}
+# Per-thread dictionary of the metrics recorded inside collect(), None outside it
+_local = threading.local()
+
+
+class _Metric:
+
+    def __init__(self, kind, buckets=None):
+        self.kind = kind
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets) if buckets else None
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        if self.buckets:
+            for ii, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    self.bucket_counts[ii] += 1
+                    break
+
+
+def _record(name, kind, value, buckets=None):
+    with _lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = _Metric(kind, buckets)
+        metric.add(value)
+    collected = getattr(_local, 'metrics', None)
+    if collected is not None:
+        entry = collected.setdefault(name, {'kind': kind, 'count': 0, 'sum': 0.0, 'max': 0.0})
+        entry['count'] += 1
+        entry['sum'] += value
+        entry['max'] = max(entry['max'], value)
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
+
+
+class _Timer:
+    __slots__ = ('name', 'starting_time')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.starting_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _record(self.name, 'timer', time.perf_counter() - self.starting_time, TIMER_BUCKETS)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+    """
+    :param name: Name of the timed stage, e.g. 'search'
+    :return: Context manager that records how long its block takes
+    """
+    return _Timer(name) if _enabled else _NULL_TIMER
+
+
+def timed(name):
+    """
+    Decorator that records how long every call of a function takes
+    :param name: Name of the timed stage
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """
+    Adds to a counter, e.g. count('query_cache_hits')
+    """
+    if _enabled:
+        _record(name, 'counter', value)
+
+
+def observe(name, value):
+    """
+    Records a value of a distribution, e.g. observe('batch_size', len(batch))
+    """
+    if _enabled:
+        _record(name, 'summary', value)
+
+
+def snapshot():
+    """
+    :return: Dictionary of metric name -> {kind, count, sum, max (and buckets for timers)}
+    """
+    with _lock:
+        result = {}
+        for name, metric in _metrics.items():
+            result[name] = {'kind': metric.kind, 'count': metric.count, 'sum': metric.sum, 'max': metric.max}
+            if metric.buckets:
+                result[name]['buckets'] = dict(zip(metric.buckets, metric.bucket_counts))
+        return result
+
+
+def prometheus_text(prefix='homespotter_'):
+    """
+    :return: All metrics in the Prometheus text exposition format. Timers are histograms (in seconds), counters are
+    counters and observed values are summaries.
+    """
+    lines = []
+    for name, metric in sorted(snapshot().items()):
+        full_name = prefix + name
+        if metric['kind'] == 'counter':
+            lines.append('# TYPE %s_total counter' % full_name)
+            lines.append('%s_total %r' % (full_name, metric['sum']))
+            continue
+        if metric['kind'] == 'timer':
+            full_name += '_seconds'
+            lines.append('# TYPE %s histogram' % full_name)
+            cumulative = 0
+            for upper_bound, bucket_count in sorted(metric['buckets'].items()):
+                cumulative += bucket_count
+                lines.append('%s_bucket{le="%r"} %d' % (full_name, upper_bound, cumulative))
+            lines.append('%s_bucket{le="+Inf"} %d' % (full_name, metric['count']))
+        else:
+            lines.append('# TYPE %s summary' % full_name)
+        lines.append('%s_sum %r' % (full_name, metric['sum']))
+        lines.append('%s_count %d' % (full_name, metric['count']))
+    return '\n'.join(lines) + '\n'
+
+
+@contextlib.contextmanager
+def collect():
+    """
+    Collects the metrics recorded by the current thread inside a block, e.g. for one query
+        with instrumentation.collect() as query_metrics:
+            ...
+        instrumentation.write_json_line(file_name, query_metrics, upload=...)
+    Concurrent queries run on other threads, so they do not end up in each other's metrics.
+    :return: Dictionary of metric name -> {kind, count, sum, max}, filled in while the block runs
+    """
+    previous = getattr(_local, 'metrics', None)
+    _local.metrics = {}
+    try:
+        yield _local.metrics
+    finally:
+        _local.metrics = previous
+
+
+def write_json_line(file_name, metrics, **fields):
+    """
+    Appends metrics to a JSON lines file
+    :param file_name: File to append to
+    :param metrics: Metrics of the line, e.g. of a single query from collect()
+    :param fields: Extra fields of the line, e.g. an ID of the query
+    """
+    line = dict(fields, timestamp=time.time(), metrics=metrics)
+    with open(file_name, 'a') as f:
+        f.write(json.dumps(line) + '\n')
+
+
+@contextlib.contextmanager
+def profile(on=True, top=30, sort_by='cumulative'):
+    """
+    Runs a block under cProfile
+        with instrumentation.profile(profile_query) as report:
+            ...
+        print(report.getvalue())
+    :param on: If False, the block runs without profiling and the report stays empty
+    :param top: Number of functions in the report
+    :param sort_by: pstats sort key
+    :return: StringIO that holds the report after the block
+    """
+    report = io.StringIO()
+    if not on:
+        yield report
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield report
+    finally:
+        profiler.disable()
+        pstats.Stats(profiler, stream=report).sort_stats(sort_by).print_stats(top)
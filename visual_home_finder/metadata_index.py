@@ -0,0 +1,164 @@
+"""
+Attribute and location index over the home-listing metadata, for filtered similarity search.
+
+Numeric columns (price, beds, baths) are kept sorted, so a range filter is two binary searches. Zip codes have one
+bitmap each, and listings are bucketed in to a lat/lon grid so that a map area only looks at the cells it covers.
+Filters are combined as boolean bitmaps over the rows of the embedding store.
+
+filtered_search() only scores the listings that pass the filters when they are a small share of the catalog
+(pre-filtering), and otherwise searches the whole catalog and drops the listings that do not pass (post-filtering),
+which is cheaper when most listings pass anyway.
+"""
+
+import collections
+import numpy as np
+
+import config
+import embedding_store
+
+# Columns that can be filtered by range
+RANGE_COLUMNS = ('PRICE', 'BEDS', 'BATHS')
+
+# Filters understood by MetadataIndex.select(). Every filter is optional.
+# - price, beds, baths: (low, high) tuples, inclusive. Either end may be None.
+# - zip_codes: list of zip codes
+# - bounds: (min lat, max lat, min lon, max lon) of a map area
+ListingFilter = collections.namedtuple('ListingFilter', ['price', 'beds', 'baths', 'zip_codes', 'bounds'])
+ListingFilter.__new__.__defaults__ = (None,) * len(ListingFilter._fields)
+
+
+class MetadataIndex:
+    """
+    Sorted columns, zip code bitmaps and a lat/lon grid over the listings
+    """
+
+    def __init__(self, listings_df, grid_degrees=config.GEO_GRID_DEGREES):
+        """
+        :param listings_df: Dataframe of the listings, one row per row of the embedding store
+        :param grid_degrees: Size of the lat/lon grid cells in degrees
+        """
+        self.count = len(listings_df)
+
+        # Sorted values of each range column. NaNs are sorted to the end and never match a range.
+        self._sorted = {}
+        for column in RANGE_COLUMNS:
+            values = listings_df[column].values.astype(np.float64)
+            order = np.argsort(values, kind='stable')
+            self._sorted[column] = (order, values[order], int(np.count_nonzero(~np.isnan(values))))
+
+        zip_codes = embedding_store.zip_code_strings(listings_df['ZIP OR POSTAL CODE']).values
+        self._zip_bitmaps = {zip_code: zip_codes == zip_code for zip_code in np.unique(zip_codes)}
+
+        # Lat/lon grid: cell -> rows of the listings in the cell
+        self.grid_degrees = grid_degrees
+        self._lat = listings_df['lat'].values.astype(np.float64)
+        self._lon = listings_df['lon'].values.astype(np.float64)
+        located = ~(np.isnan(self._lat) | np.isnan(self._lon))
+        self._cells = {}
+        if located.any():
+            located_rows = np.flatnonzero(located)
+            cell_ids = np.stack(self._cell(self._lat[located_rows], self._lon[located_rows]), axis=1)
+            unique_cells, cell_of_row = np.unique(cell_ids, axis=0, return_inverse=True)
+            cell_of_row = cell_of_row.ravel()
+            rows_by_cell = np.split(located_rows[np.argsort(cell_of_row, kind='stable')],
+                                    np.cumsum(np.bincount(cell_of_row))[:-1])
+            self._cells = {tuple(cell_id): rows for cell_id, rows in zip(unique_cells.tolist(), rows_by_cell)}
+
+    def _cell(self, lat, lon):
+        return np.floor(lat / self.grid_degrees).astype(np.int64), np.floor(lon / self.grid_degrees).astype(np.int64)
+
+    @property
+    def zip_codes(self):
+        return sorted(self._zip_bitmaps)
+
+    def value_range(self, column):
+        """
+        :return: Tuple of (smallest, largest) value of a range column
+        """
+        _, sorted_values, valid = self._sorted[column]
+        return sorted_values[0], sorted_values[valid - 1]
+
+    def range_bitmap(self, column, low=None, high=None):
+        """
+        :param column: One of RANGE_COLUMNS
+        :param low: Smallest value that passes, or None
+        :param high: Largest value that passes, or None
+        :return: Boolean array marking the listings with low <= value <= high
+        """
+        order, sorted_values, valid = self._sorted[column]
+        start = 0 if low is None else np.searchsorted(sorted_values[:valid], low, side='left')
+        end = valid if high is None else np.searchsorted(sorted_values[:valid], high, side='right')
+        bitmap = np.zeros(self.count, dtype=bool)
+        bitmap[order[start:end]] = True
+        return bitmap
+
+    def zip_bitmap(self, zip_codes):
+        bitmap = np.zeros(self.count, dtype=bool)
+        for zip_code in zip_codes:
+            if str(zip_code) in self._zip_bitmaps:
+                bitmap |= self._zip_bitmaps[str(zip_code)]
+        return bitmap
+
+    def bounds_bitmap(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        :return: Boolean array marking the listings inside a map area
+        """
+        (min_lat_cell, max_lat_cell), (min_lon_cell, max_lon_cell) = self._cell(np.array([min_lat, max_lat]),
+                                                                                 np.array([min_lon, max_lon]))
+        bitmap = np.zeros(self.count, dtype=bool)
+        if (max_lat_cell - min_lat_cell + 1) * (max_lon_cell - min_lon_cell + 1) > len(self._cells):
+            # The area covers more cells than are occupied, so go through the occupied cells instead
+            cells = [rows for (lat_cell, lon_cell), rows in self._cells.items()
+                     if min_lat_cell <= lat_cell <= max_lat_cell and min_lon_cell <= lon_cell <= max_lon_cell]
+        else:
+            cells = [self._cells[(lat_cell, lon_cell)]
+                     for lat_cell in range(min_lat_cell, max_lat_cell + 1)
+                     for lon_cell in range(min_lon_cell, max_lon_cell + 1) if (lat_cell, lon_cell) in self._cells]
+        if cells:
+            rows = np.concatenate(cells)
+            # Cells on the edge of the area are only partly inside it
+            inside = ((self._lat[rows] >= min_lat) & (self._lat[rows] <= max_lat) &
+                      (self._lon[rows] >= min_lon) & (self._lon[rows] <= max_lon))
+            bitmap[rows[inside]] = True
+        return bitmap
+
+    def select(self, listing_filter):
+        """
+        :param listing_filter: ListingFilter
+        :return: Boolean array marking the listings that pass all filters, or None if there are no filters
+        """
+        bitmaps = []
+        for column, value_range in zip(RANGE_COLUMNS, (listing_filter.price, listing_filter.beds,
+                                                       listing_filter.baths)):
+            if value_range is not None:
+                bitmaps.append(self.range_bitmap(column, *value_range))
+        if listing_filter.zip_codes is not None:
+            bitmaps.append(self.zip_bitmap(listing_filter.zip_codes))
+        if listing_filter.bounds is not None:
+            bitmaps.append(self.bounds_bitmap(*listing_filter.bounds))
+        if not bitmaps:
+            return None
+        return np.logical_and.reduce(bitmaps)
+
+
+def filtered_search(search_index, query_embedding, candidates, threshold=None, k=None,
+                    max_prefilter_fraction=config.PREFILTER_MAX_FRACTION):
+    """
+    Finds the listings most similar to a query among the listings that pass the filters
+    :param search_index: SimilaritySearch or IVFIndex
+    :param query_embedding: Embedding of the query image
+    :param candidates: Boolean array from MetadataIndex.select(), or None to search all listings
+    :param threshold: If given, only listings with a similarity above the threshold are returned
+    :param k: If given, at most k listings are returned
+    :param max_prefilter_fraction: Only score the candidates if they are at most this share of the listings.
+    Otherwise search all listings and filter the results.
+    :return: Tuple of (listing indices, similarities), sorted from most to least similar
+    """
+    if candidates is None:
+        return search_index.search(query_embedding, threshold=threshold, k=k)
+    candidate_rows = np.flatnonzero(candidates)
+    if hasattr(search_index, 'search_rows') and len(candidate_rows) <= max_prefilter_fraction * len(candidates):
+        return search_index.search_rows(query_embedding, candidate_rows, threshold=threshold, k=k)
+    rows, similarities = search_index.search(query_embedding, threshold=threshold)
+    passed = candidates[rows]
+    return rows[passed][:k], similarities[passed][:k]
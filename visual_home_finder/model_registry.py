@@ -0,0 +1,118 @@
+"""
+Process-wide registry of the Keras models. Each model is loaded the first time it is asked for and then shared,
+so a process never loads the same model twice.
+
+The feature model is loaded from a trimmed artifact (only the layers up to dense_4, without optimizer state) when
+it has been exported, which is much quicker to load than the full classifier. With config.FEATURE_BACKEND set to an
+exported backend (see inference_backends.py), the frozen graph or TFLite model is loaded instead.
+
+Usage (from the visual_home_finder directory) to export the trimmed feature model and time the cold start:
+    python model_registry.py --export --time
+"""
+
+import os
+import time
+import argparse
+import threading
+
+import config
+import utilities
+
+_models = {}
+_lock = threading.Lock()
+
+
+def _load_feature_model():
+    if os.path.exists(config.FEATURE_MODEL_FILE):
+        from tensorflow.keras.models import load_model
+        return load_model(config.FEATURE_MODEL_FILE, compile=False)
+    return utilities.home_feature_model()
+
+
+def _backend_loader(backend):
+    def load():
+        import inference_backends
+        return inference_backends.load_backend(backend)
+    return load
+
+
+def _start_worker_pool():
+    import worker_pool
+    return worker_pool.WorkerPool()
+
+
+# Name -> function that loads the model
+MODEL_LOADERS = {
+    'home': utilities.home_model,
+    'home_feature': _load_feature_model,
+    'resnet_feature': utilities.resnet50_feature_model,
+}
+# Exported feature models (see inference_backends.py), e.g. 'home_feature_tflite_int8'
+for _backend in ('graph', 'tflite_float32', 'tflite_float16', 'tflite_int8'):
+    MODEL_LOADERS['home_feature_' + _backend] = _backend_loader(_backend)
+MODEL_LOADERS['home_feature_pool'] = _start_worker_pool
+
+
+def get_model(name):
+    """
+    Returns a model, loading it if this is the first time it is asked for in this process
+    :param name: One of the names in MODEL_LOADERS
+    :return: Keras model
+    """
+    if name not in _models:
+        with _lock:
+            # Check again, another thread may have loaded the model while we were waiting for the lock
+            if name not in _models:
+                _models[name] = MODEL_LOADERS[name]()
+    return _models[name]
+
+
+def get_feature_model(backend=config.FEATURE_BACKEND):
+    """
+    Returns the model that generates home feature (dense_4) embeddings
+    :param backend: 'keras', or an exported backend from inference_backends.BACKENDS
+    :return: Keras model, or an exported model with the same predict()/ predict_on_batch() methods
+    """
+    return get_model('home_feature' if backend == 'keras' else 'home_feature_' + backend)
+
+
+def get_worker_pool():
+    """
+    Returns the pool of config.WORKER_POOL_SIZE processes running the feature model (see worker_pool.py), started
+    the first time it is asked for in this process
+    """
+    return get_model('home_feature_pool')
+
+
+def export_feature_model(output_file=config.FEATURE_MODEL_FILE):
+    """
+    Saves the home feature model (the classifier cut at dense_4) without optimizer state
+    :param output_file: .h5 file to save the trimmed model to
+    """
+    utilities.home_feature_model().save(output_file, include_optimizer=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the trimmed home feature model.')
+    parser.add_argument('--export', action='store_true', help='export the trimmed feature model')
+    parser.add_argument('--output', type=str, default=config.FEATURE_MODEL_FILE, help='trimmed model file')
+    parser.add_argument('--time', action='store_true', help='time loading the feature model and a first prediction')
+    args = parser.parse_args()
+
+    if args.export:
+        export_feature_model(args.output)
+        print("Saved trimmed feature model to %s" % args.output)
+
+    if args.time:
+        import numpy as np
+
+        starting_time = time.time()
+        feature_model = get_feature_model()
+        load_time = time.time() - starting_time
+        feature_model.predict(np.zeros((1, config.IMAGE_SIZE, config.IMAGE_SIZE, 3), dtype=np.float32))
+        print("Loaded feature model in %.2f s, first prediction after %.2f s" % (load_time,
+                                                                                 time.time() - starting_time))
+
+
+if __name__ == "__main__":
+    main()
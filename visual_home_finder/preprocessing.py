@@ -0,0 +1,158 @@
+"""
+Image preprocessing shared by training, the offline embedding builder and serving.
+
+Each image is written straight in to a preallocated float32 batch buffer, and normalization is applied to the whole
+batch with a single in-place operation.
+
+PIL's draft mode lets the JPEG decoder downscale while decoding (by a factor of up to 8) when the image is much larger
+than IMAGE_SIZE. It is off by default: draft decoding gives slightly different pixels than a full decode, and the
+catalog embeddings and the training images were decoded in full, so model inputs (uploads, evaluation, training) are
+decoded the same way. It is used for thumbnails, where only the look matters.
+
+Usage (from the visual_home_finder directory) to benchmark preprocessing speed:
+    python preprocessing.py --batch_size 32 --workers 4
+"""
+
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+import config
+import paths
+
+# 'mean' subtracts config.IMG_MEAN (used by our home models), 'scale' divides by 256 (used by the autoencoder)
+NORMALIZATIONS = ('mean', 'scale', None)
+
+
+def allocate_batch(batch_size, image_size=config.IMAGE_SIZE):
+    """
+    Returns an uninitialized float32 buffer for a batch of images
+    """
+    return np.empty((batch_size, image_size, image_size, 3), dtype=np.float32)
+
+
+def open_image(image_file, draft=False, image_size=config.IMAGE_SIZE):
+    """
+    Opens an image. With draft=True, JPEGs are decoded at a reduced size that is still at least image_size.
+    :param image_file: Image file name, or file-like object (e.g. an upload)
+    :param draft: If True, use reduced-size JPEG decoding
+    :param image_size: Size the image will be resized to
+    :return: PIL image
+    """
+    image_pil = Image.open(image_file)
+    if draft:
+        image_pil.draft('RGB', (image_size, image_size))
+    return image_pil
+
+
+def image_into(image_pil, out):
+    """
+    Resizes an image and writes its RGB pixels in to a slot of a batch buffer. Transparency channels are dropped.
+    :param image_pil: PIL image
+    :param out: (image_size x image_size x 3) float32 array to write to, e.g. batch[ii]
+    """
+    image_pil = image_pil.convert('RGB').resize((out.shape[1], out.shape[0]))
+    out[...] = np.asarray(image_pil)
+
+
+def normalize(batch, normalization='mean'):
+    """
+    Normalizes a batch of images in place
+    :param batch: (batch x image_size x image_size x 3) float32 array
+    :param normalization: One of NORMALIZATIONS
+    :return: The batch
+    """
+    if normalization == 'mean':
+        batch -= config.IMG_MEAN
+    elif normalization == 'scale':
+        batch /= 256
+    elif normalization is not None:
+        raise ValueError("Unknown normalization %s, use one of %s" % (normalization, NORMALIZATIONS))
+    return batch
+
+
+def preprocess_image(image_pil, normalization='mean'):
+    """
+    Preprocesses a single image for the models
+    :param image_pil: PIL image
+    :param normalization: One of NORMALIZATIONS
+    :return: (1 x IMAGE_SIZE x IMAGE_SIZE x 3) float32 array
+    """
+    batch = allocate_batch(1)
+    image_into(image_pil, batch[0])
+    return normalize(batch, normalization)
+
+
+def load_into(image_file, out, draft=False):
+    """
+    Decodes and resizes an image in to a slot of a batch buffer, without normalizing it
+    :param image_file: Image file name, or file-like object
+    :param out: (image_size x image_size x 3) float32 array to write to, e.g. batch[ii]
+    :param draft: If True, use reduced-size JPEG decoding
+    :return: False if the image could not be read
+    """
+    try:
+        image_into(open_image(image_file, draft=draft, image_size=out.shape[0]), out)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def load_batch(image_files, out=None, normalization='mean', executor=None, draft=False):
+    """
+    Decodes, resizes and normalizes a batch of images
+    :param image_files: List of image files (names or file-like objects)
+    :param out: Batch buffer from allocate_batch() with room for at least len(image_files) images. Allocated if None.
+    :param normalization: One of NORMALIZATIONS
+    :param executor: If given, images are decoded in parallel on this executor
+    :param draft: If True, use reduced-size JPEG decoding
+    :return: Tuple of (len(image_files) x IMAGE_SIZE x IMAGE_SIZE x 3 view of the buffer, boolean array that is
+    False for images that could not be read)
+    """
+    if out is None:
+        out = allocate_batch(len(image_files))
+    batch = out[:len(image_files)]
+    if executor is None:
+        loaded = [load_into(image_file, batch[ii], draft) for ii, image_file in enumerate(image_files)]
+    else:
+        loaded = list(executor.map(load_into, image_files, batch, [draft] * len(image_files)))
+    return normalize(batch, normalization), np.asarray(loaded, dtype=bool)
+
+
+def benchmark(image_files, batch_size=32, workers=4, draft=False):
+    """
+    Measures preprocessing throughput
+    :param image_files: List of image files
+    :param batch_size: Number of images per batch
+    :param workers: Number of decoding threads (0 to decode on the calling thread)
+    :param draft: If True, use reduced-size JPEG decoding
+    :return: Images per second
+    """
+    out = allocate_batch(batch_size)
+    starting_time = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for start in range(0, len(image_files), batch_size):
+            load_batch(image_files[start:start + batch_size], out, executor=executor if workers else None,
+                       draft=draft)
+    return len(image_files) / (time.time() - starting_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image preprocessing.')
+    parser.add_argument('--images', type=str, default=config.TEST_PATH, help='directory with images')
+    parser.add_argument('--batch_size', type=int, default=32, help='number of images per batch')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 4], help='numbers of decoding threads')
+    args = parser.parse_args()
+
+    image_files = list(paths.list_images(args.images))
+    for workers in args.workers:
+        for draft in (False, True):
+            print("workers=%-3d draft=%-5s %.1f images/sec" % (workers, draft,
+                                                              benchmark(image_files, args.batch_size, workers,
+                                                                        draft)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+Compressed listing embeddings for the similarity search.
+
+Codecs (all applied to L2-normalized embeddings, so scores approximate cosine similarity)
+- float16: half-precision copy, 2 bytes per dimension
+- int8: per-dimension scalar quantization to 256 levels between the smallest and largest value, 1 byte per dimension
+- pq: product quantization. The embedding is split in to sub-vectors, and each sub-vector is replaced by the index
+  of its nearest of 256 centroids, 1 byte per sub-vector. Queries are scored with asymmetric distance tables:
+  the query is compared exactly with every centroid once, then each listing's score is a sum of table lookups.
+
+QuantizedSearch scores all listings (or only the listings that pass the metadata filters) on the codes and then
+re-ranks the candidates with the float32 embeddings (which can stay memory-mapped in the embedding store), so only the
+codes have to be held in memory. Searches with k re-rank the best max(k, rerank) candidates; searches with only a
+threshold re-rank every listing whose code score is within QUANTIZATION_MARGIN of the threshold, so they return every
+listing above the threshold like exact search does.
+
+Usage (from the visual_home_finder directory) to report recall@k, memory and speed of each codec on the catalog:
+    python quantization.py --k 10 --rerank 100
+"""
+
+import time
+import argparse
+import numpy as np
+
+import config
+import embedding_store
+from search import SimilaritySearch, normalize_rows, top_indices
+
+# Number of rows decoded at a time when scoring, so that the float32 copy stays small
+SCORE_CHUNK = 4096
+
+# Maximum number of embeddings the codecs are fitted on
+MAX_TRAINING = 100000
+
+
+def kmeans(vectors, n_clusters, n_iter=20, seed=13):
+    """
+    Euclidean k-means
+    :param vectors: (N x dim) float32 array
+    :param n_clusters: Number of clusters
+    :param n_iter: Number of iterations
+    :param seed: Seed for picking the initial centroids
+    :return: Tuple of (n_clusters x dim centroids, N cluster assignments)
+    """
+    rng = np.random.RandomState(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = nearest_centroids(vectors, centroids)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        empty = counts == 0
+        # Sum the members of every cluster in one pass over the vectors sorted by cluster
+        order = np.argsort(assignments, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[~empty]
+        centroids[~empty] = np.add.reduceat(vectors[order], starts) / counts[~empty, None]
+        # Re-seed empty clusters with random vectors so that every centroid stays in use
+        centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+    return centroids, nearest_centroids(vectors, centroids)
+
+
+def nearest_centroids(vectors, centroids):
+    # |v - c|^2 = |v|^2 - 2 v.c + |c|^2, and |v|^2 is the same for all centroids
+    return np.argmin((centroids ** 2).sum(axis=1) - 2 * vectors @ centroids.T, axis=1)
+
+
+class Float16Codec:
+    name = 'float16'
+
+    def fit(self, embeddings):
+        return self
+
+    def encode(self, embeddings):
+        return np.asarray(embeddings, dtype=np.float16)
+
+    def scores(self, query, codes):
+        """
+        :param query: Unit-norm float32 query embedding
+        :param codes: Codes from encode()
+        :return: Approximate similarity of the query with every encoded listing
+        """
+        return np.concatenate([codes[start:start + SCORE_CHUNK].astype(np.float32) @ query
+                               for start in range(0, len(codes), SCORE_CHUNK)])
+
+    @property
+    def nbytes(self):
+        return 0
+
+
+class Int8Codec:
+    name = 'int8'
+
+    def fit(self, embeddings):
+        self.offset = embeddings.min(axis=0).astype(np.float32)
+        self.scale = (embeddings.max(axis=0) - self.offset).astype(np.float32) / 255
+        self.scale[self.scale == 0] = 1
+        return self
+
+    def encode(self, embeddings):
+        return np.clip(np.rint((embeddings - self.offset) / self.scale), 0, 255).astype(np.uint8)
+
+    def scores(self, query, codes):
+        # q.x ~= q.(offset + scale * code) = q.offset + (q * scale).code
+        scaled_query = query * self.scale
+        return float(query @ self.offset) + np.concatenate(
+            [codes[start:start + SCORE_CHUNK].astype(np.float32) @ scaled_query
+             for start in range(0, len(codes), SCORE_CHUNK)])
+
+    @property
+    def nbytes(self):
+        return self.offset.nbytes + self.scale.nbytes
+
+
+class PQCodec:
+    name = 'pq'
+
+    def __init__(self, n_subspaces=config.PQ_SUBSPACES, n_centroids=256, max_training=20000, seed=13):
+        """
+        :param n_subspaces: Number of sub-vectors (and bytes) per embedding
+        :param n_centroids: Number of centroids per sub-vector (at most 256)
+        :param max_training: Maximum number of embeddings the centroids are trained on
+        :param seed: Seed for sampling the training embeddings and k-means
+        """
+        self.n_subspaces = n_subspaces
+        self.n_centroids = n_centroids
+        self.max_training = max_training
+        self.seed = seed
+
+    def _split(self, embeddings):
+        # Pad with zeros so that the dimension is a multiple of the number of sub-vectors
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        padding = -embeddings.shape[-1] % self.n_subspaces
+        if padding:
+            embeddings = np.pad(embeddings, [(0, 0)] * (embeddings.ndim - 1) + [(0, padding)])
+        return embeddings.reshape(embeddings.shape[:-1] + (self.n_subspaces, -1))
+
+    def fit(self, embeddings):
+        rng = np.random.RandomState(self.seed)
+        if len(embeddings) > self.max_training:
+            embeddings = embeddings[np.sort(rng.choice(len(embeddings), self.max_training, replace=False))]
+        sub_vectors = self._split(embeddings)
+        n_centroids = min(self.n_centroids, len(embeddings))
+        self.centroids = np.stack([kmeans(sub_vectors[:, ss], n_centroids, seed=self.seed)[0]
+                                   for ss in range(self.n_subspaces)])
+        return self
+
+    def encode(self, embeddings):
+        codes = np.empty((len(embeddings), self.n_subspaces), dtype=np.uint8)
+        for start in range(0, len(embeddings), SCORE_CHUNK):
+            sub_vectors = self._split(embeddings[start:start + SCORE_CHUNK])
+            for ss in range(self.n_subspaces):
+                codes[start:start + SCORE_CHUNK, ss] = nearest_centroids(sub_vectors[:, ss], self.centroids[ss])
+        return codes
+
+    def scores(self, query, codes):
+        # Asymmetric distance table: similarity of each query sub-vector with each centroid of its subspace
+        table = np.einsum('scd,sd->sc', self.centroids, self._split(query))
+        return table[np.arange(self.n_subspaces), codes].sum(axis=1)
+
+    @property
+    def nbytes(self):
+        return self.centroids.nbytes
+
+
+CODECS = {'float16': Float16Codec, 'int8': Int8Codec, 'pq': PQCodec}
+
+
+class QuantizedSearch:
+    """
+    Cosine-similarity search over compressed listing embeddings, with an exact re-rank of the best candidates.
+    Has the same search interface as SimilaritySearch.
+    """
+
+    def __init__(self, listing_embeddings, codec='int8', rerank=config.QUANTIZATION_RERANK, removed_rows=None):
+        """
+        :param listing_embeddings: (N x dim) array of listing embeddings, e.g. memory-mapped from the embedding
+        store. Only the re-ranked rows are read from it.
+        :param codec: One of CODECS, or a codec instance
+        :param rerank: Number of candidates re-ranked with the exact embeddings when searching for the k best listings
+        (at least k are re-ranked)
+        :param removed_rows: Rows of listings that should never be returned (e.g. tombstoned in the store)
+        """
+        self.full_embeddings = listing_embeddings
+        self.rerank = rerank
+        if isinstance(codec, str):
+            training_rows = np.arange(len(listing_embeddings))
+            if len(training_rows) > MAX_TRAINING:
+                training_rows = np.sort(np.random.RandomState(13).choice(training_rows, MAX_TRAINING, replace=False))
+            codec = CODECS[codec]().fit(normalize_rows(listing_embeddings[training_rows]))
+        self.codec = codec
+        # Encode in chunks, so that a normalized float32 copy of the whole catalog is never held in memory
+        self.codes = np.concatenate([codec.encode(normalize_rows(listing_embeddings[start:start + SCORE_CHUNK]))
+                                     for start in range(0, len(listing_embeddings), SCORE_CHUNK)])
+        self.removed = np.zeros(len(self.codes), dtype=bool)
+        if removed_rows is not None:
+            self.removed[removed_rows] = True
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the codes and the codec, i.e. without the (memory-mapped) float32 embeddings
+        """
+        return self.codes.nbytes + self.codec.nbytes + self.removed.nbytes
+
+    def add(self, listing_embeddings, full_embeddings=None):
+        """
+        Appends listings, encoded with the existing codec
+        :param listing_embeddings: (number of new listings x embedding size) array of listing embeddings
+        :param full_embeddings: All listing embeddings including the new ones, e.g. the memory-map of the refreshed
+        store. If None, the new embeddings are appended to an in-memory copy.
+        """
+        new_embeddings = normalize_rows(listing_embeddings)
+        self.codes = np.concatenate([self.codes, self.codec.encode(new_embeddings)])
+        if full_embeddings is None:
+            full_embeddings = np.concatenate([self.full_embeddings, listing_embeddings])
+        self.full_embeddings = full_embeddings
+        self.removed = np.concatenate([self.removed, np.zeros(len(new_embeddings), dtype=bool)])
+
+    def remove(self, rows):
+        self.removed[rows] = True
+
+    def search(self, query_embedding, threshold=None, k=None):
+        """
+        Finds the listings most similar to a single query
+        :param query_embedding: Embedding of the query image
+        :param threshold: If given, only listings with a similarity above the threshold are returned
+        :param k: If given, at most k listings are returned
+        :return: Tuple of (listing indices, similarities), sorted from most to least similar
+        """
+        query = normalize_rows(query_embedding)[0]
+        return self._rerank(query, np.arange(len(self.codes)), self.codec.scores(query, self.codes), threshold, k)
+
+    def search_rows(self, query_embedding, rows, threshold=None, k=None):
+        """
+        Finds the listings most similar to a single query, only scoring the codes of the given rows (e.g. the
+        listings that pass the metadata filters)
+        :param query_embedding: Embedding of the query image
+        :param rows: Rows of the listings to score
+        :param threshold: If given, only listings with a similarity above the threshold are returned
+        :param k: If given, at most k listings are returned
+        :return: Tuple of (listing indices, similarities), sorted from most to least similar
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return rows, np.zeros(0, dtype=np.float32)
+        query = normalize_rows(query_embedding)[0]
+        return self._rerank(query, rows, self.codec.scores(query, self.codes[rows]), threshold, k)
+
+    def _rerank(self, query, rows, scores, threshold, k):
+        scores[self.removed[rows]] = -np.inf
+        # Approximate scores can be off by a little, so keep candidates slightly below the threshold. Without k every
+        # such candidate is re-ranked, so that no listing above the threshold is missed.
+        candidates = top_indices(scores, threshold=-np.inf if threshold is None else threshold -
+                                 config.QUANTIZATION_MARGIN, k=None if k is None else max(k, self.rerank))
+        candidate_rows = np.sort(rows[candidates])
+        exact_scores = self.exact_scores(query, candidate_rows)
+        selected = top_indices(exact_scores, threshold=threshold, k=k)
+        return candidate_rows[selected], exact_scores[selected]
+
+    def exact_scores(self, query, rows):
+        """
+        :param query: Unit-norm float32 query embedding
+        :param rows: Sorted rows of the listings to score
+        :return: Cosine similarity of the query with the float32 embeddings of the rows. The rows are read in chunks,
+        so re-ranking many candidates never holds a large normalized copy.
+        """
+        return np.concatenate([normalize_rows(self.full_embeddings[rows[start:start + SCORE_CHUNK]]) @ query
+                               for start in range(0, len(rows), SCORE_CHUNK)] or [np.zeros(0, dtype=np.float32)])
+
+    def search_batch(self, query_embeddings, threshold=None, k=None):
+        return [self.search(query, threshold=threshold, k=k) for query in normalize_rows(query_embeddings)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report recall@k and memory of the embedding codecs.')
+    parser.add_argument('--store', type=str, default=config.EMBEDDING_STORE, help='embedding store directory')
+    parser.add_argument('--feature', type=str, default='home_feature', help='feature to compress')
+    parser.add_argument('--codecs', type=str, nargs='+', default=list(CODECS), help='codecs to compare')
+    parser.add_argument('--k', type=int, default=10, help='k for recall@k')
+    parser.add_argument('--rerank', type=int, default=config.QUANTIZATION_RERANK,
+                        help='number of candidates re-ranked with float32 embeddings (0 for no re-rank)')
+    parser.add_argument('--num_queries', type=int, default=200, help='number of listings used as queries')
+    args = parser.parse_args()
+
+    from ann_index import recall_at_k
+
+    listing_embeddings = embedding_store.open_store(args.store).features(args.feature)
+    rng = np.random.RandomState(13)
+    queries = np.asarray(listing_embeddings)[rng.choice(len(listing_embeddings),
+                                                        min(args.num_queries, len(listing_embeddings)),
+                                                        replace=False)]
+    exact = SimilaritySearch(listing_embeddings)
+    start = time.time()
+    exact_results = exact.search_batch(queries, k=args.k)
+    print("%-8s %8.2f MB  %.3f ms/query" % ('float32', exact.embeddings.nbytes / 1e6,
+                                           1000 * (time.time() - start) / len(queries)))
+    for codec in args.codecs:
+        start = time.time()
+        index = QuantizedSearch(listing_embeddings, codec, rerank=max(args.rerank, args.k))
+        build_time = time.time() - start
+        start = time.time()
+        results = index.search_batch(queries, k=args.k)
+        query_ms = 1000 * (time.time() - start) / len(queries)
+        # Recall of the codes alone, without the float32 re-rank
+        index.rerank = args.k
+        no_rerank_results = index.search_batch(queries, k=args.k) if args.rerank else results
+        print("%-8s %8.2f MB  %.3f ms/query  recall@%d = %.3f (%.3f without re-rank), built in %.1f s"
+              % (codec, index.nbytes / 1e6, query_ms, args.k, recall_at_k(results, exact_results, args.k),
+                 recall_at_k(no_rerank_results, exact_results, args.k), build_time))
+
+
+if __name__ == "__main__":
+    main()
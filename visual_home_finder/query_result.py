@@ -0,0 +1,128 @@
+"""
+Per-query results that answer threshold changes without re-filtering.
+
+The similar listings of a query are sorted once, from most to least similar. Along that order we keep prefix
+aggregates: running sums for the mean days on market and running min/max of the year built and price. The listings
+above any threshold are a prefix of the sorted order, so moving the similarity slider is a binary search plus
+constant-time lookups. The price histogram keeps only the price bin of each listing (one byte each) and counts the
+bins of the prefix, which is much smaller than cumulative counts per listing and still fast.
+"""
+
+import numpy as np
+
+# Number of bins of the price histogram
+PRICE_BINS = 20
+
+
+def price_bin_edges(listings_df, bins=PRICE_BINS):
+    """
+    Returns fixed histogram bin edges spanning the prices of the whole catalog
+    """
+    prices = listings_df['PRICE'].values.astype(np.float64)
+    return np.linspace(np.nanmin(prices), np.nanmax(prices), bins + 1)
+
+
+def draw_price_histogram(counts, bin_edges):
+    """
+    Draws the price histogram of the similar homes
+    :param counts: Number of similar homes in each price bin, e.g. from QueryResult.price_histogram()
+    :param bin_edges: Edges of the price bins
+    :return: JPEG image as bytes
+    """
+    import io
+    import matplotlib.pyplot as plt
+
+    figure = plt.figure()
+    plt.hist(bin_edges[:-1], bin_edges, weights=counts)
+    plt.title('Price Range of Similar Homes')
+    plt.xlabel('Home Prices')
+    plt.ylabel('Number of Houses')
+    image_bytes = io.BytesIO()
+    plt.savefig(image_bytes, format='jpg')
+    plt.close(figure)
+    return image_bytes.getvalue()
+
+
+def _as_int(value):
+    # Years and prices are whole numbers, keep them as ints so that they print like the dataframe values do
+    return value if np.isnan(value) else int(value)
+
+
+class QueryResult:
+    """
+    The listings similar to one uploaded image, with prefix aggregates for instant threshold changes
+    """
+
+    def __init__(self, rows, similarities, listings_df, bin_edges=None):
+        """
+        :param rows: Rows (in listings_df) of the similar listings
+        :param similarities: Similarity of each of the rows
+        :param listings_df: Dataframe of all home listings
+        :param bin_edges: Price histogram bin edges. Defaults to price_bin_edges(listings_df).
+        """
+        order = np.argsort(-np.asarray(similarities), kind='stable')
+        self.rows = np.asarray(rows)[order]
+        self.similarities = np.asarray(similarities)[order]
+        self.bin_edges = price_bin_edges(listings_df) if bin_edges is None else bin_edges
+
+        similar_df = listings_df.iloc[self.rows]
+        days = similar_df['DAYS ON MARKET'].values.astype(np.float64)
+        years = similar_df['YEAR BUILT'].values.astype(np.float64)
+        prices = similar_df['PRICE'].values.astype(np.float64)
+
+        # Prefix aggregates: entry ii covers the ii+1 most similar listings. NaNs are skipped like pandas does.
+        self._days_sum = np.cumsum(np.nan_to_num(days))
+        self._days_count = np.cumsum(~np.isnan(days))
+        self._year_min = np.fmin.accumulate(years) if len(years) else years
+        self._year_max = np.fmax.accumulate(years) if len(years) else years
+        self._price_min = np.fmin.accumulate(prices) if len(prices) else prices
+        self._price_max = np.fmax.accumulate(prices) if len(prices) else prices
+
+        # Price bin of every listing, in similarity order. Listings without a price go in an extra last bin that
+        # price_histogram() drops.
+        num_bins = len(self.bin_edges) - 1
+        bins = np.clip(np.digitize(prices, self.bin_edges[1:-1]), 0, num_bins - 1)
+        bins[np.isnan(prices)] = num_bins
+        self._price_bins = bins.astype(np.uint8 if num_bins < 255 else np.int32)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def count_above(self, threshold):
+        """
+        Returns the number of listings with a similarity above the threshold
+        """
+        # Similarities are sorted in descending order, so search the negated (ascending) values
+        return int(np.searchsorted(-self.similarities, -threshold, side='left'))
+
+    def top(self, threshold):
+        """
+        :return: Tuple of (rows, similarities) of the listings above the threshold, most similar first
+        """
+        count = self.count_above(threshold)
+        return self.rows[:count], self.similarities[:count]
+
+    def stats(self, threshold):
+        """
+        Returns the same statistics as utilities.get_home_stats() for the listings above the threshold
+        """
+        count = self.count_above(threshold)
+        if count == 0:
+            return {'Avg Days on Market': np.nan, 'Earliest Year Built': np.nan, 'Latest Year Built': np.nan,
+                    'Min Price': np.nan, 'Max Price': np.nan}
+        last = count - 1
+        days_count = self._days_count[last]
+        return {'Avg Days on Market': self._days_sum[last] / days_count if days_count else np.nan,
+                'Earliest Year Built': _as_int(self._year_min[last]),
+                'Latest Year Built': _as_int(self._year_max[last]),
+                'Min Price': _as_int(self._price_min[last]),
+                'Max Price': _as_int(self._price_max[last])}
+
+    def price_histogram(self, threshold):
+        """
+        :return: Tuple of (counts per bin, bin edges) of the prices of the listings above the threshold
+        """
+        count = self.count_above(threshold)
+        num_bins = len(self.bin_edges) - 1
+        counts = np.bincount(self._price_bins[:count], minlength=num_bins + 1)[:num_bins]
+        return counts.astype(np.int32), self.bin_edges
@@ -0,0 +1,125 @@
+"""
+Vectorized cosine-similarity search over the home-listing embeddings
+"""
+
+import numpy as np
+
+
+def normalize_rows(matrix):
+    """
+    Returns an L2-normalized, contiguous float32 copy of a matrix. Rows with zero norm are left as zeros.
+    :param matrix: 2-D array of embeddings (one row per embedding)
+    :return: 2-D float32 numpy array with unit-norm rows
+    """
+    matrix = np.array(matrix, dtype=np.float32, order='C', ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+    return matrix
+
+
+def top_indices(scores, threshold=None, k=None):
+    """
+    Returns the indices of the highest scores, sorted from highest to lowest score
+    :param scores: 1-D array of scores
+    :param threshold: If given, only scores above the threshold are returned
+    :param k: If given, at most k indices are returned
+    :return: 1-D numpy array of indices in to scores
+    """
+    if threshold is not None:
+        candidates = np.flatnonzero(scores > threshold)
+    else:
+        candidates = np.arange(len(scores))
+    if k is not None and k < len(candidates):
+        # argpartition only puts the k best scores at the front, so only those k need sorting
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+class SimilaritySearch:
+    """
+    Exact cosine-similarity search. The listing embeddings are normalized once, so each query is a single
+    matrix-vector (or matrix-matrix for a batch of queries) product.
+    """
+
+    def __init__(self, listing_embeddings, removed_rows=None):
+        """
+        :param listing_embeddings: (number of listings x embedding size) array of listing embeddings
+        :param removed_rows: Rows of listings that should never be returned (e.g. tombstoned in the store)
+        """
+        self.embeddings = normalize_rows(listing_embeddings)
+        self.removed = np.zeros(len(self.embeddings), dtype=bool)
+        if removed_rows is not None:
+            self.removed[removed_rows] = True
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    def add(self, listing_embeddings):
+        """
+        Appends listings. They get the next row numbers, matching rows appended to the embedding store.
+        :param listing_embeddings: (number of new listings x embedding size) array of listing embeddings
+        """
+        new_embeddings = normalize_rows(listing_embeddings)
+        self.embeddings = np.concatenate([self.embeddings, new_embeddings])
+        self.removed = np.concatenate([self.removed, np.zeros(len(new_embeddings), dtype=bool)])
+
+    def remove(self, rows):
+        """
+        Stops returning listings in search results
+        :param rows: Rows of the listings to remove
+        """
+        self.removed[rows] = True
+
+    def similarities(self, query_embeddings):
+        """
+        Returns the cosine similarity of the queries with every listing
+        :param query_embeddings: A single embedding, or a (number of queries x embedding size) array
+        :return: (number of queries x number of listings) array of similarities
+        """
+        return normalize_rows(query_embeddings) @ self.embeddings.T
+
+    def search(self, query_embedding, threshold=None, k=None):
+        """
+        Finds the listings most similar to a single query
+        :param query_embedding: Embedding of the query image
+        :param threshold: If given, only listings with a similarity above the threshold are returned
+        :param k: If given, at most k listings are returned
+        :return: Tuple of (listing indices, similarities), sorted from most to least similar
+        """
+        return self.search_batch(query_embedding, threshold=threshold, k=k)[0]
+
+    def search_rows(self, query_embedding, rows, threshold=None, k=None):
+        """
+        Finds the listings most similar to a single query, only scoring the given rows (e.g. the listings that
+        pass the metadata filters)
+        :param query_embedding: Embedding of the query image
+        :param rows: Rows of the listings to score
+        :param threshold: If given, only listings with a similarity above the threshold are returned
+        :param k: If given, at most k listings are returned
+        :return: Tuple of (listing indices, similarities), sorted from most to least similar
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        scores = self.embeddings[rows] @ normalize_rows(query_embedding)[0]
+        scores[self.removed[rows]] = -np.inf
+        indices = top_indices(scores, threshold=-np.inf if threshold is None else threshold, k=k)
+        return rows[indices], scores[indices]
+
+    def search_batch(self, query_embeddings, threshold=None, k=None):
+        """
+        Finds the listings most similar to each of a batch of queries
+        :param query_embeddings: (number of queries x embedding size) array of query embeddings
+        :param threshold: If given, only listings with a similarity above the threshold are returned
+        :param k: If given, at most k listings are returned per query
+        :return: List with one (listing indices, similarities) tuple per query
+        """
+        has_removed = self.removed.any()
+        if has_removed and threshold is None:
+            threshold = -np.inf
+        results = []
+        for scores in self.similarities(query_embeddings):
+            if has_removed:
+                scores[self.removed] = -np.inf
+            indices = top_indices(scores, threshold=threshold, k=k)
+            results.append((indices, scores[indices]))
+        return results
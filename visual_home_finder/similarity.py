@@ -0,0 +1,209 @@
+"""
+Similarity metrics between home embeddings, computed for a batch of queries against the whole listing matrix.
+
+- 'cosine': cosine similarity
+- 'euclidean': 1 / (1 + euclidean distance), computed in float64 (the expanded form |q|^2 + |x|^2 - 2 q.x cancels
+  badly in float32, so a listing's similarity with itself would be far from 1)
+- 'pearson': Pearson correlation, i.e. the cosine similarity of the embeddings after subtracting each embedding's mean
+- 'spearman': Spearman rank correlation, i.e. the Pearson correlation of the ranks of the values in each embedding
+
+Everything that only depends on the listings (normalized rows, centred rows, ranks, squared norms) is computed once,
+so scoring a batch of queries is a single matrix product plus an element-wise step, with no Python loop over
+listings. MetricSearch has the same interface as SimilaritySearch, so the app can switch metrics.
+
+The metrics have different scales (euclidean similarities depend on the size of the embeddings), so every metric has
+its own threshold slider in config.SIMILARITY_SLIDERS. Metrics without a fixed default threshold use
+typical_threshold(), the similarity that a typical listing's RESULTS_PAGE_SIZE-th most similar listing has.
+
+Usage (from the visual_home_finder directory) to compare the metrics on the listing embeddings:
+    python similarity.py --num_queries 100 --k 20
+"""
+
+import time
+import argparse
+import numpy as np
+
+import config
+from search import SimilaritySearch, normalize_rows, top_indices
+
+METRICS = ('cosine', 'euclidean', 'pearson', 'spearman')
+
+
+def rank_rows(matrix):
+    """
+    Ranks the values in each row, giving tied values their average rank (like scipy.stats.rankdata)
+    :param matrix: 2-D array
+    :return: float32 array of ranks (starting at 1), same shape as matrix
+    """
+    matrix = np.atleast_2d(matrix)
+    num_rows, num_columns = matrix.shape
+    order = np.argsort(matrix, axis=1, kind='stable')
+    sorted_values = np.take_along_axis(matrix, order, axis=1)
+    # Number the runs of tied values, starting a new run at the start of every row
+    new_run = np.ones((num_rows, num_columns), dtype=bool)
+    new_run[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    run_ids = np.cumsum(new_run.ravel()) - 1
+    positions = np.tile(np.arange(1, num_columns + 1, dtype=np.float64), num_rows)
+    average_ranks = np.bincount(run_ids, weights=positions) / np.bincount(run_ids)
+    ranks = np.empty((num_rows, num_columns), dtype=np.float32)
+    np.put_along_axis(ranks, order, average_ranks[run_ids].reshape(num_rows, num_columns), axis=1)
+    return ranks
+
+
+def _centred_unit_rows(matrix):
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    return normalize_rows(matrix - matrix.mean(axis=1, keepdims=True))
+
+
+def prepare_listings(listing_embeddings, metric='cosine'):
+    """
+    Transforms the listing embeddings once, so that every metric is a matrix product with the prepared queries
+    :param listing_embeddings: (number of listings x embedding size) array
+    :param metric: One of METRICS
+    :return: Prepared (number of listings x size) float32 array (float64 for euclidean)
+    """
+    listing_embeddings = np.atleast_2d(np.asarray(listing_embeddings, dtype=np.float32))
+    if metric == 'cosine':
+        return normalize_rows(listing_embeddings)
+    if metric == 'pearson':
+        return _centred_unit_rows(listing_embeddings)
+    if metric == 'spearman':
+        return _centred_unit_rows(rank_rows(listing_embeddings))
+    if metric == 'euclidean':
+        # [x, |x|^2], so that [-2q, 1] . [x, |x|^2] = |x|^2 - 2 q.x = |q - x|^2 - |q|^2
+        listing_embeddings = listing_embeddings.astype(np.float64)
+        squared_norms = np.einsum('ij,ij->i', listing_embeddings, listing_embeddings)
+        return np.hstack([listing_embeddings, squared_norms[:, None]])
+    raise ValueError("Unknown metric %s, use one of %s" % (metric, METRICS))
+
+
+def prepare_queries(query_embeddings, metric='cosine'):
+    """
+    :param query_embeddings: A single embedding, or a (number of queries x embedding size) array
+    :param metric: One of METRICS
+    :return: Tuple of (prepared queries, per-query offset that is added to the products, or None)
+    """
+    query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+    if metric == 'euclidean':
+        query_embeddings = query_embeddings.astype(np.float64)
+        squared_norms = np.einsum('ij,ij->i', query_embeddings, query_embeddings)
+        ones = np.ones((len(query_embeddings), 1), dtype=np.float64)
+        return np.hstack([-2 * query_embeddings, ones]), squared_norms
+    return prepare_listings(query_embeddings, metric), None
+
+
+def to_similarity(products, offsets, metric='cosine'):
+    """
+    Turns the products of prepared queries and listings in to similarities
+    :param products: (number of queries x number of listings) array, or 1-D for a single query
+    :param offsets: Offsets from prepare_queries()
+    :param metric: One of METRICS
+    """
+    if metric != 'euclidean':
+        return products
+    offsets = offsets[:, None] if products.ndim == 2 else offsets[0]
+    squared_distances = products + offsets
+    # Rounding errors of the expanded form grow with the squared norms, so distances that small are a listing with
+    # itself (or an identical embedding)
+    squared_distances = np.where(squared_distances > 1e-12 * offsets, squared_distances, 0.0)
+    return 1.0 / (1.0 + np.sqrt(squared_distances))
+
+
+def similarities(query_embeddings, listing_embeddings, metric='cosine'):
+    """
+    :param query_embeddings: A single embedding, or a (number of queries x embedding size) array
+    :param listing_embeddings: (number of listings x embedding size) array
+    :param metric: One of METRICS
+    :return: (number of queries x number of listings) array of similarities
+    """
+    queries, offsets = prepare_queries(query_embeddings, metric)
+    return to_similarity(queries @ prepare_listings(listing_embeddings, metric).T, offsets, metric)
+
+
+def typical_threshold(listing_embeddings, metric='cosine', rank=config.RESULTS_PAGE_SIZE, num_queries=100):
+    """
+    Threshold at which a typical listing has about rank similar listings: the median, over a sample of listings used
+    as queries, of the similarity of their rank-th most similar other listing
+    :param listing_embeddings: (number of listings x embedding size) array
+    :param metric: One of METRICS
+    :param rank: Number of similar listings a typical query should show
+    :param num_queries: Number of listings used as queries
+    :return: Similarity threshold
+    """
+    listing_embeddings = np.atleast_2d(np.asarray(listing_embeddings))
+    if len(listing_embeddings) < 2:
+        return 0.0
+    rank = min(rank, len(listing_embeddings) - 1)
+    rng = np.random.RandomState(13)
+    rows = rng.choice(len(listing_embeddings), min(num_queries, len(listing_embeddings)), replace=False)
+    scores = similarities(listing_embeddings[rows], listing_embeddings, metric)
+    # Index rank (not rank - 1) skips the query listing itself, which is the most similar
+    kth_scores = -np.partition(-scores, rank, axis=1)[:, rank]
+    return float(np.median(kth_scores))
+
+
+class MetricSearch(SimilaritySearch):
+    """
+    Exact search with any of METRICS. The listings are prepared once, so every query batch is one matrix product.
+    """
+
+    def __init__(self, listing_embeddings, metric=config.SIMILARITY_METRIC, removed_rows=None):
+        """
+        :param listing_embeddings: (number of listings x embedding size) array of listing embeddings
+        :param metric: One of METRICS
+        :param removed_rows: Rows of listings that should never be returned (e.g. tombstoned in the store)
+        """
+        if metric not in METRICS:
+            raise ValueError("Unknown metric %s, use one of %s" % (metric, METRICS))
+        self.metric = metric
+        self.embeddings = prepare_listings(listing_embeddings, metric)
+        self.removed = np.zeros(len(self.embeddings), dtype=bool)
+        if removed_rows is not None:
+            self.removed[removed_rows] = True
+
+    def add(self, listing_embeddings):
+        new_embeddings = prepare_listings(listing_embeddings, self.metric)
+        self.embeddings = np.concatenate([self.embeddings, new_embeddings])
+        self.removed = np.concatenate([self.removed, np.zeros(len(new_embeddings), dtype=bool)])
+
+    def similarities(self, query_embeddings):
+        queries, offsets = prepare_queries(query_embeddings, self.metric)
+        return to_similarity(queries @ self.embeddings.T, offsets, self.metric)
+
+    def search_rows(self, query_embedding, rows, threshold=None, k=None):
+        rows = np.asarray(rows, dtype=np.int64)
+        queries, offsets = prepare_queries(query_embedding, self.metric)
+        scores = to_similarity(self.embeddings[rows] @ queries[0], offsets, self.metric)
+        scores[self.removed[rows]] = -np.inf
+        indices = top_indices(scores, threshold=-np.inf if threshold is None else threshold, k=k)
+        return rows[indices], scores[indices]
+
+
+def main():
+    import embedding_store
+
+    parser = argparse.ArgumentParser(description='Compare the similarity metrics on the listing embeddings.')
+    parser.add_argument('--num_queries', type=int, default=100, help='number of listings used as queries')
+    parser.add_argument('--k', type=int, default=20, help='number of neighbours compared between metrics')
+    args = parser.parse_args()
+
+    listing_embeddings = np.asarray(embedding_store.open_store().features('home_feature'))
+    rng = np.random.RandomState(13)
+    queries = listing_embeddings[rng.choice(len(listing_embeddings), min(args.num_queries, len(listing_embeddings)),
+                                            replace=False)]
+    neighbours = {}
+    for metric in METRICS:
+        starting_time = time.perf_counter()
+        search_index = MetricSearch(listing_embeddings, metric)
+        build_time = time.perf_counter() - starting_time
+        starting_time = time.perf_counter()
+        neighbours[metric] = [set(rows) for rows, _ in search_index.search_batch(queries, k=args.k)]
+        print("%-9s prepared in %.3f s, %.2f ms per query" % (metric, build_time, 1000 * (time.perf_counter() -
+                                                                                      starting_time) / len(queries)))
+    for metric in METRICS[1:]:
+        overlap = np.mean([len(a & b) / float(args.k) for a, b in zip(neighbours['cosine'], neighbours[metric])])
+        print("top-%d overlap of %s with cosine: %.3f" % (args.k, metric, overlap))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ master/gallery/layout_experiments/app.py
 """
 
 import streamlit as st
+import numpy as np
 import pandas as pd
 from typing import List, Optional
 import markdown
@@ -11,6 +12,7 @@ import io
 import matplotlib.pyplot as plt
 from pathlib import Path
 import base64
+import html
 
 
 COLOR = "white"
@@ -57,13 +59,21 @@ class Cell:
         self.inner_html = markdown.markdown(image_html)
 
     def image_from_file(self, image_filename, image_size=224):
-        byte_str = Path(image_filename).read_bytes()
+        self.image_from_bytes(Path(image_filename).read_bytes(), image_size=image_size)
+
+    def image_from_bytes(self, byte_str, image_size=224):
         encoded = base64.b64encode(byte_str).decode()
         image_html = "<img height='{}' width='{}' src='data:image/png;base64,{}'>".format(image_size,
                                                                                            image_size,
                                                                                            encoded)
         self.inner_html = markdown.markdown(image_html)
 
+    def image_from_src(self, src, image_size=224):
+        """
+        Shows an image from a URL or data URI, e.g. a thumbnail from thumbnails.ThumbnailCache
+        """
+        self.inner_html = "<img height='{}' width='{}' src='{}'>".format(image_size, image_size, src)
+
     def print_home_stats(self, home_stats):
         print_str = """##Statistics for Similar Homes   \n"""
         print_str += 'Average days on the market: %.1f    \n'% home_stats['Avg Days on Market']
@@ -180,6 +190,80 @@ class Grid:
         self.cells.append(cell)
         return cell
 
+def listing_details_html(listings_df):
+    """
+    Formats the details of every listing once, so that result pages only have to look them up
+    :param listings_df: Dataframe of all home listings
+    :return: Array with the details html of each listing (without the similarity score), in the same order
+    """
+    details = []
+    for price, beds, baths, url in zip(listings_df['PRICE'], listings_df['BEDS'], listings_df['BATHS'],
+                                       listings_df['url']):
+        url = html.escape(str(url), quote=True)
+        details.append('Price: ${:,}<br />\nNumber of Beds: {}<br />\nNumber of Baths: {}<br />\n'
+                       'URL: <a href="{}">{}</a><br />\n'.format(price, beds, baths, url, url))
+    return np.asarray(details, dtype=object)
+
+
+class ListingGrid:
+    """
+    Renders a page of home listings (thumbnail + details) as a single CSS grid. The style is emitted once per page
+    instead of once per listing.
+    """
+
+    def __init__(self, template_columns="1 1 1 1", gap="5px", background_color=COLOR, color=BACKGROUND_COLOR):
+        self.template_columns = template_columns
+        self.gap = gap
+        self.background_color = background_color
+        self.color = color
+
+    def style(self):
+        return f"""
+<style>
+    .listing-wrapper {{
+    display: grid;
+    grid-template-columns: {self.template_columns};
+    grid-gap: {self.gap};
+    background-color: {self.background_color};
+    color: {self.color};
+    }}
+    .listing-box {{
+    background-color: {self.color};
+    color: {self.background_color};
+    border-radius: 5px;
+    padding: 20px;
+    font-size: 150%;
+    }}
+    .listing-image {{
+    grid-column-start: 1;
+    grid-column-end: 2;
+    }}
+    .listing-details {{
+    grid-column-start: 2;
+    grid-column-end: 4;
+    }}
+</style>
+"""
+
+    def html(self, image_srcs, details, similarities, image_size=224):
+        """
+        :param image_srcs: URL or data URI of the image of each listing on the page
+        :param details: Details html of each listing from listing_details_html()
+        :param similarities: Similarity score of each listing
+        :param image_size: Size the images are displayed at
+        :return: Html of the whole page
+        """
+        boxes = []
+        for src, listing_details, similarity in zip(image_srcs, details, similarities):
+            boxes.append("<div class='listing-box listing-image'><img height='%d' width='%d' src='%s'></div>"
+                         "<div class='listing-box listing-details'><p>%sSimilarity Score is: %.3f</p></div>"
+                         % (image_size, image_size, src, listing_details, similarity))
+        return "<div class='listing-wrapper'>" + "\n".join(boxes) + "</div>"
+
+    def render(self, image_srcs, details, similarities, image_size=224):
+        st.markdown(self.style() + self.html(image_srcs, details, similarities, image_size), unsafe_allow_html=True)
+
+
 def set_block_container_style(
     max_width: int = 1200,
     max_width_100_percent: bool = True,
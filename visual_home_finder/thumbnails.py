@@ -0,0 +1,222 @@
+"""
+Thumbnails of the listing images for the result pages.
+
+At index time every listing image is resized to each of config.THUMBNAIL_SIZES and saved as a small JPEG named by
+the hash of the original image (<hash>_<size>.jpg), so thumbnails never go stale and can be cached forever by
+browsers. thumbnails.json maps each listing ID to the hash of its image.
+
+When rendering, ThumbnailCache returns an <img> src for a listing: a URL under config.THUMBNAIL_URL if the
+thumbnail directory is served over HTTP (e.g. by the inference server), or else a base64 data URI that is kept in
+a bounded in-memory cache, so the disk is only read the first time a thumbnail is shown. The cache is keyed by the
+image hash, and refresh() re-reads thumbnails.json when it changes, so a listing whose image was replaced (e.g. by
+incremental_indexer.py) shows its new thumbnail.
+
+Usage (from the visual_home_finder directory) to build the thumbnails of all listings:
+    python thumbnails.py --workers 8
+"""
+
+import os
+import io
+import json
+import base64
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import preprocessing
+import embedding_builder
+from embedding_cache import LRUCache
+
+THUMBNAIL_INDEX = 'thumbnails.json'
+
+
+def thumbnail_name(content_hash, size):
+    return '%s_%d.jpg' % (content_hash, size)
+
+
+def choose_size(image_size, sizes=config.THUMBNAIL_SIZES):
+    """
+    Returns the smallest thumbnail size that is at least image_size (or the largest size if none is)
+    """
+    larger_sizes = [size for size in sizes if size >= image_size]
+    return min(larger_sizes) if larger_sizes else max(sizes)
+
+
+def make_thumbnails(image_file, sizes=config.THUMBNAIL_SIZES, quality=config.THUMBNAIL_QUALITY):
+    """
+    Resizes an image to every thumbnail size. Each size is resized from the next larger one.
+    :param image_file: Image file name, or file-like object
+    :param sizes: Thumbnail sizes in pixels
+    :param quality: JPEG quality
+    :return: Dictionary of size -> JPEG bytes
+    """
+    image_pil = preprocessing.open_image(image_file, draft=True, image_size=max(sizes)).convert('RGB')
+    thumbnails = {}
+    for size in sorted(sizes, reverse=True):
+        image_pil = image_pil.resize((size, size))
+        thumbnail = io.BytesIO()
+        image_pil.save(thumbnail, format='JPEG', quality=quality)
+        thumbnails[size] = thumbnail.getvalue()
+    return thumbnails
+
+
+def read_thumbnail_index(thumbnail_path=config.THUMBNAIL_PATH):
+    """
+    :return: Dictionary of listing ID -> hash of its image. Empty if no thumbnails were built.
+    """
+    index_file = os.path.sep.join([thumbnail_path, THUMBNAIL_INDEX])
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file) as f:
+        return json.load(f)
+
+
+def _build_listing_thumbnails(listing_id, thumbnail_path, sizes):
+    try:
+        with open(embedding_builder.listing_image_file(listing_id), 'rb') as f:
+            image_bytes = f.read()
+    except (IOError, OSError):
+        return None, False
+    content_hash = hashlib.sha1(image_bytes).hexdigest()
+    missing = [size for size in sizes
+               if not os.path.exists(os.path.sep.join([thumbnail_path, thumbnail_name(content_hash, size)]))]
+    if not missing:
+        return content_hash, False
+    try:
+        thumbnails = make_thumbnails(io.BytesIO(image_bytes), missing)
+    except (IOError, OSError):
+        return None, False
+    for size, thumbnail in thumbnails.items():
+        with open(os.path.sep.join([thumbnail_path, thumbnail_name(content_hash, size)]), 'wb') as f:
+            f.write(thumbnail)
+    return content_hash, True
+
+
+def build_thumbnails(listing_ids, thumbnail_path=config.THUMBNAIL_PATH, sizes=config.THUMBNAIL_SIZES, workers=4):
+    """
+    Builds the thumbnails of the listings that do not have them yet, and records them in the thumbnail index
+    :param listing_ids: Listing IDs to build thumbnails for
+    :param thumbnail_path: Directory to write the thumbnails to
+    :param sizes: Thumbnail sizes in pixels
+    :param workers: Number of threads resizing images
+    :return: Number of listings whose thumbnails were written
+    """
+    if not os.path.exists(thumbnail_path):
+        os.makedirs(thumbnail_path)
+    thumbnail_index = read_thumbnail_index(thumbnail_path)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda ii: _build_listing_thumbnails(ii, thumbnail_path, sizes), listing_ids))
+
+    written = 0
+    for listing_id, (content_hash, was_written) in zip(listing_ids, results):
+        if content_hash is not None:
+            thumbnail_index[listing_id] = content_hash
+        written += was_written
+    index_file = os.path.sep.join([thumbnail_path, THUMBNAIL_INDEX])
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(thumbnail_index, f, sort_keys=True)
+    os.replace(index_file + '.tmp', index_file)
+    return written
+
+
+def data_uri(jpeg_bytes):
+    return 'data:image/jpeg;base64,' + base64.b64encode(jpeg_bytes).decode()
+
+
+class ThumbnailCache:
+    """
+    Returns <img> sources for listing thumbnails, keeping encoded data URIs in a bounded LRU cache
+    """
+
+    def __init__(self, thumbnail_path=config.THUMBNAIL_PATH, base_url=config.THUMBNAIL_URL,
+                 max_bytes=config.THUMBNAIL_CACHE_BYTES, sizes=config.THUMBNAIL_SIZES):
+        """
+        :param thumbnail_path: Directory with the thumbnails built by build_thumbnails()
+        :param base_url: URL the thumbnail directory is served from. Thumbnails are inlined as data URIs if None.
+        :param max_bytes: Maximum total size of the data URIs held in memory
+        :param sizes: Thumbnail sizes that were built
+        """
+        self.thumbnail_path = thumbnail_path
+        self.base_url = base_url
+        self.sizes = sizes
+        self.thumbnail_index = {}
+        self._index_version = None
+        self.memory = LRUCache(max_entries=1000000, max_bytes=max_bytes, size_of=len)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-reads the thumbnail index if it changed since it was last read
+        """
+        try:
+            version = os.stat(os.path.sep.join([self.thumbnail_path, THUMBNAIL_INDEX])).st_mtime_ns
+        except OSError:
+            version = None
+        if version != self._index_version:
+            self.thumbnail_index = read_thumbnail_index(self.thumbnail_path)
+            self._index_version = version
+
+    def src(self, listing_id, image_size=224):
+        """
+        :param listing_id: Listing ID
+        :param image_size: Size the image is displayed at
+        :return: URL or data URI of the listing's thumbnail
+        """
+        size = choose_size(image_size, self.sizes)
+        content_hash = self.thumbnail_index.get(listing_id)
+        if content_hash is not None and self.base_url:
+            return self.base_url.rstrip('/') + '/' + thumbnail_name(content_hash, size)
+
+        thumbnail_file = None
+        if content_hash is not None:
+            thumbnail_file = os.path.sep.join([self.thumbnail_path, thumbnail_name(content_hash, size)])
+        if thumbnail_file is not None and os.path.exists(thumbnail_file):
+            key = (content_hash, size)
+            uri = self.memory.get(key)
+            if uri is None:
+                with open(thumbnail_file, 'rb') as f:
+                    uri = data_uri(f.read())
+                self.memory.put(key, uri)
+            return uri
+
+        # Listings added after the thumbnails were built are resized on the fly. They have no hash yet, so they are
+        # keyed by the modification time of their image.
+        image_file = embedding_builder.listing_image_file(listing_id)
+        key = (listing_id, os.stat(image_file).st_mtime_ns, size)
+        uri = self.memory.get(key)
+        if uri is None:
+            uri = data_uri(make_thumbnails(image_file, [size])[size])
+            self.memory.put(key, uri)
+        return uri
+
+    def upload_src(self, image_bytes, image_size=350):
+        """
+        :param image_bytes: Contents of an uploaded image file
+        :param image_size: Size the image is displayed at
+        :return: Data URI of a thumbnail of the upload
+        """
+        key = (hashlib.sha1(image_bytes).hexdigest(), image_size)
+        uri = self.memory.get(key)
+        if uri is None:
+            uri = data_uri(make_thumbnails(io.BytesIO(image_bytes), [image_size])[image_size])
+            self.memory.put(key, uri)
+        return uri
+
+    def stats(self):
+        return self.memory.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build thumbnails of the home-listing images.')
+    parser.add_argument('--output', type=str, default=config.THUMBNAIL_PATH, help='thumbnail directory')
+    parser.add_argument('--workers', type=int, default=4, help='number of image resizing threads')
+    args = parser.parse_args()
+
+    listing_ids = list(embedding_builder.read_listing_csvs().index)
+    written = build_thumbnails(listing_ids, args.output, workers=args.workers)
+    print("Wrote thumbnails for %d of %d listings to %s" % (written, len(listing_ids), args.output))
+
+
+if __name__ == "__main__":
+    main()
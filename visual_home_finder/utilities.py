@@ -1,22 +1,21 @@
 """
-Common functions used by notebooks and other scripts
+Common functions used by notebooks and other scripts.
+TensorFlow is only imported inside the functions that need it, so that importing this module stays fast.
 """
 
 import os
 import config
+import preprocessing
 import numpy as np
 
-from tensorflow.keras.models import Model, load_model
-from tensorflow.keras.applications import ResNet50
-from tensorflow.keras.preprocessing import image
-from PIL import Image
-
 
 def home_model():
     """
     Returns the home CNN model that we built to classify home styles.
     Takes a while to load. Do not call often. Best to get the model and cache result.
     """
+    from tensorflow.keras.models import load_model
+
     # Loading our home-style feature model
     home_model_instance = load_model(os.path.sep.join([config.MODEL_PATH, config.MODEL_NAME]))
 
@@ -28,8 +27,10 @@ def home_feature_model():
     Returns the home feature CNN model that we built to generate home feature embeddings
     Takes a while to load. Do not call often. Best to get the model and cache result.
     """
-    # Loading our home-style feature model
-    home_model = load_model(os.path.sep.join([config.MODEL_PATH, config.MODEL_NAME]))
+    from tensorflow.keras.models import Model, load_model
+
+    # Loading our home-style feature model. The feature model is only used for predictions, so skip compiling.
+    home_model = load_model(os.path.sep.join([config.MODEL_PATH, config.MODEL_NAME]), compile=False)
 
     # Get home-style features from the model
     our_feature_model = Model(inputs=home_model.input,
@@ -43,6 +44,9 @@ def resnet50_feature_model():
     Returns the Resnet50 feature model that generates home feature embeddings
     Takes a while to load.  Do not call often. Best to get the model and cache result.
     """
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.applications import ResNet50
+
     # Load Resnet50
     resnet_model = ResNet50()
 
@@ -53,6 +57,33 @@ def resnet50_feature_model():
     return resnet_feature_model
 
 
+def combined_home_model(home_model_instance=None):
+    """
+    Returns a single model that outputs the home-style class prediction, the home features (dense_4) and the
+    Resnet50 features (avg_pool) for a batch of images with one forward pass. The Resnet50 features are taken
+    from the frozen Resnet50 backbone inside our home model. If the home model does not contain the backbone
+    (older models), the model only outputs the class prediction and home features.
+    Takes a while to load. Do not call often. Best to get the model and cache result.
+    :param home_model_instance: Home-style classification model. Loaded if not given.
+    :return: Tuple of (Keras model, True if the model also outputs Resnet50 features)
+    """
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.layers import GlobalAveragePooling2D
+
+    if home_model_instance is None:
+        home_model_instance = home_model()
+    outputs = [home_model_instance.output, home_model_instance.get_layer('dense_4').output]
+
+    layer_names = [layer.name for layer in home_model_instance.layers]
+    has_resnet_features = 'conv5_block3_out' in layer_names
+    if has_resnet_features:
+        # Resnet50's avg_pool layer is a global average pool of the last convolution block
+        outputs.append(GlobalAveragePooling2D(name='avg_pool')(
+            home_model_instance.get_layer('conv5_block3_out').output))
+
+    return Model(inputs=home_model_instance.input, outputs=outputs), has_resnet_features
+
+
 def get_features_for_image(image_file_name, feature_model):
     """
     Returns the feature embeddings for an image using the home_feature_model
@@ -60,13 +91,9 @@ def get_features_for_image(image_file_name, feature_model):
     :param feature_model: Keras model to generate feature embeddings
     :return: feature embeddings for the image
     """
-
-    image_pil = Image.open(image_file_name)  # We are using PIL since keras image does not support IOBytes Tensorflow
-    #  2.2 onwards
-    image_pil = image_pil.resize((config.IMAGE_SIZE, config.IMAGE_SIZE))
-    image_array = image.img_to_array(image_pil)[..., :3]  # Some image types such as png have 4 channels (additional
-    # transparency channel. Remove fourth and only keep first 3 RGB channels
-    image_array = np.expand_dims(image_array - config.IMG_MEAN, axis=0)  # Shape = (1,222,224,3)
+    # We are using PIL since keras image does not support IOBytes Tensorflow 2.2 onwards
+    image_pil = preprocessing.open_image(image_file_name)
+    image_array = preprocessing.preprocess_image(image_pil, normalization='mean')  # Shape = (1,224,224,3)
     image_feature = np.ravel(feature_model.predict(image_array)).tolist()
     return image_feature
 
@@ -79,17 +106,27 @@ def get_features_for_image_with_scaling(image_file_name, feature_model):
     :param feature_model: Keras model to generate feature embeddings
     :return: feature embeddings for the image
     """
-
-    image_pil = Image.open(image_file_name)  # We are using PIL since keras image does not support IOBytes Tensorflow
-    #  2.2 onwards
-    image_pil = image_pil.resize((config.IMAGE_SIZE, config.IMAGE_SIZE))
-    image_array = image.img_to_array(image_pil)[..., :3]  # Some image types such as png have 4 channels (additional
-    # transparency channel. Remove fourth and only keep first 3 RGB channels
-    image_array = np.expand_dims(image_array/256, axis=0)  # Shape = (1,222,224,3)
+    # We are using PIL since keras image does not support IOBytes Tensorflow 2.2 onwards
+    image_pil = preprocessing.open_image(image_file_name)
+    image_array = preprocessing.preprocess_image(image_pil, normalization='scale')  # Shape = (1,224,224,3)
     image_feature = np.ravel(feature_model.predict(image_array)).tolist()
     return image_feature
 
 
+def get_home_stats(listings_df):
+    """
+    :param listings_df: Dataframe containing home listings
+    :return: Returns a dictionary with various home stats
+    """
+    home_stats = {}
+    home_stats['Avg Days on Market'] = listings_df['DAYS ON MARKET'].mean()
+    home_stats['Earliest Year Built'] = listings_df['YEAR BUILT'].min()
+    home_stats['Latest Year Built'] = listings_df['YEAR BUILT'].max()
+    home_stats['Min Price'] = listings_df['PRICE'].min()
+    home_stats['Max Price'] = listings_df['PRICE'].max()
+    return home_stats
+
+
 def str_to_array(string_numpy):
     """formatting : Conversion of String List to List
 
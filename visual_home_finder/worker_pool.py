@@ -0,0 +1,341 @@
+"""
+Multi-process worker pool for the feature model.
+
+A single process runs TensorFlow with one set of thread pools for every request, which scales poorly on machines with
+many cores. The pool starts num_workers processes that each load the feature model once, with their own number of
+intra-op threads and (optionally) pinned to their own block of CPUs. Images are handed to the workers through
+shared-memory batch buffers: the parent copies a batch in to a free slot of a worker's buffer and only sends the
+slot number, so image arrays are never pickled. Every worker has two slots, so the next batch can be copied in
+while the current one runs.
+
+WorkerPool has the same predict()/ predict_on_batch() interface as the Keras model and can be called from many
+threads at once, e.g. by the inference server's micro-batcher threads. If a worker exits (e.g. crashes in the model),
+its pending batches fail with a RuntimeError and its slots are dropped, so the other workers keep serving.
+
+Usage (from the visual_home_finder directory) to measure throughput for different layouts:
+    python worker_pool.py --workers 1 2 4 8 --intra_op_threads 0 --affinity --output worker_pool.json
+"""
+
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import config
+
+IMAGE_SHAPE = (config.IMAGE_SIZE, config.IMAGE_SIZE, 3)
+
+
+def cpu_blocks(num_workers):
+    """
+    Splits the CPUs this process may run on in to one contiguous block per worker
+    :return: List of num_workers lists of CPU numbers
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    return [[int(cpu) for cpu in block] for block in np.array_split(cpus, num_workers) if len(block)]
+
+
+def _worker_main(worker_id, shm_name, slots, max_batch_size, task_queue, result_queue, backend, intra_op_threads,
+                 inter_op_threads, cpus, model_loader):
+    # Spawned workers share the parent's resource tracker, so the buffer is only unlinked once, by the parent
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffers = np.ndarray((slots, max_batch_size) + IMAGE_SHAPE, dtype=np.float32, buffer=shm.buf)
+
+    try:
+        if cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        # Thread pools have to be configured before TensorFlow runs anything
+        if intra_op_threads or inter_op_threads:
+            import tensorflow as tf
+            if intra_op_threads:
+                tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+            if inter_op_threads:
+                tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+        if model_loader is None:
+            import model_registry
+            feature_model = model_registry.get_feature_model(backend)
+        else:
+            feature_model = model_loader()
+        # One warm-up pass, so the first request is not slowed down and the parent learns the embedding size
+        embedding_size = np.asarray(feature_model.predict_on_batch(buffers[0, :1])).shape[-1]
+        result_queue.put((worker_id, None, embedding_size))
+    except Exception as e:
+        result_queue.put((worker_id, None, RuntimeError('Worker %d could not start: %r' % (worker_id, e))))
+        return
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        slot, count = task
+        try:
+            result = np.asarray(feature_model.predict_on_batch(buffers[slot, :count]), dtype=np.float32)
+        except Exception as e:
+            result = RuntimeError('Worker %d failed: %r' % (worker_id, e))
+        result_queue.put((worker_id, slot, result))
+    del buffers
+    shm.close()
+
+
+class WorkerPool:
+    """
+    Runs the feature model in worker processes fed through shared memory
+    """
+
+    def __init__(self, num_workers=config.WORKER_POOL_SIZE, intra_op_threads=config.WORKER_INTRA_OP_THREADS,
+                 inter_op_threads=None, cpu_affinity=config.WORKER_CPU_AFFINITY,
+                 max_batch_size=config.SERVER_MAX_BATCH_SIZE, backend=config.FEATURE_BACKEND, slots=2,
+                 model_loader=None):
+        """
+        :param num_workers: Number of worker processes
+        :param intra_op_threads: TensorFlow intra-op threads per worker (None or 0 for TensorFlow's default)
+        :param inter_op_threads: TensorFlow inter-op threads per worker (None or 0 for TensorFlow's default)
+        :param cpu_affinity: If True, every worker is pinned to its own block of CPUs
+        :param max_batch_size: Maximum number of images per forward pass. Larger batches are split.
+        :param backend: Feature model backend, see model_registry.get_feature_model()
+        :param slots: Number of batch buffers per worker
+        :param model_loader: Picklable function that returns the model, instead of the feature model (for tests)
+        """
+        self.num_workers = num_workers
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.images = 0
+        context = multiprocessing.get_context('spawn')
+        self._result_queue = context.Queue()
+        self._task_queues = []
+        self._shms = []
+        self._buffers = []
+        self._processes = []
+        self._free_slots = queue.Queue()
+        self._pending = {}
+        self._dead = set()
+        self._lock = threading.Lock()
+        self.embedding_size = None
+
+        blocks = cpu_blocks(num_workers) if cpu_affinity else [None] * num_workers
+        slot_bytes = max_batch_size * int(np.prod(IMAGE_SHAPE)) * np.dtype(np.float32).itemsize
+        for worker_id in range(num_workers):
+            shm = shared_memory.SharedMemory(create=True, size=slots * slot_bytes)
+            self._shms.append(shm)
+            self._buffers.append(np.ndarray((slots, max_batch_size) + IMAGE_SHAPE, dtype=np.float32, buffer=shm.buf))
+            task_queue = context.Queue()
+            self._task_queues.append(task_queue)
+            process = context.Process(target=_worker_main, daemon=True,
+                                      args=(worker_id, shm.name, slots, max_batch_size, task_queue,
+                                            self._result_queue, backend, intra_op_threads, inter_op_threads,
+                                            blocks[worker_id % len(blocks)], model_loader))
+            process.start()
+            self._processes.append(process)
+
+        # Wait for every worker to load the model, so the first requests are not slowed down by it
+        started = 0
+        while started < num_workers:
+            try:
+                worker_id, _, status = self._result_queue.get(timeout=1)
+            except queue.Empty:
+                if all(process.is_alive() for process in self._processes):
+                    continue
+                status = RuntimeError('A worker exited while loading the model')
+            if isinstance(status, Exception):
+                self.close()
+                raise status
+            self.embedding_size = status
+            started += 1
+        # Slots are handed out round-robin over the workers
+        for slot in range(slots):
+            for worker_id in range(num_workers):
+                self._free_slots.put((worker_id, slot))
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def _collect(self):
+        while True:
+            try:
+                worker_id, slot, result = self._result_queue.get(timeout=0.5)
+            except queue.Empty:
+                worker_id, slot, result = -1, None, None
+            self._check_workers()
+            if worker_id is None:
+                break
+            with self._lock:
+                future = self._pending.pop((worker_id, slot), None)
+            if future is None:
+                continue
+            self._free_slots.put((worker_id, slot))
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _check_workers(self):
+        """
+        Fails the pending batches of workers that exited (e.g. crashed in the model) and drops their slots, so callers
+        never wait for a result that will not come
+        """
+        for worker_id, process in enumerate(self._processes):
+            if worker_id in self._dead or process.is_alive():
+                continue
+            with self._lock:
+                self._dead.add(worker_id)
+                failed = [self._pending.pop(key) for key in list(self._pending) if key[0] == worker_id]
+            error = RuntimeError('Worker %d exited with code %s' % (worker_id, process.exitcode))
+            for future in failed:
+                future.set_exception(error)
+            if len(self._dead) == self.num_workers:
+                # Wakes up the submit() calls waiting for a slot
+                self._free_slots.put((None, None))
+
+    def submit(self, batch):
+        """
+        Copies a batch of at most max_batch_size images in to a free worker slot and queues it. Blocks while all
+        slots are in use. Raises a RuntimeError if no worker is running.
+        :param batch: (batch x IMAGE_SIZE x IMAGE_SIZE x 3) float32 array
+        :return: Future that resolves to the (batch x embedding size) embeddings
+        """
+        if len(batch) > self.max_batch_size:
+            raise ValueError("Batch of %d images is larger than max_batch_size %d" % (len(batch),
+                                                                                    self.max_batch_size))
+        while True:
+            worker_id, slot = self._free_slots.get()
+            if worker_id is None:
+                # Passed on, so every waiting caller wakes up
+                self._free_slots.put((None, None))
+                raise RuntimeError('No worker of the pool is running')
+            # Slots of workers that exited are dropped
+            if worker_id not in self._dead:
+                break
+        self._buffers[worker_id][slot, :len(batch)] = batch
+        future = Future()
+        with self._lock:
+            if worker_id in self._dead:
+                raise RuntimeError('Worker %d exited' % worker_id)
+            self._pending[(worker_id, slot)] = future
+            self.batches += 1
+            self.images += len(batch)
+        self._task_queues[worker_id].put((slot, len(batch)))
+        return future
+
+    def predict_on_batch(self, batch):
+        """
+        :param batch: (batch x IMAGE_SIZE x IMAGE_SIZE x 3) float32 array, split over the workers if it is larger
+        than max_batch_size
+        :return: (batch x embedding size) array of embeddings
+        """
+        if len(batch) == 0:
+            return np.zeros((0, self.embedding_size), dtype=np.float32)
+        futures = [self.submit(batch[start:start + self.max_batch_size])
+                   for start in range(0, len(batch), self.max_batch_size)]
+        return np.concatenate([future.result() for future in futures])
+
+    predict = predict_on_batch
+
+    def stats(self):
+        return {'workers': self.num_workers, 'batches': self.batches, 'images': self.images}
+
+    def close(self):
+        """
+        Stops the workers and frees the shared memory
+        """
+        self._free_slots.put((None, None))
+        for task_queue, process in zip(self._task_queues, self._processes):
+            if process.is_alive():
+                task_queue.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self._result_queue.put((None, None, None))
+        self._buffers = []
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def measure_throughput(feature_model, num_images=512, batch_size=8, concurrency=16):
+    """
+    Measures embedding throughput with concurrent clients
+    :param feature_model: Model or WorkerPool with predict_on_batch()
+    :param num_images: Number of images embedded
+    :param batch_size: Number of images per request
+    :param concurrency: Number of concurrent clients
+    :return: Images per second
+    """
+    rng = np.random.RandomState(0)
+    batch = rng.uniform(-128, 128, (batch_size,) + IMAGE_SHAPE).astype(np.float32)
+    feature_model.predict_on_batch(batch)
+    num_requests = max(1, num_images // batch_size)
+    starting_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda _: feature_model.predict_on_batch(batch), range(num_requests)))
+    return num_requests * batch_size / (time.perf_counter() - starting_time)
+
+
+def layout_report(worker_counts, intra_op_threads=(0,), cpu_affinity=False, num_images=512, batch_size=8,
+                  concurrency=16, backend=config.FEATURE_BACKEND, model_loader=None):
+    """
+    Measures throughput for every combination of worker count and intra-op threads
+    :param worker_counts: Numbers of worker processes to try
+    :param intra_op_threads: Numbers of intra-op threads per worker to try. 0 uses the CPUs per worker (with
+    affinity) or TensorFlow's default.
+    :return: List of dictionaries, one per layout
+    """
+    results = []
+    for num_workers in worker_counts:
+        for threads in intra_op_threads:
+            if threads == 0 and cpu_affinity:
+                threads = len(cpu_blocks(num_workers)[0])
+            starting_time = time.perf_counter()
+            with WorkerPool(num_workers, threads or None, cpu_affinity=cpu_affinity, max_batch_size=batch_size,
+                            backend=backend, model_loader=model_loader) as pool:
+                start_seconds = time.perf_counter() - starting_time
+                images_per_sec = measure_throughput(pool, num_images, batch_size, concurrency)
+            results.append({'workers': num_workers, 'intra_op_threads': threads, 'cpu_affinity': cpu_affinity,
+                            'start_seconds': start_seconds, 'images_per_sec': images_per_sec})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure feature model throughput for worker pool layouts.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='numbers of worker processes')
+    parser.add_argument('--intra_op_threads', type=int, nargs='+', default=[0],
+                        help='numbers of intra-op threads per worker (0: CPUs per worker with --affinity, else '
+                             "TensorFlow's default)")
+    parser.add_argument('--affinity', action='store_true', help='pin every worker to its own block of CPUs')
+    parser.add_argument('--num_images', type=int, default=512, help='number of images per measurement')
+    parser.add_argument('--batch_size', type=int, default=8, help='number of images per request')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of concurrent clients')
+    parser.add_argument('--backend', type=str, default=config.FEATURE_BACKEND, help='feature model backend')
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    args = parser.parse_args()
+
+    import model_registry
+
+    in_process = measure_throughput(model_registry.get_feature_model(args.backend), args.num_images,
+                                    args.batch_size, args.concurrency)
+    print("in-process: %.1f images/sec" % in_process)
+    results = layout_report(args.workers, args.intra_op_threads, args.affinity, args.num_images, args.batch_size,
+                            args.concurrency, args.backend)
+    for result in results:
+        print("workers=%(workers)-3d intra_op_threads=%(intra_op_threads)-3d %(images_per_sec).1f images/sec "
+              "(started in %(start_seconds).1f s)" % result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'cpus': len(cpu_blocks(1)[0]), 'in_process_images_per_sec': in_process, 'layouts': results},
+                      f, indent=2)
+
+
+if __name__ == "__main__":
+    main()